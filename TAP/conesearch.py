@@ -0,0 +1,289 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import re
+import math
+import logging
+
+from spatial_index import SpatialIndex
+
+from TAP.filecache import fileCache
+
+
+class coneSearch:
+
+    """
+    coneSearch makes the WHERE constraint of a cone search (all the
+    records within radius of ra, dec) on a table with the x, y, z and
+    spatial index columns (see spatial_index): an exact dot product test
+    on x, y, z and a superset of it on the index column, as a short list
+    of index ranges the DBMS can scan with its B-tree index.
+
+    The cells covering the cone come from SpatialIndex; ranges that touch
+    or overlap are merged, and if there are more than maxranges, the ones
+    with the smallest gaps between them are merged too (the x, y, z test
+    drops the extra records).  The ranges only depend on the cone and the
+    index settings, so they are kept in the 'coneranges' file cache.
+
+    Required input:
+
+        ra, dec, radius:  cone center and radius (degrees)
+
+    Optional input:
+
+        mode:             SpatialIndex.HTM (default) or SpatialIndex.HPX
+
+        level:            index level (default 7)
+
+        colname:          index column (default 'spt_ind')
+
+        encoding:         SpatialIndex.BASE4 (default) or BASE10
+
+        xcol, ycol, zcol: unit vector columns (default 'x', 'y', 'z')
+
+        maxranges:        most index ranges in the constraint (default 64)
+
+        cachedir:         cache directory (default: no cache)
+
+    Usage:
+
+        cone = coneSearch(10.68, 41.27, 0.01, mode=SpatialIndex.HTM,
+                          level=20, colname='htm20',
+                          encoding=SpatialIndex.BASE10,
+                          cachedir=config.cachedir)
+
+        sql = 'select * from ps where ' + cone.constraint
+    """
+
+    debug = 0
+
+    mode = SpatialIndex.HTM
+    level = 7
+    colname = 'spt_ind'
+    encoding = SpatialIndex.BASE4
+
+    xcol = 'x'
+    ycol = 'y'
+    zcol = 'z'
+
+    maxranges = 64
+    cachedir = ''
+    ttl = 86400*30
+
+    ranges = []
+
+    geom_constraint = ''
+    index_constraint = ''
+    constraint = ''
+
+    ncell = 0
+
+    cellpattern = re.compile(r'between\s+(\d+)\s+and\s+(\d+)|=\s*(\d+)',
+                             re.IGNORECASE)
+
+    def __init__(self, ra, dec, radius, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        for key in ['mode', 'level', 'colname', 'encoding', 'xcol', 'ycol',
+                    'zcol', 'maxranges', 'cachedir']:
+
+            if(key in kwargs):
+                setattr(self, key, kwargs[key])
+
+        self.level = int(self.level)
+
+        if((dec < -90.) or (dec > 90.)):
+            self.msg = 'Cone search DEC must be between -90 and 90.'
+            raise Exception(self.msg)
+
+        if((radius <= 0.) or (radius > 180.)):
+            self.msg = 'Cone search radius must be between 0 and 180 degrees.'
+            raise Exception(self.msg)
+
+        self.ra = ra % 360.
+        self.dec = dec
+        self.radius = radius
+
+        #
+        # Index ranges: from the cache, or from SpatialIndex
+        #
+
+        cache = None
+        key = f'{self.mode}|{self.level:d}|{self.encoding}|' \
+              f'{self.maxranges:d}|{self.ra:.17g}|{self.dec:.17g}|' \
+              f'{self.radius:.17g}'
+
+        ranges = None
+
+        if(len(self.cachedir) > 0):
+
+            try:
+                cache = fileCache(self.cachedir, 'coneranges', ttl=self.ttl,
+                                  debug=self.debug)
+
+                ranges = cache.get(key)
+
+            except Exception as e:
+                cache = None
+
+        if ranges is None:
+
+            ranges = self.__coalesce__(self.__cells__())
+
+            if cache is not None:
+                cache.put(key, ranges)
+
+        self.ranges = [(int(lo), int(hi)) for (lo, hi) in ranges]
+
+        #
+        # Constraints
+        #
+
+        self.geom_constraint = self.__geomConstraint__()
+
+        terms = []
+        for (lo, hi) in self.ranges:
+
+            if(lo == hi):
+                terms.append(f'({self.colname:s} = {lo:d})')
+            else:
+                terms.append(f'({self.colname:s} between {lo:d} and {hi:d})')
+
+        self.index_constraint = '(' + ' or '.join(terms) + ')'
+
+        self.constraint = '(' + self.geom_constraint + ' and ' + \
+            self.index_constraint + ')'
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'coneSearch: {self.ncell:d} cell ranges -> '
+                          f'{len(self.ranges):d}')
+            logging.debug(f'constraint: {self.constraint:s}')
+
+        #
+        # } end of init
+        #
+
+
+    def __cells__(self, **kwargs):
+
+        # Index ranges covering the cone, read from the index constraint
+        # SpatialIndex makes ("col = n" and "col between n1 and n2" terms)
+        #
+
+        index = SpatialIndex()
+
+        retval = index.cone_search(self.ra, self.dec, self.radius,
+                                   self.mode, self.level,
+                                   self.xcol, self.ycol, self.zcol,
+                                   self.colname, self.encoding)
+
+        ranges = []
+
+        for match in self.cellpattern.finditer(retval['index_constraint']):
+
+            if match.group(3) is not None:
+                lo = int(match.group(3))
+                hi = lo
+            else:
+                lo = int(match.group(1))
+                hi = int(match.group(2))
+
+            ranges.append((min(lo, hi), max(lo, hi)))
+
+        if(len(ranges) == 0):
+            self.msg = 'No index cells found for the cone.'
+            raise Exception(self.msg)
+
+        self.ncell = len(ranges)
+
+        return(ranges)
+
+
+    def __coalesce__(self, ranges, **kwargs):
+
+        #
+        # {
+        #
+
+        # Merge touching or overlapping ranges, then the closest ranges
+        # until there are at most maxranges
+        #
+
+        merged = []
+
+        for (lo, hi) in sorted(ranges):
+
+            if((len(merged) > 0) and (lo <= merged[-1][1] + 1)):
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+
+        while((self.maxranges > 0) and (len(merged) > self.maxranges)):
+
+            gaps = sorted([(merged[i+1][0] - merged[i][1],
+                            merged[i+1][1] - merged[i][0], i)
+                           for i in range(len(merged) - 1)])
+
+            #
+            # Merge across the smallest gaps, several per pass but not
+            # two next to each other, so that equal gaps do not chain into
+            # one long range
+            #
+
+            nmerge = len(merged) - self.maxranges
+
+            drop = set()
+            for (gap, span, i) in gaps:
+
+                if(len(drop) >= nmerge):
+                    break
+
+                if(((i - 1) in drop) or ((i + 1) in drop)):
+                    continue
+
+                drop.add(i)
+
+            out = []
+            for i in range(len(merged)):
+
+                if((i - 1) in drop):
+                    out[-1][1] = merged[i][1]
+                else:
+                    out.append(list(merged[i]))
+
+            merged = out
+
+        return(merged)
+
+        #
+        # } end of coalesce def
+        #
+
+
+    def __geomConstraint__(self, **kwargs):
+
+        # Dot product of the record's unit vector with the cone center's
+        # against the cosine of the radius, with all the digits of the
+        # doubles (for small radii cos(r) differs from 1 beyond the 12th)
+        #
+
+        ra = math.radians(self.ra)
+        dec = math.radians(self.dec)
+
+        cx = math.cos(dec)*math.cos(ra)
+        cy = math.cos(dec)*math.sin(ra)
+        cz = math.sin(dec)
+
+        cosr = math.cos(math.radians(self.radius))
+
+        return(f'(({cx:.17g}*{self.xcol:s})+({cy:.17g}*{self.ycol:s})+'
+               f'({cz:.17g}*{self.zcol:s})>={cosr:.17g})')
@@ -87,6 +87,102 @@ class configParam:
         self.arraysize = arraysize
 
 
+        #
+        # Number of threads formatting result batches in parallel
+        # with the DB fetch (1: format in the fetching thread)
+        #
+
+        nworker = 1
+
+        if('WriterThreads' in confobj[self.server]):
+            try:
+                nworker = int(confobj[self.server]['WriterThreads'])
+            except Exception as e:
+                nworker = 1
+
+        if(nworker < 1):
+            nworker = 1
+
+        self.nworker = nworker
+
+
+        #
+        # Prefetch the next batch in a background thread while the
+        # current one is written; the batch size is then tuned between
+        # ArraySize and ArraySizeMax
+        #
+
+        prefetch = 0
+
+        if('Prefetch' in confobj[self.server]):
+            try:
+                prefetch = int(confobj[self.server]['Prefetch'])
+            except Exception as e:
+                prefetch = 0
+
+        self.prefetch = prefetch
+
+        arraysize_max = 4*self.arraysize
+
+        if('ArraySizeMax' in confobj[self.server]):
+            try:
+                arraysize_max = int(confobj[self.server]['ArraySizeMax'])
+            except Exception as e:
+                arraysize_max = 4*self.arraysize
+
+        self.arraysize_max = arraysize_max
+
+
+        #
+        # Width of the numeric columns not in the data dictionary and
+        # number of rows sampled to tell int from float for the ones
+        # without DB type information
+        #
+
+        numwidth = 22
+
+        if('NumWidth' in confobj[self.server]):
+            try:
+                numwidth = int(confobj[self.server]['NumWidth'])
+            except Exception as e:
+                numwidth = 22
+
+        self.numwidth = numwidth
+
+        nsample = 100
+
+        if('TypeSample' in confobj[self.server]):
+            try:
+                nsample = int(confobj[self.server]['TypeSample'])
+            except Exception as e:
+                nsample = 100
+
+        if(nsample < 1):
+            nsample = 1
+
+        self.nsample = nsample
+
+
+        #
+        # Memory budget (MB) for the result batches in flight: the
+        # arraysize is then sized from the measured bytes per row
+        # (0: fixed ArraySize)
+        #
+
+        memory_budget = 0
+
+        if('MemoryBudget' in confobj[self.server]):
+            try:
+                memory_budget = int(confobj[self.server]['MemoryBudget'])
+            except Exception as e:
+                memory_budget = 0
+
+        if(memory_budget < 0):
+            memory_budget = 0
+
+        self.memory_budget = memory_budget*1024*1024
+
+
         self.connectInfo = {}
 
         self.connectInfo['dbms'] = dbms
@@ -193,6 +289,54 @@ class configParam:
         if('ADQL_ENCODING' in confobj[self.server]):
             self.adqlparam['encoding'] = confobj[self.server]['ADQL_ENCODING']
 
+        if('ADQL_COLNAME' in confobj[self.server]):
+            self.adqlparam['colname'] = confobj[self.server]['ADQL_COLNAME']
+
+        #
+        # Most index ranges in a cone search constraint (the closest
+        # ranges are merged beyond that)
+        #
+
+        self.cone_maxranges = 64
+        if('CONE_MAXRANGES' in confobj[self.server]):
+            try:
+                self.cone_maxranges = \
+                    int(confobj[self.server]['CONE_MAXRANGES'])
+            except Exception as e:
+                self.cone_maxranges = 64
+
+        self.upload_maxrows = 100000
+        if('UPLOAD_MAXROWS' in confobj[self.server]):
+            try:
+                self.upload_maxrows = \
+                    int(confobj[self.server]['UPLOAD_MAXROWS'])
+            except Exception as e:
+                self.upload_maxrows = 100000
+
+        self.xmatch_maxranges = 8
+        if('XMATCH_MAXRANGES' in confobj[self.server]):
+            try:
+                self.xmatch_maxranges = \
+                    int(confobj[self.server]['XMATCH_MAXRANGES'])
+            except Exception as e:
+                self.xmatch_maxranges = 8
+
+        self.parallel_scan = 0
+        if('PARALLEL_SCAN' in confobj[self.server]):
+            try:
+                self.parallel_scan = \
+                    int(confobj[self.server]['PARALLEL_SCAN'])
+            except Exception as e:
+                self.parallel_scan = 0
+
+        self.parallel_minrows = 1000000
+        if('PARALLEL_SCAN_MINROWS' in confobj[self.server]):
+            try:
+                self.parallel_minrows = \
+                    int(confobj[self.server]['PARALLEL_SCAN_MINROWS'])
+            except Exception as e:
+                self.parallel_minrows = 1000000
+
 
         self.workdir = ''
         if('TAP_WORKDIR' in confobj[self.server]):
@@ -274,6 +418,160 @@ class configParam:
         if('DECCOL' in confobj[self.server]):
             self.deccol = confobj[self.server]['DECCOL']
 
+        #
+        # Directory for the caches shared by the service processes and
+        # the time-to-live (sec) of the cached user access IDs and of
+        # the validated login cookies
+        #
+
+        self.cachedir = self.workdir + '/TAP/cache'
+        if('TAP_CACHEDIR' in confobj[self.server]):
+            self.cachedir = confobj[self.server]['TAP_CACHEDIR']
+
+        self.access_ttl = 600
+        if('ACCESS_TTL' in confobj[self.server]):
+            try:
+                self.access_ttl = int(confobj[self.server]['ACCESS_TTL'])
+            except Exception as e:
+                self.access_ttl = 600
+
+        self.session_ttl = 300
+        if('SESSION_TTL' in confobj[self.server]):
+            try:
+                self.session_ttl = int(confobj[self.server]['SESSION_TTL'])
+            except Exception as e:
+                self.session_ttl = 300
+
+        #
+        # Diagnostic: have propfilter write the allowed fileids of each
+        # query to the user workdir
+        #
+
+        self.fileidtbl = 0
+        if('FILEID_TBL' in confobj[self.server]):
+            try:
+                self.fileidtbl = int(confobj[self.server]['FILEID_TBL'])
+            except Exception as e:
+                self.fileidtbl = 0
+
+        #
+        # Precomputed public release date column of the propfilter
+        # tables (see TAP.releasedate)
+        #
+
+        self.releasecol = ''
+        if('RELEASE_COL' in confobj[self.server]):
+            self.releasecol = confobj[self.server]['RELEASE_COL']
+
+        #
+        # Share the propfilter results of users without grants (public
+        # data only) between identical requests until the next midnight
+        #
+
+        self.public_cache = 0
+        if('PUBLIC_CACHE' in confobj[self.server]):
+            try:
+                self.public_cache = int(confobj[self.server]['PUBLIC_CACHE'])
+            except Exception as e:
+                self.public_cache = 0
+
+        #
+        # Result cache: byte budget (config in MB) of the result files
+        # kept under cachedir, and how long they are used
+        #
+
+        self.result_cache = 0
+        if('RESULT_CACHE' in confobj[self.server]):
+            try:
+                self.result_cache = int(
+                    float(confobj[self.server]['RESULT_CACHE'])*1024*1024)
+            except Exception as e:
+                self.result_cache = 0
+
+        self.result_ttl = 3600
+        if('RESULT_TTL' in confobj[self.server]):
+            try:
+                self.result_ttl = int(confobj[self.server]['RESULT_TTL'])
+            except Exception as e:
+                self.result_ttl = 3600
+
+        #
+        # Single flight: seconds the result of a query is shared with the
+        # identical requests that waited for it (without RESULT_CACHE)
+        #
+
+        self.single_flight = 0
+        if('SINGLE_FLIGHT' in confobj[self.server]):
+            try:
+                self.single_flight = \
+                    int(confobj[self.server]['SINGLE_FLIGHT'])
+            except Exception as e:
+                self.single_flight = 0
+
+        #
+        # Data version of the tables, for the caches (see TAP.dataversion):
+        # mode ('sql', 'tap_schema', 'mtime'), query, TAP_SCHEMA.tables
+        # column and seconds between lookups
+        #
+
+        self.dataversion = ''
+        if('DATA_VERSION' in confobj[self.server]):
+            self.dataversion = confobj[self.server]['DATA_VERSION']
+
+        self.dataversion_sql = ''
+        if('DATA_VERSION_SQL' in confobj[self.server]):
+            self.dataversion_sql = confobj[self.server]['DATA_VERSION_SQL']
+
+        self.dataversion_col = 'version'
+        if('DATA_VERSION_COL' in confobj[self.server]):
+            self.dataversion_col = confobj[self.server]['DATA_VERSION_COL']
+
+        self.dataversion_interval = 60
+        if('DATA_VERSION_INTERVAL' in confobj[self.server]):
+            try:
+                self.dataversion_interval = \
+                    int(confobj[self.server]['DATA_VERSION_INTERVAL'])
+            except Exception as e:
+                self.dataversion_interval = 60
+
+        #
+        # Seconds the VOSI documents are kept when the TAP_SCHEMA version
+        # is not known (see DATA_VERSION)
+        #
+
+        self.vosi_ttl = 3600
+        if('VOSI_TTL' in confobj[self.server]):
+            try:
+                self.vosi_ttl = int(confobj[self.server]['VOSI_TTL'])
+            except Exception as e:
+                self.vosi_ttl = 3600
+
+        #
+        # TAP_SCHEMA queries are answered from a local SQLite copy of
+        # TAP_SCHEMA; seconds the copy is used when the TAP_SCHEMA version
+        # is not known (0: off)
+        #
+
+        self.tapschema_cache = 0
+        if('TAP_SCHEMA_CACHE' in confobj[self.server]):
+            try:
+                self.tapschema_cache = \
+                    int(confobj[self.server]['TAP_SCHEMA_CACHE'])
+            except Exception as e:
+                self.tapschema_cache = 0
+
+        #
+        # Table routing for propfilter: the [tablemap] section has one
+        # sub-section per table (instrument, datalevel, fileid, datecol,
+        # propcol); see TAP.tablemap
+        #
+
+        self.tablemap = {}
+        if('tablemap' in confobj):
+
+            for name in confobj['tablemap'].sections:
+                self.tablemap[name] = dict(confobj['tablemap'][name])
+
         if self.debug:
             logging.debug('')
             logging.debug(f'      workdir    = {self.workdir:s}')
@@ -289,5 +587,26 @@ class configParam:
             logging.debug(f'      accessid   = {self.accessid:s}')
             logging.debug(f'      racol      = {self.racol:s}')
             logging.debug(f'      deccol     = {self.deccol:s}')
+            logging.debug(f'      cachedir   = {self.cachedir:s}')
+            logging.debug(f'      access_ttl = {self.access_ttl:d}')
+            logging.debug(f'      session_ttl = {self.session_ttl:d}')
+            logging.debug(f'      fileidtbl  = {self.fileidtbl:d}')
+            logging.debug(f'      releasecol = {self.releasecol:s}')
+            logging.debug(f'      public_cache = {self.public_cache:d}')
+            logging.debug(f'      result_cache = {self.result_cache:d}')
+            logging.debug(f'      result_ttl = {self.result_ttl:d}')
+            logging.debug(f'      single_flight = {self.single_flight:d}')
+            logging.debug(f'      dataversion = {self.dataversion:s}')
+            logging.debug(f'      dataversion_interval = '
+                          f'{self.dataversion_interval:d}')
+            logging.debug(f'      vosi_ttl = {self.vosi_ttl:d}')
+            logging.debug(f'      tapschema_cache = {self.tapschema_cache:d}')
+            logging.debug(f'      cone_maxranges = {self.cone_maxranges:d}')
+            logging.debug(f'      upload_maxrows = {self.upload_maxrows:d}')
+            logging.debug(f'      xmatch_maxranges = {self.xmatch_maxranges:d}')
+            logging.debug(f'      parallel_scan = {self.parallel_scan:d}')
+            logging.debug(f'      parallel_minrows = '
+                          f'{self.parallel_minrows:d}')
+            logging.debug(f'      tablemap   = {str(self.tablemap):s}')
 
         return
@@ -0,0 +1,267 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import logging
+import argparse
+
+from TAP.filecache import fileCache
+from TAP.configparam import configParam
+
+
+class dataVersion:
+
+    """
+    dataVersion returns a version string for the contents of a table, so
+    that the caches (results, VOSI documents, ...) can tell when the data
+    was reloaded.  The version is taken from one of:
+
+        'sql':         a query returning one value, e.g.
+                       "select max(load_id) from {table}" ({table} is
+                       replaced by the table name)
+
+        'tap_schema':  a column of TAP_SCHEMA.tables (e.g. a load date
+                       set by the loader) for the table's row
+
+        'mtime':       the modification time of the SQLite database file
+                       (and its write-ahead log); the TAP_SCHEMA database
+                       for the TAP_SCHEMA tables
+
+    The value is looked up at most once per interval: it is kept in the
+    'dataversion' file cache under cachedir in between.  An empty string
+    means no version is known (mode '', or the lookup failed).
+
+    Required input:
+
+        connectInfo:  DBMS connection info (as in configParam)
+
+        dbtable:      table name
+
+    Optional input:
+
+        mode:         'sql', 'tap_schema', 'mtime' or '' (default)
+
+        sql:          query for mode 'sql'
+
+        column:       TAP_SCHEMA.tables column for mode 'tap_schema'
+                      (default 'version')
+
+        interval:     seconds between lookups (default 60)
+
+        cachedir:     cache directory (default: look up every time)
+
+    Usage:
+
+        dv = dataVersion(config.connectInfo, 'ps', mode='sql',
+                         sql='select max(load_id) from {table}',
+                         cachedir=config.cachedir)
+
+        version = dv.version
+    """
+
+    debug = 0
+
+    mode = ''
+    sql = ''
+    column = 'version'
+    interval = 60
+    cachedir = ''
+
+    version = ''
+
+    def __init__(self, connectInfo, dbtable, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('mode' in kwargs):
+            self.mode = kwargs['mode'].lower()
+
+        if('sql' in kwargs):
+            self.sql = kwargs['sql']
+
+        if('column' in kwargs):
+            self.column = kwargs['column']
+
+        if('interval' in kwargs):
+            self.interval = kwargs['interval']
+
+        if('cachedir' in kwargs):
+            self.cachedir = kwargs['cachedir']
+
+        self.connectInfo = connectInfo
+        self.dbms = connectInfo['dbms'].lower()
+        self.dbtable = dbtable.lower()
+
+        if(len(self.mode) == 0):
+            return
+
+        cache = None
+        key = self.mode + '|' + self.dbtable
+
+        if((len(self.cachedir) > 0) and (self.interval > 0)):
+
+            try:
+                cache = fileCache(self.cachedir, 'dataversion',
+                                  ttl=self.interval, debug=self.debug)
+
+                version = cache.get(key)
+
+                if version is not None:
+                    self.version = version
+                    return
+
+            except Exception as e:
+                cache = None
+
+        try:
+            self.version = self.__lookup__()
+
+        except Exception as e:
+
+            #
+            # Without a version the caches just can't tell a reload
+            #
+
+            self.version = ''
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'dataVersion exception: {str(e):s}')
+
+        if cache is not None:
+            cache.put(key, self.version)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'dataVersion {self.dbtable:s}: {self.version:s}')
+
+        #
+        # } end of init
+        #
+
+
+    def __lookup__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        if(self.mode == 'mtime'):
+
+            #
+            # SQLite: the database file, and the write-ahead log which
+            # takes the writes first in WAL mode
+            #
+
+            if(self.dbms != 'sqlite3'):
+                raise Exception('mtime data version needs sqlite3')
+
+            db = self.connectInfo['db']
+
+            if self.dbtable.startswith('tap_schema.'):
+                db = self.connectInfo['tap_schema']
+
+            version = str(os.stat(db).st_mtime_ns)
+
+            if os.path.exists(db + '-wal'):
+                version = version + '.' + str(os.stat(db + '-wal').st_mtime_ns)
+
+            return(version)
+
+        bindvars = {}
+
+        if(self.mode == 'sql'):
+
+            sql = self.sql.replace('{table}', self.dbtable)
+
+        elif(self.mode == 'tap_schema'):
+
+            sql = 'select ' + self.column + \
+                ' from TAP_SCHEMA.tables where lower(table_name) = :tbl'
+
+            bindvars = {'tbl': self.dbtable}
+
+        else:
+            raise Exception('Invalid data version mode [' + self.mode + ']')
+
+        conn = self.__connect__()
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, bindvars)
+
+            row = cursor.fetchone()
+
+        finally:
+            conn.close()
+
+        if((row is None) or (row[0] is None)):
+            return('')
+
+        return(str(row[0]))
+
+        #
+        # } end of lookup def
+        #
+
+
+    def __connect__(self, **kwargs):
+
+        if(self.dbms == 'oracle'):
+
+            import cx_Oracle
+
+            conn = cx_Oracle.connect(self.connectInfo['userid'],
+                                     self.connectInfo['password'],
+                                     self.connectInfo['dbserver'])
+        else:
+            import sqlite3
+
+            conn = sqlite3.connect(self.connectInfo['db'])
+
+            conn.execute('ATTACH DATABASE ? AS TAP_SCHEMA',
+                         (self.connectInfo['tap_schema'],))
+
+        return(conn)
+
+
+def main():
+
+    #
+    # Show the data version of a table, e.g. to check the configuration:
+    #
+    #     python -m TAP.dataversion ps
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Print the data version of a table.')
+
+    parser.add_argument('table', help='table name')
+    parser.add_argument('--config', default=os.getenv('TAP_CONF', ''),
+                        help='TAP config file (default: $TAP_CONF)')
+
+    args = parser.parse_args()
+
+    config = configParam(args.config)
+
+    dv = dataVersion(config.connectInfo, args.table,
+                     mode=config.dataversion,
+                     sql=config.dataversion_sql,
+                     column=config.dataversion_col,
+                     interval=0)
+
+    print(f'{args.table:s}: [{dv.version:s}]')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+
+
+class fileCache:
+
+    """
+    fileCache keeps small (JSON serializable) values with a time-to-live
+    in files under a cache directory.  The TAP service runs one process
+    per request, so the files are what makes the cache shared between
+    requests; values already read are also kept in the process.
+
+    Required input:
+
+        cachedir:  cache directory (created if needed)
+
+        name:      cache name; each cache is a sub-directory of cachedir
+
+    Optional input:
+
+        ttl:       time-to-live in seconds (default 600)
+
+    Usage:
+
+        cache = fileCache(cachedir, 'access', ttl=600)
+
+        value = cache.get(key)         (None if missing or expired)
+
+        cache.put(key, value)
+
+        cache.invalidate(key)          (all keys if key is None)
+    """
+
+    debug = 0
+
+    cachedir = ''
+    name = ''
+    ttl = 600
+
+    def __init__(self, cachedir, name, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('ttl' in kwargs):
+            self.ttl = kwargs['ttl']
+
+        self.name = name
+        self.cachedir = cachedir + '/' + name
+
+        self.memo = {}
+
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+
+        except Exception as e:
+
+            self.msg = f'Failed to create cache directory [{self.cachedir:s}]'
+            raise Exception(self.msg)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'fileCache: cachedir= {self.cachedir:s} '
+                          f'ttl= {self.ttl:d}')
+
+        #
+        # } end of init
+        #
+
+
+    def get(self, key, **kwargs):
+
+        #
+        # {
+        #
+
+        now = time.time()
+
+        if(key in self.memo):
+
+            expires, value = self.memo[key]
+
+            if(expires > now):
+                return(value)
+
+            del self.memo[key]
+
+        path = self.__path__(key)
+
+        try:
+            with open(path, 'r') as fp:
+                data = json.load(fp)
+
+        except Exception as e:
+            return(None)
+
+        if((data.get('key') != key) or (data.get('expires', 0) <= now)):
+            return(None)
+
+        self.memo[key] = (data['expires'], data['value'])
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'fileCache {self.name:s}: hit {path:s}')
+
+        return(data['value'])
+
+        #
+        # } end of get def
+        #
+
+
+    def put(self, key, value, **kwargs):
+
+        #
+        # {
+        #
+
+        # The file is written to a temporary name and renamed, so that a
+        # concurrent reader sees either the old or the new value
+        #
+
+        ttl = self.ttl
+        if('ttl' in kwargs):
+            ttl = kwargs['ttl']
+
+        expires = time.time() + ttl
+
+        self.memo[key] = (expires, value)
+
+        path = self.__path__(key)
+
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir, prefix='.tmp')
+
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'key': key, 'expires': expires, 'value': value},
+                          fp)
+
+            os.chmod(tmppath, 0o664)
+            os.replace(tmppath, path)
+
+        except Exception as e:
+
+            #
+            # A cache that cannot be written only costs the lookup
+            #
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'fileCache put exception: {str(e):s}')
+
+        return
+
+        #
+        # } end of put def
+        #
+
+
+    def invalidate(self, key=None, **kwargs):
+
+        #
+        # {
+        #
+
+        if key is None:
+
+            self.memo = {}
+
+            for fname in os.listdir(self.cachedir):
+
+                if fname.endswith('.json'):
+
+                    try:
+                        os.remove(self.cachedir + '/' + fname)
+                    except Exception as e:
+                        pass
+            return
+
+        if(key in self.memo):
+            del self.memo[key]
+
+        try:
+            os.remove(self.__path__(key))
+        except Exception as e:
+            pass
+
+        return
+
+        #
+        # } end of invalidate def
+        #
+
+
+    def __path__(self, key, **kwargs):
+
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+        return(self.cachedir + '/' + digest + '.json')
+
+
+def main():
+
+    #
+    # Command line invalidation, e.g. after changing a user's grants:
+    #
+    #     python -m TAP.filecache /work/TAP/cache access koa|jsmith
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Invalidate entries of a TAP file cache.')
+
+    parser.add_argument('cachedir', help='cache directory (TAP_CACHEDIR)')
+    parser.add_argument('name', help='cache name (e.g. access)')
+    parser.add_argument('key', nargs='?', default=None,
+                        help='key to invalidate (default: all keys)')
+
+    args = parser.parse_args()
+
+    cache = fileCache(args.cachedir, args.name)
+    cache.invalidate(args.key)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
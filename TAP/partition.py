@@ -0,0 +1,716 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import re
+import heapq
+import pickle
+import shutil
+import logging
+import pathlib
+import sqlite3
+import tempfile
+import itertools
+import multiprocessing
+
+import sqlparse
+
+from sqlparse.sql import Function, Identifier
+from sqlparse.tokens import Keyword, DML, Name, Comment
+
+from TAP.tablenames import TableNames
+
+
+def scan_partition(task):
+
+    # Run the query on one index range of the table (process pool
+    # worker): a temporary view with the table's name hides the table
+    # from the query, and is flattened into it by SQLite, so the index
+    # range is one more constraint on the table's index.  The rows are
+    # written to a spill file, in batches.  The task stops early once
+    # its spill directory is gone (the cursor was closed), so that the
+    # shared pool is free for the next query.
+    #
+
+    spilldir = os.path.dirname(task['path'])
+
+    if not os.path.isdir(spilldir):
+        return(task['path'], 0)
+
+    conn = sqlite3.connect(pathlib.Path(task['db']).resolve().as_uri() +
+                           '?mode=ro', uri=True)
+
+    try:
+        conn.execute('ATTACH DATABASE ? AS TAP_SCHEMA',
+                     (pathlib.Path(task['tap_schema']).resolve().as_uri() +
+                      '?mode=ro',))
+
+        conn.execute('create temp view ' + task['dbtable'] +
+                     ' as select * from main.' + task['dbtable'] +
+                     ' where ' + task['range'])
+
+        cursor = conn.cursor()
+        cursor.execute(task['sql'])
+
+        nrow = 0
+
+        with open(task['path'], 'wb') as fp:
+
+            while True:
+
+                rows = cursor.fetchmany(task['arraysize'])
+                if not rows:
+                    break
+
+                if not os.path.isdir(spilldir):
+                    break
+
+                pickle.dump(rows, fp, pickle.HIGHEST_PROTOCOL)
+
+                nrow = nrow + len(rows)
+
+    finally:
+        conn.close()
+
+    return(task['path'], nrow)
+
+
+def read_partition(path):
+
+    with open(path, 'rb') as fp:
+
+        while True:
+
+            try:
+                rows = pickle.load(fp)
+
+            except EOFError:
+                break
+
+            yield from rows
+
+
+def sort_value(value):
+
+    # SQLite order of values of different types: NULL, numbers, text,
+    # blobs (text in BINARY collation, i.e. code point order)
+    #
+
+    if value is None:
+        return((0, 0))
+
+    if isinstance(value, (int, float)):
+        return((1, value))
+
+    if isinstance(value, str):
+        return((2, value))
+
+    return((3, bytes(value)))
+
+
+class descending:
+
+    # Sort key of a DESC column: reverses the comparison
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return(self.value == other.value)
+
+    def __lt__(self, other):
+        return(other.value < self.value)
+
+
+class partitionCursor:
+
+    """
+    partitionCursor runs a SQLite query in parallel: the query's table
+    is split into disjoint ranges of its (indexed) spatial index column,
+    each range runs on its own read-only connection in a process pool,
+    and the rows are merged into one stream read like a cursor (by
+    writeResult): in completion order, or, for a query with ORDER BY,
+    merged in the query's order.
+
+    Only large scans whose rows map one to one to the table's rows
+    qualify: one SELECT reading the table once, without aggregates,
+    DISTINCT, GROUP BY, LIMIT or set operations, ordered (if at all) by
+    result columns, that SQLite plans as a full scan of the table (not a
+    search on one of its indexes) of at least minrows rows.  Otherwise
+    the constructor raises an Exception and the query is run as usual.
+
+    The process pool is kept for the rest of the process and shared by
+    the queries (it is started again if nproc changes).
+
+    Required input:
+
+        conn:        the query's SQLite connection (for the column
+                     descriptions and the index bounds)
+
+        connectInfo: DBMS connection info (db and tap_schema paths)
+
+        sql:         query
+
+        dbtable:     table to split
+
+        colname:     spatial index column of dbtable
+
+    Optional input:
+
+        nproc:       number of processes (default 4)
+
+        npart:       number of index ranges (default 4*nproc)
+
+        minrows:     smallest table (rows, as estimated by its largest
+                     rowid) worth splitting (default 1000000)
+
+        workdir:     directory for the spill files (default: system
+                     temporary directory)
+
+        arraysize:   rows per fetch (default 10000)
+
+    Usage:
+
+        cursor = partitionCursor(conn, connectInfo, sql, 'ps', 'htm20',
+                                 nproc=32, workdir=userworkdir)
+
+        wresult = writeResult(cursor, ...)
+
+        cursor.close()
+    """
+
+    debug = 0
+
+    nproc = 4
+    npart = 0
+    minrows = 1000000
+    workdir = None
+    arraysize = 10000
+
+    #
+    # Process pool shared by the queries of the process
+    #
+
+    sharedpool = None
+    sharedsize = 0
+
+    description = None
+    connection = None
+
+    ntask = 0
+    ntable = 0
+
+    rowkeys = ['GROUP BY', 'HAVING', 'LIMIT', 'FETCH', 'OFFSET', 'DISTINCT',
+               'UNION', 'INTERSECT', 'EXCEPT', 'WITH', 'OVER', 'WINDOW']
+
+    aggfuncs = ['count', 'sum', 'avg', 'min', 'max', 'total',
+                'group_concat']
+
+    def __init__(self, conn, connectInfo, sql, dbtable, colname, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('nproc' in kwargs):
+            self.nproc = kwargs['nproc']
+
+        if('npart' in kwargs):
+            self.npart = kwargs['npart']
+
+        if('minrows' in kwargs):
+            self.minrows = kwargs['minrows']
+
+        if('workdir' in kwargs):
+            self.workdir = kwargs['workdir']
+
+        if('arraysize' in kwargs):
+            self.arraysize = kwargs['arraysize']
+
+        if(self.npart <= 0):
+            self.npart = 4*self.nproc
+
+        self.connection = conn
+        self.connectInfo = connectInfo
+
+        self.sql = sql.strip().rstrip(';')
+        self.dbtable = dbtable.lower()
+        self.colname = colname
+
+        self.pool = None
+        self.spilldir = None
+
+        #
+        # Large scans only: a query SQLite answers with searches on
+        # indexes runs faster on one connection than the pool can start.
+        # The plan (cheap) rules out most of them before the query is
+        # parsed.
+        #
+
+        cursor = conn.cursor()
+
+        cursor.execute('explain query plan ' + self.sql)
+
+        self.plan = [str(row[-1]).split() for row in cursor.fetchall()]
+
+        if not any([(len(words) > 0) and (words[0] == 'SCAN')
+                    for words in self.plan]):
+            raise Exception('no table scan in the plan')
+
+        #
+        # Query shape, then the index and its bounds
+        #
+
+        orderby = self.__checkQuery__()
+
+        if(re.fullmatch(r'[a-z_][a-z0-9_$]*', self.dbtable) is None):
+            raise Exception('not a plain table name [' + self.dbtable + ']')
+
+        if(re.fullmatch(r'[A-Za-z_][A-Za-z0-9_$]*', self.colname) is None):
+            raise Exception('not a plain column name [' + self.colname + ']')
+
+        self.__checkPlan__()
+
+        cursor.execute('select max(rowid) from main.' + self.dbtable)
+
+        (nrow,) = cursor.fetchone()
+
+        if((nrow is None) or (nrow < self.minrows)):
+            raise Exception('table [' + self.dbtable + '] has fewer than ' +
+                            str(self.minrows) + ' rows')
+
+        indexed = False
+
+        for (index,) in cursor.execute(
+                'select name from main.pragma_index_list(?)',
+                (self.dbtable,)).fetchall():
+
+            info = cursor.execute('select name from main.pragma_index_info(?)'
+                                  ' order by seqno', (index,)).fetchall()
+
+            if((len(info) > 0) and (str(info[0][0]).lower() ==
+                                    self.colname.lower())):
+                indexed = True
+                break
+
+        if not indexed:
+            raise Exception('no index on [' + self.dbtable + '.' +
+                            self.colname + ']')
+
+        cursor.execute('select min(' + self.colname + '), max(' +
+                       self.colname + ') from main.' + self.dbtable)
+
+        (imin, imax) = cursor.fetchone()
+
+        if(not isinstance(imin, int) or not isinstance(imax, int)):
+            raise Exception('no integer index values')
+
+        #
+        # Result columns: the query on an empty view of the table
+        #
+
+        try:
+            cursor.execute('create temp view ' + self.dbtable +
+                           ' as select * from main.' + self.dbtable +
+                           ' where 0')
+
+            cursor.execute(self.sql)
+            cursor.fetchall()
+
+            self.description = cursor.description
+
+        finally:
+            cursor.execute('drop view if exists temp.' + self.dbtable)
+
+        self.sortkey = None
+
+        if orderby is not None:
+            self.sortkey = self.__sortKey__(orderby)
+
+        #
+        # Index ranges: equal widths (the pool balances the load), and
+        # the rows without index value
+        #
+
+        ranges = []
+
+        span = imax - imin + 1
+
+        for i in range(self.npart):
+
+            lo = imin + (span*i)//self.npart
+            hi = imin + (span*(i+1))//self.npart - 1
+
+            if(lo <= hi):
+                ranges.append(f'{self.colname:s} between {lo:d} and {hi:d}')
+
+        ranges.append(f'{self.colname:s} is null')
+
+        self.spilldir = tempfile.mkdtemp(dir=self.workdir, prefix='.part')
+
+        tasks = []
+
+        for i in range(len(ranges)):
+
+            tasks.append({'db': self.connectInfo['db'],
+                          'tap_schema': self.connectInfo['tap_schema'],
+                          'dbtable': self.dbtable,
+                          'range': ranges[i],
+                          'sql': self.sql,
+                          'arraysize': self.arraysize,
+                          'path': self.spilldir + '/' + str(i)})
+
+        self.ntask = len(tasks)
+
+        self.pool = self.__sharedPool__()
+
+        if self.sortkey is None:
+            self.rows = self.__unordered__(tasks)
+        else:
+            self.rows = self.__ordered__(tasks)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'partitionCursor: {self.dbtable:s}.'
+                          f'{self.colname:s} [{imin:d}, {imax:d}] in '
+                          f'{len(tasks):d} ranges, {self.nproc:d} '
+                          f'processes, ordered: {orderby is not None}')
+
+        #
+        # } end of init
+        #
+
+
+    def fetchmany(self, size=None):
+
+        if size is None:
+            size = self.arraysize
+
+        try:
+            return(list(itertools.islice(self.rows, size)))
+
+        except Exception as e:
+
+            self.close()
+            self.__resetPool__()
+
+            self.msg = 'Partitioned query failed: ' + str(e)
+            raise Exception(self.msg)
+
+
+    def fetchall(self):
+
+        return(list(self.rows))
+
+
+    def close(self):
+
+        # The spill files are dropped, which also stops the tasks still
+        # running (the writer may stop before the last row); the pool is
+        # kept for the next query
+        #
+
+        self.pool = None
+
+        if self.spilldir is not None:
+
+            shutil.rmtree(self.spilldir, ignore_errors=True)
+            self.spilldir = None
+
+
+    def __sharedPool__(self, **kwargs):
+
+        cls = type(self)
+
+        if((cls.sharedpool is not None) and (cls.sharedsize != self.nproc)):
+
+            cls.sharedpool.terminate()
+            cls.sharedpool.join()
+            cls.sharedpool = None
+
+        if cls.sharedpool is None:
+
+            cls.sharedpool = multiprocessing.Pool(self.nproc)
+            cls.sharedsize = self.nproc
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'partitionCursor: started {self.nproc:d} '
+                              f'processes')
+
+        return(cls.sharedpool)
+
+
+    def __resetPool__(self, **kwargs):
+
+        # After a failure the pool may have lost workers: the next query
+        # starts a new one
+        #
+
+        cls = type(self)
+
+        if cls.sharedpool is not None:
+
+            cls.sharedpool.terminate()
+            cls.sharedpool.join()
+            cls.sharedpool = None
+
+
+    def __unordered__(self, tasks, **kwargs):
+
+        nrow = 0
+
+        for (path, n) in self.pool.imap_unordered(scan_partition, tasks):
+
+            yield from read_partition(path)
+
+            os.remove(path)
+
+            nrow = nrow + n
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'partitionCursor: {nrow:d} rows')
+
+
+    def __ordered__(self, tasks, **kwargs):
+
+        # Each range comes sorted from SQLite; the sorted spill files are
+        # merged once all the ranges are done
+        #
+
+        results = self.pool.map(scan_partition, tasks)
+
+        yield from heapq.merge(*[read_partition(path)
+                                 for (path, n) in results],
+                               key=self.sortkey)
+
+
+    def __checkQuery__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # Raises an Exception if the query's rows do not map one to one to
+        # dbtable rows; returns the ORDER BY text (None if not ordered)
+        #
+
+        statements = sqlparse.parse(self.sql)
+
+        if(len(statements) != 1):
+            raise Exception('more than one statement')
+
+        self.statement = statements[0]
+
+        nselect = 0
+        orderby = None
+
+        head = ''
+
+        for token in statements[0].flatten():
+
+            if(token.ttype in Comment):
+                continue
+
+            if(token.ttype in DML):
+
+                if(token.normalized.upper() != 'SELECT'):
+                    raise Exception('not a SELECT')
+
+                nselect = nselect + 1
+
+            if((token.ttype in Keyword) and
+                    (token.normalized.upper() in self.rowkeys)):
+                raise Exception(token.normalized.upper() + ' query')
+
+            #
+            # Outer joins would repeat the other table's unmatched rows in
+            # every range
+            #
+
+            if((token.ttype in Keyword) and
+                    (token.normalized.upper().split()[0] in
+                     ['LEFT', 'RIGHT', 'FULL', 'OUTER', 'NATURAL'])):
+                raise Exception('outer join query')
+
+            if((token.ttype in Keyword) and
+                    (token.normalized.upper() == 'ORDER BY')):
+                orderby = ''
+                continue
+
+            if((token.ttype is Name) and
+                    (token.value.lower() in self.aggfuncs) and
+                    (token.parent is not None) and
+                    isinstance(token.parent.parent, Function)):
+                raise Exception('aggregate query')
+
+            if orderby is None:
+                head = head + token.value
+            else:
+                orderby = orderby + token.value
+
+        if(nselect != 1):
+            raise Exception('subqueries')
+
+        #
+        # (TableNames reads the ORDER BY items as tables too)
+        #
+
+        tables = TableNames().extract_tables(head)
+
+        if(tables.count(self.dbtable) != 1):
+            raise Exception('table [' + self.dbtable + '] read ' +
+                            str(tables.count(self.dbtable)) + ' times')
+
+        self.ntable = len(tables)
+
+        return(orderby)
+
+        #
+        # } end of checkQuery def
+        #
+
+
+    def __checkPlan__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # Raises an Exception unless SQLite plans a scan of dbtable (by
+        # its name or alias in the plan): a search on one of its indexes
+        # (e.g. a selective where clause or a cone search) is left to
+        # one connection
+        #
+
+        names = [self.dbtable]
+
+        for identifier in self.__identifiers__(self.statement):
+
+            name = identifier.get_real_name()
+
+            if((name is not None) and (name.lower() == self.dbtable)
+                    and (identifier.get_alias() is not None)):
+                names.append(identifier.get_alias().lower())
+
+        scanned = False
+
+        for words in self.plan:
+
+            #
+            # 'SCAN s', 'SEARCH s USING INDEX ...' (older versions:
+            # 'SCAN TABLE src AS s')
+            #
+
+            if((len(words) < 2) or (words[0] not in ['SCAN', 'SEARCH'])):
+                continue
+
+            name = words[1]
+
+            if('AS' in words[:-1]):
+                name = words[words.index('AS') + 1]
+            elif((name == 'TABLE') and (len(words) > 2)):
+                name = words[2]
+
+            if(name.lower() not in names):
+                continue
+
+            if(words[0] == 'SEARCH'):
+                raise Exception('index search: ' + ' '.join(words))
+
+            scanned = True
+
+        if not scanned:
+            raise Exception('no scan of [' + self.dbtable + '] in the plan')
+
+        return
+
+        #
+        # } end of checkPlan def
+        #
+
+
+    def __identifiers__(self, token, **kwargs):
+
+        for item in token.get_sublists():
+
+            if isinstance(item, Identifier):
+                yield item
+
+            yield from self.__identifiers__(item)
+
+
+    def __sortKey__(self, orderby, **kwargs):
+
+        #
+        # {
+        #
+
+        # Merge key of the rows: the ORDER BY items have to be result
+        # columns (by name or position)
+        #
+
+        names = [str(col[0]).lower() for col in self.description]
+
+        keys = []
+
+        for item in orderby.split(','):
+
+            words = item.split()
+
+            desc = False
+
+            if((len(words) == 2) and (words[1].upper() in ['ASC', 'DESC'])):
+                desc = (words[1].upper() == 'DESC')
+                words = words[:1]
+
+            if(len(words) != 1):
+                raise Exception('ORDER BY item [' + item.strip() + ']')
+
+            expr = words[0]
+
+            if expr.isdigit():
+
+                index = int(expr) - 1
+
+                if((index < 0) or (index >= len(names))):
+                    raise Exception('ORDER BY position [' + expr + ']')
+
+            else:
+
+                #
+                # A qualified name is only known to be the result column
+                # of that name when there is one table
+                #
+
+                if((expr.find('.') != -1) and (self.ntable != 1)):
+                    raise Exception('ORDER BY item [' + expr + '] of a join')
+
+                name = expr.split('.')[-1].lower()
+
+                if(re.fullmatch(r'[a-z_][a-z0-9_$]*', name) is None or
+                   (names.count(name) != 1)):
+                    raise Exception('ORDER BY item [' + expr + '] is not '
+                                    'a result column')
+
+                index = names.index(name)
+
+            keys.append((index, desc))
+
+        def sortkey(row):
+
+            return(tuple([descending(sort_value(row[index])) if desc
+                          else sort_value(row[index])
+                          for (index, desc) in keys]))
+
+        return(sortkey)
+
+        #
+        # } end of sortKey def
+        #
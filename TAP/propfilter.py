@@ -5,12 +5,27 @@
 
 import os
 import logging
+import hashlib
 
 import datetime
 
+import sqlparse
+
+from sqlparse.sql import IdentifierList, Identifier, Where, Parenthesis
+from sqlparse.sql import Function
+from sqlparse.tokens import Keyword, DML, Punctuation, Name, Wildcard
+from sqlparse.tokens import Comment
+
 from TAP.writeresult import writeResult
 from TAP.datadictionary import dataDictionary
 from TAP.tablenames import TableNames
+from TAP.upload import upload_table
+from TAP.filecache import fileCache
+from TAP.tablemap import tableMap
+from TAP.releasedate import add_months
+from TAP.rowfilter import rowFilter
+from TAP.resultcache import resultCache, result_key, access_scope
+from TAP.resultcache import next_midnight
 
 
 class propFilter:
@@ -38,10 +53,35 @@ class propFilter:
     dbtable = ''
     instrument = ''
     datalevel = ''
+    datecol = ''
+    propcol = ''
+    filtermode = 'sql'
+
+    tablemap = {}
 
     nfetch = 1000
     ninsert = 1000
 
+    nbindmax = 1000
+    nbindsqlite = 999
+    accesstmp = ''
+
+    cachedir = ''
+    access_ttl = 600
+    session_ttl = 300
+
+    fileidtbl = 0
+
+    public_cache = 0
+    result_cache = 0
+    result_ttl = 3600
+    single_flight = 0
+    dataversion = ''
+
+    upload = None
+
+    releasecol = ''
+
     racol = ''
     deccol = ''
 
@@ -62,14 +102,21 @@ class propFilter:
     query_in = ''
     query = ''
 
-    selectstr = ''
-    wherestr = ''
-    orderbystr = ''
-    groupbystr = ''
+    accessids = None
+
+    fromwhere = ''
+    ninject = 0
+
+    setkeys = ['UNION', 'UNION ALL', 'INTERSECT', 'EXCEPT', 'MINUS']
+
+    rowkeys = ['GROUP BY', 'HAVING', 'LIMIT', 'FETCH', 'OFFSET', 'DISTINCT',
+               'UNIQUE', 'TOP', 'ROWNUM']
 
-    selectcols = []
-    orderbycols = []
-    groupbycols = []
+    aggfuncs = ['count', 'sum', 'avg', 'min', 'max', 'stddev', 'variance',
+                'median', 'listagg']
+
+    endkeys = ['GROUP BY', 'ORDER BY', 'HAVING', 'LIMIT', 'FETCH', 'OFFSET',
+               'WINDOW']
 
     time0 = None
     time1 = None
@@ -117,6 +164,50 @@ class propFilter:
 
             maxrec(int):      default -1 meaning return all records,
 
+            cachedir(char):   cache directory shared by the service
+                               processes (default: no caching),
+
+            access_ttl(int):  seconds a user's access IDs stay cached
+                               (default 600, 0: no caching),
+
+            session_ttl(int): seconds a validated cookie stays cached
+                               (default 300, 0: no caching),
+
+            fileidtbl(0/1):   diagnostic: also write the allowed fileids
+                               to tmp_fileidallowed<pid>.tbl in workdir
+                               (default 0),
+
+            releasecol(char): precomputed release date column (maintained
+                               by TAP.releasedate) replacing the
+                               add_months() test (default: none),
+
+            tablemap(dict):   table name -> instrument, datalevel, fileid,
+                               datecol, propcol overrides (config
+                               [tablemap] section, see TAP.tablemap),
+
+            public_cache(0/1): share the results of users without grants
+                               through cachedir until the next midnight
+                               (default 0),
+
+            result_cache(int): byte budget of the result cache shared
+                               through cachedir (default 0: results are
+                               not cached, except with public_cache),
+
+            result_ttl(int):  seconds a cached result is used (default
+                               3600),
+
+            single_flight(int): without result cache, seconds the result
+                               of a query is shared with the identical
+                               requests that waited for it (default 0:
+                               off),
+
+            dataversion(char): data version of dbtable (see
+                               TAP.dataversion), part of the result cache
+                               key,
+
+            upload:           uploaded tables (TAP.upload.tapUpload),
+                              loaded into the session as TAP_UPLOAD,
+
             racol(char):      RA column name,
 
             deccol(char):     Dec column name,
@@ -159,6 +250,66 @@ class propFilter:
         if self.arraysize < 1:
             self.arraysize = 10000
 
+        self.nworker = 1
+        if('nworker' in kwargs):
+            self.nworker = kwargs['nworker']
+
+        self.prefetch = 0
+        if('prefetch' in kwargs):
+            self.prefetch = kwargs['prefetch']
+
+        self.arraysize_max = 4*self.arraysize
+        if('arraysize_max' in kwargs):
+            self.arraysize_max = kwargs['arraysize_max']
+
+        self.numwidth = 22
+        if('numwidth' in kwargs):
+            self.numwidth = kwargs['numwidth']
+
+        self.nsample = 100
+        if('nsample' in kwargs):
+            self.nsample = kwargs['nsample']
+
+        self.memory_budget = 0
+        if('memory_budget' in kwargs):
+            self.memory_budget = kwargs['memory_budget']
+
+        if('cachedir' in kwargs):
+            self.cachedir = kwargs['cachedir']
+
+        if('access_ttl' in kwargs):
+            self.access_ttl = kwargs['access_ttl']
+
+        if('session_ttl' in kwargs):
+            self.session_ttl = kwargs['session_ttl']
+
+        if('fileidtbl' in kwargs):
+            self.fileidtbl = kwargs['fileidtbl']
+
+        if('releasecol' in kwargs):
+            self.releasecol = kwargs['releasecol']
+
+        if('tablemap' in kwargs):
+            self.tablemap = kwargs['tablemap']
+
+        if('public_cache' in kwargs):
+            self.public_cache = kwargs['public_cache']
+
+        if('result_cache' in kwargs):
+            self.result_cache = kwargs['result_cache']
+
+        if('result_ttl' in kwargs):
+            self.result_ttl = kwargs['result_ttl']
+
+        if('single_flight' in kwargs):
+            self.single_flight = kwargs['single_flight']
+
+        if('dataversion' in kwargs):
+            self.dataversion = kwargs['dataversion']
+
+        if('upload' in kwargs):
+            self.upload = kwargs['upload']
+
 
         if('connectInfo' in kwargs):
 
@@ -292,7 +443,6 @@ class propFilter:
         if('fileid' in kwargs):
             self.fileid = kwargs['fileid']
 
-        self.fileid_allowed = self.fileid + '_allowed'
 
         self.racol = ''
         if('racol' in kwargs):
@@ -335,7 +485,6 @@ class propFilter:
             logging.debug(f'      usertbl = {self.usertbl:s}')
             logging.debug(f'      accesstbl = {self.accesstbl:s}')
             logging.debug(f'      fileid = {self.fileid:s}')
-            logging.debug(f'      fileid_allowed = {self.fileid_allowed:s}')
             logging.debug(f'      accessid = {self.accessid:s}')
             logging.debug(f'      propfilter = {self.propfilter:s}')
             logging.debug(f'      racol = {self.racol:s}')
@@ -359,7 +508,8 @@ class propFilter:
                 self.conn = cx_Oracle.connect(
                     self.userid,
                     self.password,
-                    self.dbserver)
+                    self.dbserver,
+                    threaded=True)
 
                 if self.debug:
                     logging.debug('')
@@ -376,12 +526,21 @@ class propFilter:
         elif(self.dbms.lower() == 'sqlite3'):
 
             try:
-                self.conn = sqlite3.connect(self.db)
+                self.conn = sqlite3.connect(self.db,
+                                            check_same_thread=False)
 
                 if self.debug:
                     logging.debug('')
                     logging.debug('Connected to SQLite3, database ' + self.db)
 
+                #
+                # The access constraint uses the Oracle add_months()
+                # (current_date is built into SQLite)
+                #
+
+                self.conn.create_function('add_months', 2, add_months,
+                                          deterministic=True)
+
                 cmd = 'ATTACH DATABASE ? AS TAP_SCHEMA'
 
                 dbspec = (self.tap_schema,)
@@ -415,6 +574,24 @@ class propFilter:
         # } end connect to dbms
         #
 
+        #
+        # Uploaded tables (TAP_UPLOAD) are loaded into this session
+        #
+
+        if self.upload is not None:
+
+            try:
+                self.upload.load(self.conn, self.dbms)
+
+                self.query = self.upload.rewrite(self.query, self.dbms)
+
+            except Exception as e:
+
+                self.status = 'error'
+                self.msg = 'Failed to load the uploaded tables: ' + str(e)
+
+                raise Exception(self.msg)
+
         #
         # Use Oracle function to check query syntax
         #
@@ -452,27 +629,70 @@ class propFilter:
 
         tn = TableNames()
         tables = tn.extract_tables(self.query)
+        tables = [tbl for tbl in tables if not upload_table(tbl)]
+
+        #
+        # Retrieve instrument and datalevel for propfilter.  Every
+        # proprietary table in the query gets the access constraint, not
+        # only dbtable: a join would otherwise return the rows of the
+        # other table(s) unfiltered.  Tables whose settings have no
+        # proprietary period column (and the TAP_SCHEMA tables) are
+        # public; dbtable is the first proprietary table.
+        #
+
+        tmap = tableMap(self.propfilter, self.fileid, tablemap=self.tablemap,
+                        debug=self.debug)
+
+        self.proptables = {}
+
+        for tbl in tables:
 
-        if len(tables) > 0:
+            name = tbl.replace('"', '').lower()
+
+            if name.startswith('tap_schema.'):
+                continue
+
+            tblentry = tmap.lookup(tbl)
+
+            if(len(tblentry['propcol']) > 0):
+
+                self.proptables[name] = tblentry
+
+                if(len(self.dbtable) == 0):
+                    self.dbtable = tbl
+
+        if((len(self.dbtable) == 0) and (len(tables) > 0)):
             self.dbtable = tables[0]
 
+        #
+        # dbtable is always filtered
+        #
+
+        entry = tmap.lookup(self.dbtable)
+
+        self.proptables[self.dbtable.replace('"', '').lower()] = entry
+
         if self.debug:
             logging.debug('')
             logging.debug(f'dbtable = [{self.dbtable:s}]')
+            logging.debug(f'proprietary tables: {str(list(self.proptables)):s}')
 
-        #
-        # Parse query: to extract query pieces for propfilter
-        #
-
-        self.__parseQuery__(self.query)
+        self.instrument = entry['instrument']
+        self.datalevel = entry['datalevel']
+        self.fileid = entry['fileid']
+        self.datecol = entry['datecol']
+        self.propcol = entry['propcol']
+        self.filtermode = entry['filtermode']
 
         if self.debug:
             logging.debug('')
-            logging.debug('Returned parseQuery:')
-            logging.debug(f'      orderbystr = {self.orderbystr:s}')
-            logging.debug(f'      groupbystr = {self.groupbystr:s}')
-            logging.debug(f'      wherestr = {self.wherestr:s}')
-            logging.debug(f'      selectstr = {self.selectstr:s}')
+            logging.debug('Returned tableMap lookup:')
+            logging.debug(f'      instrument = {self.instrument:s}')
+            logging.debug(f'      datalevel = {self.datalevel:s}')
+            logging.debug(f'      fileid = {self.fileid:s}')
+            logging.debug(f'      datecol = {self.datecol:s}')
+            logging.debug(f'      propcol = {self.propcol:s}')
+            logging.debug(f'      filtermode = {self.filtermode:s}')
 
         #
         # Validate user
@@ -521,57 +741,17 @@ class propFilter:
             raise Exception(self.msg)
 
         #
-        # Create tmp_accessiddbtbl
-        #
-
-        tmp_accessiddbtbl = 'tmp_' + self.accessid + str(os.getpid())
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'tmp_accessiddbtbl = {tmp_accessiddbtbl:s}')
-
-        if(len(self.userid) > 0):
-
-            #
-            # {
-            #
-
-            try:
-                self.__createTmpAccessiddb__(tmp_accessiddbtbl,
-                                             self.userid, self.accessid,
-                                             self.accesstbl)
-            except Exception as e:
-
-                self.msg = 'Failed to create tmp_accessiddbtbl: ' + str(e)
-
-                if self.debug:
-                    logging.debug('')
-                    logging.debug(f'{self.msg:s}')
-
-            if self.debug:
-                logging.debug('')
-                logging.debug('{tmp_accessiddbtbl created}')
-
-            #
-            # }   End create tmp_accessiddbtbl block: only used if userid exists
-            #
-
-        #
-        # Create tmp_fileidAlloweddbtbl
+        # Construct the final select statement: the access constraint is
+        # injected into the where clause of the query block(s) reading
+        # dbtable, so the DBMS plans a single query (the user's access
+        # IDs come in as bind values, no temporary tables are created)
         #
 
-        tmp_fileidAlloweddbtbl = 'tmp_fileidallowed' + str(os.getpid())
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'tmp_fileidAlloweddbtbl= {tmp_fileidAlloweddbtbl:s}')
+        self.bindvars = {}
 
         try:
+            sql = self.__injectConstraint__(self.query)
 
-            self.__createTmpFileiddb__(tmp_fileidAlloweddbtbl,
-                                       self.fileid, self.fileid_allowed,
-                                       self.dbtable, self.wherestr,
-                                       self.accessid, tmp_accessiddbtbl)
         except Exception as e:
 
             self.msg = str(e)
@@ -582,143 +762,93 @@ class propFilter:
 
             raise Exception(self.msg)
 
-        #
-        # Construct the final select statement for table join
-        #
-
-        sql = self.selectstr + " from " + self.dbtable + \
-            " where " + self.fileid + " in(select " + self.fileid_allowed + \
-            " from " + tmp_fileidAlloweddbtbl + ")"
-
         if self.debug:
             logging.debug('')
-            logging.debug(
-                f'select(before adding groupby and orderby: sql= {sql:s}')
-            logging.debug(f'groupbystr = {self.groupbystr:s}')
-            logging.debug(f'orderbystr = {self.orderbystr:s}')
+            logging.debug(f'filtered sql = {sql:s}')
 
         #
-        # Add group by clause
+        # Diagnostic mode: write the allowed fileids to the user workdir
+        # (this costs an extra query and nothing reads the file back)
         #
 
-        if(len(self.groupbystr) > 0):
+        if self.fileidtbl:
 
-            groupbystr = 'group by '
-            len_groupbycols = len(self.groupbycols)
+            fileidpath = self.userworkdir + '/tmp_fileidallowed' + \
+                str(os.getpid()) + '.tbl'
 
-            for i in range(0, len_groupbycols):
+            try:
+                self.__writeFileidAllowed__(fileidpath, self.fileidcol,
+                                            self.fromwhere)
+            except Exception as e:
 
-                if(i == len_groupbycols-1):
-                    groupbystr = groupbystr + self.groupbycols[i]
-                else:
-                    groupbystr = groupbystr + self.groupbycols[i] + ', '
+                self.msg = str(e)
 
-            sql = sql + " " + groupbystr
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'{self.msg:s}')
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'groupby added: sql = {sql:s}')
+                raise Exception(self.msg)
 
         #
-        # Add order by clause
+        # Writer filter mode (for users with long grant lists): the query
+        # runs without the access constraint and returns the public flag
+        # and access ID as two extra columns, checked against the set of
+        # granted IDs in writeResult.  Queries whose rows do not map one
+        # to one to dbtable rows (aggregates, distinct, row limits, more
+        # than one reference to dbtable) keep the SQL constraint.
         #
 
-        if(len(self.orderbystr) > 0):
-
-            orderbystr = 'order by '
-            len_orderbycols = len(self.orderbycols)
-
-            for i in range(0, len_orderbycols):
-
-                if(i == len_orderbycols-1):
-                    orderbystr = orderbystr + self.orderbycols[i]
-                else:
-                    orderbystr = orderbystr + self.orderbycols[i] + ', '
-
-            sql = sql + " " + orderbystr
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'orderby added: sql = {sql:s}')
-
-        cursor = self.conn.cursor()
-
-        try:
-            if self.debug:
-                self.__executeSql__(cursor, sql, debug=1)
-            else:
-                self.__executeSql__(cursor, sql)
+        rowfilter = None
 
-        except Exception as e:
+        if((self.filtermode == 'writer') and (len(self.accessids) > 0)):
 
-            self.msg = 'Failed to execute [' + sql + ']: ' + str(e)
+            writersql = self.__writerQuery__()
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
+            if writersql is not None:
 
-            raise Exception(self.msg)
+                sql = writersql
+                self.bindvars = {}
 
-        ncol = len(cursor.description)
-        exclcol = ncol - 1
+                rowfilter = rowFilter(self.accessids, debug=self.debug)
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'ncol = {ncol:d} exclcol= {exclcol:d}')
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'writer filter sql = {sql:s}')
 
         #
-        # Call writeResult
+        # Results are shared through the result cache in cachedir, keyed
+        # by the filtered query and the access scope (the user's access
+        # IDs).  Public-only results (users without grants) depend on the
+        # query alone: with public_cache they are cached until the next
+        # release boundary (local midnight); with result_cache all the
+        # results are, for result_ttl seconds (and no later than that).
         #
 
-        if self.debug:
-            logging.debug('')
-            logging.debug('call writeResultfile')
-
-        try:
-            wresult = writeResult(cursor,
-                                  self.userworkdir,
-                                  self.dd,
-                                  format=self.format,
-                                  maxrec=self.maxrec,
-                                  coldesc=self.coldesc,
-                                  racol=self.racol,
-                                  deccol=self.deccol,
-                                  debug=self.debug)
-
-        except Exception as e:
-
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'writeResult exception: {str(e):s}')
-
-            raise Exception(str(e))
-
-        self.outpath = wresult.outpath
-        self.ntot = wresult.ntot
+        cacheable = (len(self.cachedir) > 0) and \
+            (self.format in writeResult.resulttbls)
 
-        #
-        #  Drop all tmp DB tables
+        # Without caching, single_flight still has concurrent identical
+        # requests wait for the first one and share its result, kept for
+        # single_flight seconds in the 'flight' cache
         #
 
-        try:
-            self.__dropDbtbl__(tmp_fileidAlloweddbtbl)
-        except Exception as e:
-            pass
+        ttl = 0
+        cachename = 'results'
 
-        if self.debug:
-            logging.debug('')
-            logging.debug('tmp_fileidAlloweddbtbl dropped')
+        if(self.result_cache > 0):
+            ttl = min(self.result_ttl, next_midnight())
 
-        if(len(self.userid) > 0):
+        elif(self.public_cache and (len(self.accessids) == 0)):
+            ttl = next_midnight()
 
-            try:
-                self.__dropDbtbl__(tmp_accessiddbtbl)
-            except Exception as e:
-                pass
+        elif(self.single_flight > 0):
+            ttl = min(self.single_flight, next_midnight())
+            cachename = 'flight'
 
-            if self.debug:
-                logging.debug('')
-                logging.debug('tmp_accessiddbtbl dropped')
+        if(cacheable and (ttl > 0)):
+            self.__sharedResult__(sql, rowfilter, ttl, cachename)
+        else:
+            self.__writeResult__(sql, rowfilter)
 
         return
 
@@ -727,380 +857,118 @@ class propFilter:
         #
 
 
-    def __parseQuery__(self, query, **kwargs):
+    def __validateUser__(self, cookiename, cookiestr, propfilter,
+                         usertbl, **kwargs):
 
-        # Assume that group by and order by cannot be in the same query
         #
         # {
+        #
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'Enter parseQuery: query = [{query:s}]')
-            logging.debug(f'                  dbtable = [{self.dbtable:s}]')
+        #
+        #  If cookiestr exists: validate userid/encodedpass
+        #
+
+        msg = ''
+        ind = cookiestr.find(cookiename)
 
-        instrume = ["hires",
-                    "nirspec",
-                    "nirc2",
-                    "lris",
-                    "deimos",
-                    "mosfire",
-                    "osiris",
-                    "lws",
-                    "esi",
-                    "nirc",
-                    "kcwi",
-                    "nires",
-                    "nirc2"]
+        substr = ''
+        if(ind != -1):
+            substr = cookiestr[ind:]
+        else:
+            msg = 'Failed to find cookiename: [{cookiename:s}] in cookiestr'
+            raise Exception(msg)
 
-        level = ["l0",
-                 "l1",
-                 "l2",
-                 "eng"]
+        #
+        # Separate cookiestr from cookiename
+        #
 
-        selectstr = ''
-        wherestr = ''
-        orderbystr = ''
-        groupbystr = ''
+        substr1 = ''
+        ind = substr.find('=')
+        if(ind != -1):
+            substr1 = substr[ind+1:]
 
         #
-        # Extract select list from query
+        # Empty cookie str is OK, treat it as anonymous user
         #
 
-        ind = query.lower().find(' from ')
+        if(len(substr1) == 0):
+            return
+
+        arr = substr1.split('|')
+        narr = len(arr)
 
-        substr = ''
-        if(ind != -1):
-            selectstr = query[0:ind]
+        self.userid = arr[0]
+        self.encodedpass = arr[1]
 
         if self.debug:
             logging.debug('')
-            logging.debug(f'selectstr = [{selectstr:s}]')
+            logging.debug(f'userid = {self.userid:s}')
+            logging.debug(f'encodedpass = {self.encodedpass:s}')
+
+        if(self.userid == 'anon'):
+            self.userid = ''
+            return
 
         #
-        # Retrieve instrument and datalevel from dbtable name:
-        # this only works for KOA and NEID because of their dbtable name
+        # A cookie validated within session_ttl seconds is accepted
+        # without going to the DB: the cache key is a hash of the
+        # credentials, so they are not written to disk
         #
 
-        if(self.propfilter.lower() == 'koa'):
-
-            #
-            # { Retrieve instrument
-            #
-
-            ninst = len(instrume)
+        cache = None
+        key = hashlib.sha256((usertbl.lower() + '|' + self.userid + '|' +
+                              self.encodedpass).encode('utf-8')).hexdigest()
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'ninst = {ninst:d}')
+        if((len(self.cachedir) > 0) and (self.session_ttl > 0)):
 
-            self.instrument = ''
-            for i in range(ninst):
+            try:
+                cache = fileCache(self.cachedir, 'session',
+                                  ttl=self.session_ttl, debug=self.debug)
 
-                dbtable_lower = self.dbtable.lower()
+                if(cache.get(key) == self.userid):
 
-                ind = dbtable_lower.find(instrume[i])
+                    if self.debug:
+                        logging.debug('')
+                        logging.debug('cached session: user validated')
 
-                if(ind != -1):
-                    self.instrument = instrume[i]
-                    break
+                    self.status = 'ok'
+                    return
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'instrument = {self.instrument:s}')
+            except Exception as e:
 
-            ninst = len(instrume)
+                cache = None
 
-            #
-            # } end retrieve instrument
-            #
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'session cache exception: {str(e):s}')
 
+        #
+        # Validate userid/encodedpass with the data in usertbl
+        #
 
-        if(self.propfilter.lower() == 'neid'):
+        cursor = self.conn.cursor()
 
-            #
-            # { Retrieve datalevel and modify fileid
-            #
+        sql = ''
+        if(propfilter == 'koa'):
 
-            nlevel = len(level)
+            sql = "select passwd from " + usertbl + \
+                " where userid = :userid"
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'nlevel = {nlevel:d}')
+        elif(propfilter == 'neid'):
+            sql = "select password from " + usertbl + \
+                " where userid = :userid"
 
-            self.datalevel = ''
-            for i in range(nlevel):
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'User lookup sql= {sql:s}')
 
-                dbtable_lower = self.dbtable.lower()
+        try:
+            self.__executeSql__(cursor, sql,
+                                bindvars={'userid': self.userid})
 
-                ind = dbtable_lower.find(level[i])
+        except Exception as e:
 
-                if(ind != -1):
-                    self.datalevel = level[i]
-                    break
-
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'datalevel = {self.datalevel:s}')
-
-            if(self.datalevel == 'l0' or self.datalevel == 'eng'):
-
-                self.fileid = 'l0' + self.fileid
-                self.fileid_allowed = 'l0' + self.fileid_allowed
-            else:
-                self.fileid = self.datalevel.lower() + self.fileid
-                self.fileid_allowed = self.datalevel.lower() + \
-                    self.fileid_allowed
-
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'fileid = {self.fileid:s}')
-                logging.debug(f'fileid_allowed = {self.fileid_allowed:s}')
-            #
-            # }
-            #
-
-        #
-        # Extract where constraint, order by, and group by clause
-        #
-
-        substr = ''
-        ind = query.lower().find('where')
-
-        if(ind != -1):
-            substr = query[ind:]
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'substr = [{substr:s}]')
-
-
-        if(len(substr) > 0):
-
-            #
-            # { where clause exists
-            #
-
-            ind1 = -1
-            ind2 = -1
-
-            ind1 = substr.lower().find('order by')
-            ind2 = substr.lower().find('group by')
-
-            if((ind1 >= 0) and (ind2 >= 0)):
-
-                if(ind1 < ind2):
-                    wherestr = substr[0:ind1]
-                    orderbystr = substr[ind1:ind2]
-                    groupbystr = substr[ind2:]
-                else:
-                    wherestr = substr[0:ind2]
-                    groupbystr = substr[ind2:ind1]
-                    orderbystr = substr[ind1:]
-
-            elif(ind1 >= 0):
-
-                wherestr = substr[0:ind1]
-                orderbystr = substr[ind1:]
-
-            elif(ind2 >= 0):
-
-                wherestr = substr[0:ind2]
-                groupbystr = substr[ind2:]
-
-            else:
-                wherestr = substr
-            #
-            # }
-            #
-
-        else:
-
-            #
-            # { where clause doesn't exists
-            #
-
-            ind1 = -1
-            ind2 = -1
-            ind1 = query.lower().find('order by')
-            ind2 = query.lower().find('group by')
-
-            ind = -1
-            if((ind1 >= 0) and (ind2 >= 0)):
-
-                if(ind1 < ind2):
-
-                    orderbystr = query[ind1:ind2]
-                    groupbystr = query[ind2:]
-
-                else:
-                    groupbystr = query[ind2:ind1]
-                    orderbystr = query[ind1:]
-
-            elif(ind1 >= 0):
-
-                orderbystr = query[ind1:]
-
-            elif(ind2 >= 0):
-
-                groupbystr = query[ind2:]
-
-            #
-            # } end where clause doesn't exist
-            #
-
-        self.selectstr = selectstr
-        self.wherestr = wherestr
-        self.orderbystr = orderbystr
-        self.groupbystr = groupbystr
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'self.selectstr = {self.selectstr:s}')
-            logging.debug(f'self.wherestr = {self.wherestr:s}')
-            logging.debug(f'self.orderby = {self.orderbystr:s}')
-            logging.debug(f'self.groupby = {self.groupbystr:s}')
-
-        #
-        # Retrieve groupbycols
-        #
-
-        ind = groupbystr.lower().find('by ')
-        str1 = groupbystr[ind+3:].strip()
-
-        while(len(str1) > 0):
-
-            ind = str1.find(',')
-            col = ''
-            if(ind != -1):
-                col = str1[0:ind].strip()
-                str1 = str1[ind+1:]
-            else:
-                col = str1.strip()
-                str1 = ''
-
-            self.groupbycols.append(col)
-
-            if(len(str1) == 0):
-                break
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'len(groupbycols) = {len(self.groupbycols):d}')
-            logging.debug(self.groupbycols)
-
-        #
-        # Retrieve orderbycols
-        #
-
-        ind = orderbystr.lower().find('by ')
-        str1 = orderbystr[ind+3:].strip()
-
-        while(len(str1) > 0):
-
-            ind = str1.find(',')
-            col = ''
-            if(ind != -1):
-                col = str1[0:ind].strip()
-                str1 = str1[ind+1:]
-            else:
-                col = str1.strip()
-                str1 = ''
-
-            self.orderbycols.append(col)
-
-            if(len(str1) == 0):
-                break
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'len(orderbycols) = {len(self.orderbycols):d}')
-            logging.debug(self.orderbycols)
-
-        return
-
-        #
-        # } end of parseQuery def
-        #
-
-
-    def __validateUser__(self, cookiename, cookiestr, propfilter,
-                         usertbl, **kwargs):
-
-        #
-        # {
-        #
-
-        #
-        #  If cookiestr exists: validate userid/encodedpass
-        #
-
-        msg = ''
-        ind = cookiestr.find(cookiename)
-
-        substr = ''
-        if(ind != -1):
-            substr = cookiestr[ind:]
-        else:
-            msg = 'Failed to find cookiename: [{cookiename:s}] in cookiestr'
-            raise Exception(msg)
-
-        #
-        # Separate cookiestr from cookiename
-        #
-
-        substr1 = ''
-        ind = substr.find('=')
-        if(ind != -1):
-            substr1 = substr[ind+1:]
-
-        #
-        # Empty cookie str is OK, treat it as anonymous user
-        #
-
-        if(len(substr1) == 0):
-            return
-
-        arr = substr1.split('|')
-        narr = len(arr)
-
-        self.userid = arr[0]
-        self.encodedpass = arr[1]
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'userid = {self.userid:s}')
-            logging.debug(f'encodedpass = {self.encodedpass:s}')
-
-        if(self.userid == 'anon'):
-            self.userid = ''
-            return
-
-        #
-        # Validate userid/encodedpass with the data in usertbl
-        #
-
-        cursor = self.conn.cursor()
-
-        sql = ''
-        if(propfilter == 'koa'):
-
-            sql = "select passwd from " + usertbl + \
-                " where userid='" + self.userid + "'"
-
-        elif(propfilter == 'neid'):
-            sql = "select password from " + usertbl + \
-                " where userid='" + self.userid + "'"
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'User lookup sql= {sql:s}')
-
-        try:
-            self.__executeSql__(cursor, sql)
-
-        except Exception as e:
-
-            self.msg = 'Failed to execute [' + sql + ']: ' + str(e)
+            self.msg = 'Failed to execute [' + sql + ']: ' + str(e)
 
             if self.debug:
                 logging.debug('')
@@ -1146,6 +1014,9 @@ class propFilter:
             self.msg = 'Incorrect password for the user: ' + self.userid
             raise Exception(self.msg)
 
+        if cache is not None:
+            cache.put(key, self.userid)
+
         self.status = 'ok'
         return
 
@@ -1317,299 +1188,714 @@ class propFilter:
         #
 
 
-    def __createTmpAccessiddb__(self, tmp_accessiddbtbl, userid, accessid,
-                                accesstbl, **kwargs):
+    def __injectConstraint__(self, query, **kwargs):
 
         #
         # {
         #
 
-        # Create tmp_accessiddbtbl, but first drop tmp_accessiddbtbl just in case
-        # it might already exist
+        # Add the access constraint to the where clause of every select
+        # block (main query, subqueries, union members) whose from clause
+        # reads dbtable.  The query is parsed with sqlparse (as in
+        # TableNames) and rebuilt from the parse tree with the added text
+        # (kept in before/after, keyed by token) around the clauses.
         #
 
-        try:
-            self.__dropDbtbl__(tmp_accessiddbtbl)
-
-        except Exception as e:
+        statements = sqlparse.parse(query)
 
-            self.msg = 'Failed to create tmp_accessiddbtbl: ' + str(e)
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
-            pass
+        if(len(statements) == 0):
+            self.msg = 'Failed to parse query [' + query + ']'
+            raise Exception(self.msg)
 
+        self.before = {}
+        self.after = {}
 
-        sql = "create global temporary table " + tmp_accessiddbtbl + \
-            "(" + accessid + " varchar(22)) on commit preserve rows"
+        self.ninject = 0
+        self.fromtokens = []
+        self.fileidcol = ''
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'temp table create sql= {sql:s}')
+        self.filtered = set()
 
-        cursor = self.conn.cursor()
-        try:
-            self.__executeSql__(cursor, sql)
+        self.statement = statements[0]
+        self.injected = []
 
-        except Exception as e:
+        self.__injectBlock__(statements[0])
 
-            self.msg = 'Failed to create tmp_accessiddbtbl: ' + str(e)
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
+        if(self.ninject == 0):
+            self.msg = 'Failed to find table [' + self.dbtable + \
+                '] in the query from clause'
             raise Exception(self.msg)
 
-        if self.debug:
-            logging.debug('')
-            logging.debug('tmp_accessiddbtbl created')
-
         #
-        # Insert into tmp_accessiddbtbl: select accessid allowed
-        # by userid: accessidtbl
+        # A proprietary table that is read somewhere we cannot add the
+        # constraint to rejects the query
         #
 
-        sql = "insert into " + tmp_accessiddbtbl + \
-            "(select lower(" + accessid + ") as " + accessid + \
-            " from " + accesstbl + " where userid = '" + userid + "')"
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'temp table insert sql= {sql:s}')
-
-        cursor = self.conn.cursor()
-        try:
-            self.__executeSql__(cursor, sql)
+        for name in self.proptables:
 
-        except Exception as e:
+            if(name not in self.filtered):
+                self.msg = 'Failed to find table [' + name + \
+                    '] in the query from clause'
+                raise Exception(self.msg)
 
-            self.msg = 'Failed to insert data to tmp_accessiddbtbl: ' + str(e)
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
+        sql = self.__render__(statements[0]).strip()
 
-            raise Exception(self.msg)
+        self.fromwhere = ''
+        for token in self.fromtokens:
+            self.fromwhere = self.fromwhere + self.__render__(token)
 
-        return
+        return(sql)
 
         #
-        # } end of createTmpAccessiddb def
+        # } end of injectConstraint def
         #
 
 
-    def __createTmpFileiddb__(self, tmp_fileiddbtbl, fileid, fileid_allowed,
-                              dbtable, wherestr, accessid, tmp_accessiddbtbl,
-                              **kwargs):
+    def __injectBlock__(self, tokenlist, **kwargs):
 
         #
         # {
         #
 
-        # Create tmp_fileiddbtbl, but first drop tmp_fileiddbtbl just in case
-        # it might already existed
+        # A block is a statement or a parenthesized subselect: its union
+        # members are filtered separately, then the subselects inside it.
+        # ctenames are the WITH names in scope, which are not tables.
         #
 
-        try:
-            self.__dropDbtbl__(tmp_fileiddbtbl)
+        tokens = tokenlist.tokens
 
-        except Exception as e:
+        ctenames = set()
+        if('ctenames' in kwargs):
+            ctenames = kwargs['ctenames']
 
-            self.msg = 'Failed to create tmp_fileiddbtbl: ' + str(e)
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
-            pass
+        #
+        # The bodies of a WITH clause are blocks of their own; a WITH name
+        # is in scope after its definition (and in it, for a recursive one)
+        #
 
+        definitions, skip = TableNames().extract_with(tokenlist)
 
-        sql = "create global temporary table " + tmp_fileiddbtbl + \
-            "(" + fileid_allowed + " varchar(35)) on commit preserve rows"
+        names = set(ctenames)
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'fileid temp table create sql= {sql:s}')
+        for name, body in definitions:
 
-        cursor = self.conn.cursor()
-        try:
-            self.__executeSql__(cursor, sql)
+            names.add(name)
+            self.__injectBlock__(body, ctenames=set(names))
 
-        except Exception as e:
+        istart = 0
+        for i in range(0, len(tokens)):
 
-            self.msg = 'Failed to create tmp_accessiddbtbl: ' + str(e)
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
-            raise Exception(self.msg)
+            if((tokens[i].ttype is Keyword)
+                    and (tokens[i].normalized in self.setkeys)):
+
+                self.__injectSelect__(tokens, istart, i, ctenames=names)
+                istart = i + 1
+
+        self.__injectSelect__(tokens, istart, len(tokens), ctenames=names)
+
+        for token in tokens:
+
+            if(id(token) in skip):
+                continue
+
+            self.__findSubselects__(token, ctenames=names)
+
+        return
 
         #
-        # Insert into tmp_fileiddbtbl: select koaid_allowed from dbtable with
-        # input where condition and the accessid constraint
-        #
-        # KOA access_constraint
+        # } end of injectBlock def
         #
 
-        access_constraint = ''
 
-        if(self.propfilter == 'koa'):
+    def __findSubselects__(self, token, **kwargs):
 
-            if(self.instrument.lower() == 'hires'):
+        if not token.is_group:
+            return
 
-                if(len(self.userid) > 0):
+        if(isinstance(token, Parenthesis) and self.__isSubselect__(token)):
+            self.__injectBlock__(token, **kwargs)
+            return
 
-                    access_constraint = \
-                        "((current_date > add_months(date_obs, propmin))" + \
-                        " or(lower(" + accessid + ") in(select " + \
-                        accessid + " from " + tmp_accessiddbtbl + ")))"
+        for item in token.tokens:
+            self.__findSubselects__(item, **kwargs)
 
-                else:
-                    access_constraint = \
-                        "(current_date > add_months(date_obs, propmin))"
-            else:
-                if(len(self.userid) > 0):
+        return
 
-                    access_constraint = \
-                        "((current_date > add_months(date_obs, propint))" + \
-                        " or(lower(" + accessid + ") in(select " + \
-                        accessid + " from " + tmp_accessiddbtbl + ")))"
 
-                else:
-                    access_constraint = \
-                        "(current_date > add_months(date_obs, propint))"
+    def __isSubselect__(self, token, **kwargs):
+
+        for item in token.tokens:
+            if((item.ttype is DML) and (item.value.upper() == 'SELECT')):
+                return True
+
+        return False
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(
-                    f'koa: access_constraint= {access_constraint:s}')
+
+    def __injectSelect__(self, tokens, istart, iend, **kwargs):
 
         #
-        # NEID fileidallowed sql
+        # {
         #
 
-        elif(self.propfilter == 'neid'):
+        # One select in tokens[istart:iend]: find the references to
+        # proprietary tables (with their aliases) in the from clause and
+        # the where clause
+        #
 
-            if((self.datalevel.lower() == 'l0') or
-               (self.datalevel.lower() == 'eng')):
+        ctenames = set()
+        if('ctenames' in kwargs):
+            ctenames = kwargs['ctenames']
 
-                if(len(self.userid) > 0):
+        prefixes = []
+        entries = []
 
-                    access_constraint = \
-                        "((current_date > add_months(obsdate, l0propint))" + \
-                        " or(lower(" + accessid + ") in(select " + \
-                        accessid + " from " + tmp_accessiddbtbl + ")))"
-                else:
-                    access_constraint = \
-                        "(current_date > add_months(obsdate, l0propint))"
+        ifrom = -1
+        iwhere = -1
+        iclause = iend
 
-            elif(self.datalevel.lower() == 'l1'):
+        infrom = False
 
-                if(len(self.userid) > 0):
+        for i in range(istart, iend):
 
-                    access_constraint = \
-                        "((current_date > add_months(obsdate, l1propint))" + \
-                        " or(lower(" + accessid + ") in(select " + \
-                        accessid + " from " + tmp_accessiddbtbl + ")))"
-                else:
-                    access_constraint = \
-                        "(current_date > add_months(obsdate, l1propint))"
+            token = tokens[i]
 
-            elif(self.datalevel.lower() == 'l2'):
+            if((token.ttype is Keyword) and (token.normalized == 'FROM')):
+                infrom = True
+                ifrom = i
+                continue
 
-                if(len(self.userid) > 0):
+            if isinstance(token, Where):
+                infrom = False
+                iwhere = i
+                continue
 
-                    access_constraint = \
-                        "((current_date > add_months(obsdate, l2propint))" + \
-                        " or(lower(" + accessid + ") in(select " + \
-                        accessid + " from " + tmp_accessiddbtbl + ")))"
-                else:
-                    access_constraint = \
-                        "(current_date > add_months(obsdate, l2propint))"
+            if(((token.ttype is Keyword) and (token.normalized in self.endkeys))
+                    or ((token.ttype is Punctuation)
+                        and (token.value in [')', ';']))):
+                iclause = i
+                break
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(
-                    f'neid: access_constraint= {access_constraint:s}')
+            if not infrom:
+                continue
 
+            identifiers = []
+            if isinstance(token, IdentifierList):
+                identifiers = list(token.get_identifiers())
+            elif isinstance(token, Identifier):
+                identifiers = [token]
 
-        selectstr = ''
-        if(len(wherestr) > 0):
-            selectstr = "select " + fileid + " from " + dbtable + " " + \
-                wherestr + " and " + access_constraint
-        else:
-            selectstr = "select " + fileid + " from " + dbtable  + \
-                " where " + access_constraint
+            for identifier in identifiers:
 
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'selectstr = {selectstr:s}')
+                name = self.__tableName__(identifier)
 
-        #
-        # Test the selectstr
-        #
+                if((name is None) or (name in ctenames)
+                        or (name not in self.proptables)):
+                    continue
 
-        cursor = self.conn.cursor()
-        try:
-            self.__executeSql__(cursor, selectstr)
+                #
+                # The columns are qualified with the alias or the table
+                # name, so that they are not ambiguous in a join
+                #
 
-        except Exception as e:
+                if identifier.get_alias() is not None:
+                    prefix = identifier.get_alias() + '.'
+                else:
+                    prefix = name + '.'
 
-            self.msg = f'Failed to execute select statement [{selectstr:s}]: '\
-                + str(e)
+                prefixes.append(prefix)
+                entries.append(self.proptables[name])
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'{self.msg:s}')
+                self.filtered.add(name)
 
-            raise Exception(self.msg)
+                if((len(self.fileidcol) == 0)
+                        and (name == self.dbtable.replace('"', '').lower())):
+                    self.fileidcol = prefix + self.fileid
+
+        if(len(prefixes) == 0):
+            return
+
+        constraints = []
+        for i in range(0, len(prefixes)):
+            constraints.append(
+                self.__accessConstraint__(self.accessid, self.accesstbl,
+                                          prefix=prefixes[i],
+                                          datecol=entries[i]['datecol'],
+                                          propcol=entries[i]['propcol']))
+
+        constraint = ' and '.join(constraints)
+
+        if(iwhere >= 0):
+
+            #
+            # where (<input condition>) and <constraint>; a trailing
+            # fetch/offset/limit (which sqlparse leaves in the where
+            # clause) stays after it
+            #
+
+            where = tokens[iwhere]
+
+            icond = len(where.tokens)
+            for k in range(1, len(where.tokens)):
+
+                item = where.tokens[k]
+
+                if((item.ttype is Keyword)
+                        and (item.normalized in self.endkeys)):
+                    icond = k
+                    break
+
+            ilast = self.__lastItem__(where.tokens, 1, icond)
+
+            self.before[id(where.tokens[1])] = ' ('
+            self.after[id(where.tokens[ilast])] = \
+                self.__afterText__(where.tokens[ilast],
+                                   ') and ' + constraint + ' ')
+
+            fromtokens = tokens[ifrom:iwhere] + where.tokens[0:ilast+1]
+
+        else:
+
+            ilast = self.__lastItem__(tokens, ifrom, iclause)
+
+            self.after[id(tokens[ilast])] = \
+                self.__afterText__(tokens[ilast], ' where ' + constraint + ' ')
+
+            fromtokens = tokens[ifrom:ilast+1]
+
+        if(self.ninject == 0):
+            self.fromtokens = fromtokens
+
+        self.injected.append((tokens, ifrom, prefixes))
+
+        self.ninject = self.ninject + 1
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'access constraint injected: {constraint:s}')
+
+        return
+
+        #
+        # } end of injectSelect def
+        #
+
+
+    def __lastItem__(self, tokens, istart, iend, **kwargs):
+
+        # Index of the last token in tokens[istart:iend] that is not white
+        # space or a comment: the injected text goes after it
+        #
+
+        for i in range(iend-1, istart-1, -1):
+
+            token = tokens[i]
+
+            if(token.is_whitespace or (token.ttype in Comment)
+                    or isinstance(token, sqlparse.sql.Comment)):
+                continue
+
+            return(i)
+
+        return(iend-1)
+
+
+    def __afterText__(self, token, text, **kwargs):
+
+        # Text to add after token; a '--' comment at the end of the token
+        # (grouped into it by sqlparse) must not swallow it
+        #
+
+        leaves = list(token.flatten())
+
+        if((len(leaves) > 0) and (leaves[-1].ttype in Comment)
+                and leaves[-1].value.startswith('--')
+                and not leaves[-1].value.endswith('\n')):
+            return('\n' + text)
+
+        return(text)
+
+
+    def __tableName__(self, identifier, **kwargs):
+
+        # Table name (lower case, with the schema if given) an identifier
+        # in a from clause refers to, None for a subselect
+        #
+
+        for item in identifier.tokens:
+            if isinstance(item, Parenthesis):
+                return None
+
+        name = identifier.get_real_name()
+        if name is None:
+            return None
+
+        parent = identifier.get_parent_name()
+        if parent is not None:
+            name = parent + '.' + name
+
+        return(name.replace('"', '').lower())
+
+
+    def __render__(self, token, **kwargs):
+
+        # Query text of the token with the injected text around it
+        #
+
+        text = ''
+        if token.is_group:
+            for item in token.tokens:
+                text = text + self.__render__(item)
+        else:
+            text = token.value
+
+        return(self.before.get(id(token), '') + text +
+               self.after.get(id(token), ''))
+
+
+    def __writerQuery__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # The query for the writer filter mode: the public flag and the
+        # access ID are added at the end of the select list of the
+        # (single) block reading dbtable, which has to be the main query
+        # and to return one row per dbtable row.  Returns None for a
+        # query that does not qualify.
+        #
+
+        if(len(self.injected) != 1):
+            return(None)
+
+        tokens, ifrom, prefixes = self.injected[0]
+
+        if((tokens is not self.statement.tokens) or (len(prefixes) != 1)):
+            return(None)
+
+        for token in self.statement.flatten():
+
+            if(token.normalized.upper() in self.rowkeys):
+                return(None)
 
-        sql = "insert into " + tmp_fileiddbtbl + \
-            "(" + selectstr + ")"
+            if((token.ttype is Name)
+                    and (token.value.lower() in self.aggfuncs)
+                    and (token.parent is not None)
+                    and isinstance(token.parent.parent, Function)):
+                return(None)
+
+        prefix = prefixes[0]
+
+        #
+        # The select list ends with the last token before FROM; a bare
+        # '*' becomes <table>.* (Oracle takes no other column after '*')
+        #
+
+        ilast = self.__lastItem__(tokens, 0, ifrom)
+
+        if(ilast <= 0):
+            return(None)
+
+        self.before = {}
+        self.after = {}
+
+        if(tokens[ilast].ttype is Wildcard):
+            self.before[id(tokens[ilast])] = prefix
+
+        self.after[id(tokens[ilast])] = self.__afterText__(
+            tokens[ilast],
+            ", case when " + self.__publicConstraint__(prefix) +
+            " then 1 else 0 end as tap_public_, lower(" + prefix +
+            self.accessid + ") as tap_accessid_ ")
+
+        sql = self.__render__(self.statement).strip()
+
+        return(sql)
+
+        #
+        # } end of writerQuery def
+        #
+
+
+    def __publicConstraint__(self, prefix, **kwargs):
+
+        # Public data: past the proprietary period (or the precomputed
+        # release date).  SQLite has no date type: the local date and
+        # time are compared as an ISO string, which (like the Oracle
+        # current_date) is later than the bare date of the release day.
+        #
+
+        datecol = self.datecol
+        if('datecol' in kwargs):
+            datecol = kwargs['datecol']
+
+        propcol = self.propcol
+        if('propcol' in kwargs):
+            propcol = kwargs['propcol']
+
+        nowstr = 'current_date'
+        if(self.dbms.lower() == 'sqlite3'):
+            nowstr = "datetime('now', 'localtime')"
+
+        if(len(self.releasecol) > 0):
+            return("(" + nowstr + " > " + prefix + self.releasecol + ")")
+
+        return("(" + nowstr + " > add_months(" + prefix + datecol +
+               ", " + prefix + propcol + "))")
+
+
+    def __accessConstraint__(self, accessid, accesstbl, **kwargs):
+
+        #
+        # {
+        #
+
+        # Access constraint for a proprietary table: public after the
+        # proprietary period (months after the observing date), or one of
+        # the access IDs granted to the validated user in accesstbl.  The
+        # column names get the prefix (table alias or name) if given, the
+        # date and period columns are the table's (datecol, propcol).
+        #
+
+        prefix = ''
+        if('prefix' in kwargs):
+            prefix = kwargs['prefix']
+
+        pubargs = {}
+        for key in ['datecol', 'propcol']:
+            if(key in kwargs):
+                pubargs[key] = kwargs[key]
+
+        access_constraint = self.__publicConstraint__(prefix, **pubargs)
+
+        #
+        # The user's access IDs go in as bind values, in IN lists of at
+        # most nbindmax values (the Oracle limit for an IN list)
+        #
+
+        if self.accessids is None:
+
+            self.accessids = []
+            if(len(self.userid) > 0):
+                self.accessids = self.__getAccessids__(accessid, accesstbl)
+
+        accessids = self.accessids
+
+        if((self.dbms.lower() == 'sqlite3')
+                and (len(accessids) > self.nbindsqlite)):
+
+            #
+            # Older SQLite builds take at most 999 bind values per
+            # statement: a long grant list goes in a TEMP table instead
+            # (private to the connection, dropped when it is closed)
+            #
+
+            if(len(self.accesstmp) == 0):
+                self.__createAccessTmp__(accessids)
+
+            access_constraint = \
+                "(" + access_constraint + " or lower(" + prefix + \
+                accessid + ") in (select accessid from " + \
+                self.accesstmp + "))"
+
+        elif(len(accessids) > 0):
+
+            inlists = []
+
+            for i in range(0, len(accessids), self.nbindmax):
+
+                names = []
+
+                for j in range(i, min(i+self.nbindmax, len(accessids))):
+
+                    name = 'acc' + str(j)
+                    names.append(':' + name)
+
+                    self.bindvars[name] = accessids[j]
+
+                inlists.append("lower(" + prefix + accessid + ") in (" + \
+                               ", ".join(names) + ")")
+
+            access_constraint = \
+                "(" + access_constraint + " or " + \
+                " or ".join(inlists) + ")"
 
         if self.debug:
             logging.debug('')
-            logging.debug(f'fileid temp table insert sql= {sql:s}')
+            logging.debug(
+                f'{self.propfilter:s}: access_constraint= '
+                f'{access_constraint:s}')
+
+        return(access_constraint)
+
+        #
+        # } end of accessConstraint def
+        #
 
 
+    def __createAccessTmp__(self, accessids, **kwargs):
+
+        #
+        # {
+        #
+
+        tblname = 'temp.tap_accessid'
+
         cursor = self.conn.cursor()
 
         try:
-            self.__executeSql__(cursor, sql)
+            self.__executeSql__(cursor, 'create temp table if not exists ' +
+                                'tap_accessid (accessid text primary key)')
+
+            self.__executeSql__(cursor, 'delete from ' + tblname)
+
+            cursor.executemany('insert or ignore into ' + tblname +
+                               ' values (?)',
+                               [(accessid,) for accessid in accessids])
 
         except Exception as e:
 
-            self.msg = 'Failed to insert data to tmp_fileiddbtbl: ' + str(e)
+            self.msg = 'Failed to create accessid table: ' + str(e)
+
             if self.debug:
                 logging.debug('')
                 logging.debug(f'{self.msg:s}')
 
             raise Exception(self.msg)
 
+        self.accesstmp = tblname
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'{tblname:s}: {len(accessids):d} accessids')
+
+        return
+
         #
-        # Select accessid from tmp_fileiddbtbl: just to verify
+        # } end of createAccessTmp def
         #
 
-        sql = "select * from " + tmp_fileiddbtbl
+
+    def __getAccessids__(self, accessid, accesstbl, **kwargs):
+
+        #
+        # {
+        #
+
+        # Access IDs (lower case) granted to the validated user in
+        # accesstbl.  They are cached per user under cachedir for
+        # access_ttl seconds; after changing a user's grants the entry
+        # can be dropped with:
+        #
+        #     python -m TAP.filecache <cachedir> access '<accesstbl>|<userid>'
+        #
+
+        cache = None
+        key = accesstbl.lower() + '|' + self.userid
+
+        if((len(self.cachedir) > 0) and (self.access_ttl > 0)):
+
+            try:
+                cache = fileCache(self.cachedir, 'access',
+                                  ttl=self.access_ttl, debug=self.debug)
+
+                accessids = cache.get(key)
+
+                if accessids is not None:
+
+                    if self.debug:
+                        logging.debug('')
+                        logging.debug(f'cached accessids: {len(accessids):d}')
+
+                    return(accessids)
+
+            except Exception as e:
+
+                cache = None
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'access cache exception: {str(e):s}')
+
+        sql = "select lower(" + accessid + ") from " + accesstbl + \
+            " where userid = :userid"
 
         if self.debug:
             logging.debug('')
-            logging.debug(f'fileid temp table select sql = {sql:s}')
+            logging.debug(f'accessid sql= {sql:s}')
 
         cursor = self.conn.cursor()
         try:
-            self.__executeSql__(cursor, sql)
+            self.__executeSql__(cursor, sql,
+                                bindvars={'userid': self.userid})
+
+            accessids = set()
+
+            for row in cursor.fetchall():
+
+                if row[0] is not None:
+                    accessids.add(str(row[0]))
 
         except Exception as e:
 
-            self.msg = 'Failed to select from tmp_fileiddbtbl: ' + str(e)
+            self.msg = 'Failed to retrieve accessids: ' + str(e)
+
             if self.debug:
                 logging.debug('')
                 logging.debug(f'{self.msg:s}')
 
             raise Exception(self.msg)
 
-        fileidpath = self.userworkdir + '/' + tmp_fileiddbtbl + '.tbl'
+        accessids = sorted(accessids)
+
+        if cache is not None:
+            cache.put(key, accessids)
 
         if self.debug:
             logging.debug('')
+            logging.debug(f'accessids: {len(accessids):d}')
+
+        return(accessids)
+
+        #
+        # } end of getAccessids def
+        #
+
+
+    def __writeFileidAllowed__(self, fileidpath, fileid, fromwhere,
+                               **kwargs):
+
+        #
+        # {
+        #
+
+        # Write the fileids allowed by the input where condition and the
+        # access constraint (the from/where clause of the filtered query
+        # block) to fileidpath
+        #
+
+        selectstr = "select " + fileid + " " + fromwhere
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'selectstr = {selectstr:s}')
             logging.debug(f'fileidpath = {fileidpath:s}')
 
+        cursor = self.conn.cursor()
+        try:
+            self.__executeSql__(cursor, selectstr, bindvars=self.bindvars)
+
+        except Exception as e:
+
+            self.msg = f'Failed to execute select statement [{selectstr:s}]: '\
+                + str(e)
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'{self.msg:s}')
+
+            raise Exception(self.msg)
+
         try:
             self.__writeSinglecolResult__(cursor, fileidpath, 35)
 
@@ -1622,11 +1908,10 @@ class propFilter:
 
             raise Exception(self.msg)
 
-
         return
 
         #
-        # } end of createTmpFileiddb def
+        # } end of writeFileidAllowed def
         #
 
 
@@ -1636,8 +1921,12 @@ class propFilter:
         # {
         #
 
+        bindvars = {}
+        if('bindvars' in kwargs):
+            bindvars = kwargs['bindvars']
+
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, bindvars)
 
         except Exception as e:
 
@@ -1659,6 +1948,128 @@ class propFilter:
         #
 
 
+    def __writeResult__(self, sql, rowfilter, **kwargs):
+
+        #
+        # {
+        #
+
+        # Execute the filtered query and write the result file
+        #
+
+        cursor = self.conn.cursor()
+
+        try:
+            self.__executeSql__(cursor, sql, bindvars=self.bindvars)
+
+        except Exception as e:
+
+            self.msg = 'Failed to execute [' + sql + ']: ' + str(e)
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'{self.msg:s}')
+
+            raise Exception(self.msg)
+
+        exclcols = []
+        if rowfilter is not None:
+
+            ncol = len(cursor.description)
+            exclcols = [ncol-2, ncol-1]
+
+        if self.debug:
+            logging.debug('')
+            logging.debug('call writeResultfile')
+
+        try:
+            wresult = writeResult(cursor,
+                                  self.userworkdir,
+                                  self.dd,
+                                  format=self.format,
+                                  maxrec=self.maxrec,
+                                  arraysize=self.arraysize,
+                                  nworker=self.nworker,
+                                  prefetch=self.prefetch,
+                                  arraysize_max=self.arraysize_max,
+                                  numwidth=self.numwidth,
+                                  nsample=self.nsample,
+                                  memory_budget=self.memory_budget,
+                                  exclcol=exclcols,
+                                  rowfilter=rowfilter,
+                                  coldesc=self.coldesc,
+                                  racol=self.racol,
+                                  deccol=self.deccol,
+                                  debug=self.debug)
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'writeResult exception: {str(e):s}')
+
+            raise Exception(str(e))
+
+        self.outpath = wresult.outpath
+        self.ntot = wresult.ntot
+
+        return
+
+        #
+        # } end of writeResult def
+        #
+
+
+    def __sharedResult__(self, sql, rowfilter, ttl, cachename, **kwargs):
+
+        #
+        # {
+        #
+
+        key = result_key(access_scope(self.accessids), self.dbms,
+                         self.format, self.maxrec, self.coldesc, sql,
+                         version=self.dataversion)
+
+        outpath = self.userworkdir + '/' + writeResult.resulttbls[self.format]
+
+        def runner():
+
+            self.__writeResult__(sql, rowfilter)
+
+            return({'outpath': self.outpath, 'ntot': self.ntot})
+
+        try:
+            rcache = resultCache(self.cachedir, cachename,
+                                 budget=self.result_cache,
+                                 prune=int(cachename == 'flight'),
+                                 debug=self.debug)
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'result cache exception: {str(e):s}')
+
+            self.__writeResult__(sql, rowfilter)
+            return
+
+        result = rcache.run(key, outpath, runner, ttl=ttl)
+
+        self.outpath = result['outpath']
+        self.ntot = result['ntot']
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'shared result: {self.ntot:d} rows, cache hit: '
+                          f'{rcache.nhit:d}')
+
+        return
+
+        #
+        # } end of sharedResult def
+        #
+
+
     def __parseSql__(self, cursor, sql, **kwargs):
 
         #
@@ -1718,36 +2129,3 @@ class propFilter:
         #
         # } end of encodeSqlerrmsg def
         #
-
-
-    def __dropDbtbl__(self, dbtable, **kwargs):
-
-        #
-        # {
-        #
-
-        cursor_drop = self.conn.cursor()
-        dropsql = 'drop table ' + dbtable
-
-        if self.debug:
-            logging.debug('')
-            logging.debug(f'drop table sql = {dropsql:s}')
-
-        try:
-            cursor_drop.execute(dropsql)
-
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'table {dbtable:s} successfully dropped')
-
-        except Exception as e:
-            pass
-
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'drop table exception: {str(e):s}')
-        return
-
-        #
-        # } end of dropDbtbl def
-        #
@@ -0,0 +1,271 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import logging
+import argparse
+import calendar
+import datetime
+
+from TAP.configparam import configParam
+
+
+def add_months(datestr, nmonths):
+
+    #
+    # {
+    #
+
+    # SQLite version of the Oracle add_months(date, n) for dates stored
+    # as ISO strings: the last day of a month maps to the last day of
+    # the target month, and the time of day (if any) is kept.  Returns
+    # the ISO date ('YYYY-MM-DD[ hh:mm:ss]'), or None for null input.
+    #
+
+    if((datestr is None) or (nmonths is None)):
+        return None
+
+    datestr = str(datestr)
+
+    timestr = ''
+    if(len(datestr) > 11):
+        timestr = ' ' + datestr[11:]
+
+    try:
+        date = datetime.date.fromisoformat(datestr[0:10])
+        nmonths = int(nmonths)
+
+    except Exception as e:
+        return None
+
+    month = date.month - 1 + nmonths
+
+    year = date.year + month // 12
+    month = month % 12 + 1
+
+    lastday = calendar.monthrange(year, month)[1]
+
+    day = date.day
+    if((day > lastday)
+            or (date.day == calendar.monthrange(date.year, date.month)[1])):
+        day = lastday
+
+    return datetime.date(year, month, day).isoformat() + timestr
+
+    #
+    # } end of add_months def
+    #
+
+
+class releaseDate:
+
+    """
+    releaseDate maintains the precomputed public release date column
+    used by propFilter (config RELEASE_COL): releasecol is set to
+    add_months(datecol, propcol) for the rows where it is missing or out
+    of date, so the access check becomes an indexable range predicate.
+
+    Required input:
+
+        conn:        DBMS connection
+
+        dbms:        'oracle' or 'sqlite3'
+
+        table:       table to update
+
+        datecol:     observing date column (e.g. date_obs, obsdate)
+
+        propcol:     proprietary period (months) column (e.g. propint)
+
+    Optional input:
+
+        releasecol:  release date column (default release_date)
+
+        create(0/1): add releasecol to the table first (default 0)
+
+        index(0/1):  create an index on releasecol (default 0)
+
+    Usage:
+
+        rd = releaseDate(conn, 'oracle', 'koa_hires', 'date_obs',
+                         'propmin', releasecol='release_date')
+
+        print(rd.nupdate)
+    """
+
+    debug = 0
+
+    releasecol = 'release_date'
+    create = 0
+    index = 0
+
+    nupdate = 0
+
+    status = ''
+    msg = ''
+
+    def __init__(self, conn, dbms, table, datecol, propcol, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('releasecol' in kwargs):
+            self.releasecol = kwargs['releasecol']
+
+        if('create' in kwargs):
+            self.create = kwargs['create']
+
+        if('index' in kwargs):
+            self.index = kwargs['index']
+
+        self.conn = conn
+        self.dbms = dbms.lower()
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'releaseDate: table= {table:s} datecol= '
+                          f'{datecol:s} propcol= {propcol:s} releasecol= '
+                          f'{self.releasecol:s}')
+
+        if(self.dbms == 'sqlite3'):
+            self.conn.create_function('add_months', 2, add_months,
+                                      deterministic=True)
+
+        cursor = self.conn.cursor()
+
+        #
+        # Add the release date column
+        #
+
+        if self.create:
+
+            coltype = 'date'
+            if(self.dbms == 'sqlite3'):
+                coltype = 'text'
+
+            sql = 'alter table ' + table + ' add ' + self.releasecol + \
+                ' ' + coltype
+
+            self.__executeSql__(cursor, sql)
+
+        #
+        # Update the rows whose release date is missing or stale (e.g.
+        # after an extension of the proprietary period)
+        #
+
+        releasestr = 'add_months(' + datecol + ', ' + propcol + ')'
+
+        sql = 'update ' + table + ' set ' + self.releasecol + ' = ' + \
+            releasestr + ' where (' + self.releasecol + ' is null and ' + \
+            releasestr + ' is not null) or ' + self.releasecol + \
+            ' <> ' + releasestr
+
+        self.__executeSql__(cursor, sql)
+
+        self.nupdate = cursor.rowcount
+
+        if self.index:
+
+            sql = 'create index ' + table.replace('.', '_') + '_' + \
+                self.releasecol + ' on ' + table + '(' + self.releasecol + ')'
+
+            self.__executeSql__(cursor, sql)
+
+        self.conn.commit()
+
+        self.status = 'ok'
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'releaseDate: {self.nupdate:d} rows updated')
+
+        #
+        # } end of init
+        #
+
+
+    def __executeSql__(self, cursor, sql, **kwargs):
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'sql = {sql:s}')
+
+        try:
+            cursor.execute(sql)
+
+        except Exception as e:
+
+            self.status = 'error'
+            self.msg = 'Failed to execute [' + sql + ']: ' + str(e)
+
+            raise Exception(self.msg)
+
+
+def main():
+
+    #
+    # Refresh the release dates of a table, e.g. nightly from cron:
+    #
+    #     python -m TAP.releasedate koa_hires date_obs propmin
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Update the precomputed public release date column '
+                    'used for proprietary filtering.')
+
+    parser.add_argument('table', help='table to update')
+    parser.add_argument('datecol', help='observing date column')
+    parser.add_argument('propcol', help='proprietary period column (months)')
+
+    parser.add_argument('--config', default=os.getenv('TAP_CONF', ''),
+                        help='TAP config file (default: $TAP_CONF)')
+    parser.add_argument('--releasecol', default='',
+                        help='release date column (default: RELEASE_COL '
+                             'from the config file, or release_date)')
+    parser.add_argument('--create', action='store_true',
+                        help='add the release date column first')
+    parser.add_argument('--index', action='store_true',
+                        help='create an index on the release date column')
+
+    args = parser.parse_args()
+
+    config = configParam(args.config)
+
+    releasecol = args.releasecol
+    if(len(releasecol) == 0):
+        releasecol = config.releasecol
+    if(len(releasecol) == 0):
+        releasecol = 'release_date'
+
+    if(config.dbms == 'oracle'):
+
+        import cx_Oracle
+
+        conn = cx_Oracle.connect(config.connectInfo['userid'],
+                                 config.connectInfo['password'],
+                                 config.connectInfo['dbserver'])
+    else:
+        import sqlite3
+
+        conn = sqlite3.connect(config.connectInfo['db'])
+
+    rd = releaseDate(conn, config.dbms, args.table, args.datecol,
+                     args.propcol, releasecol=releasecol,
+                     create=int(args.create), index=int(args.index))
+
+    print(f'{args.table:s}: {rd.nupdate:d} rows updated')
+
+    conn.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
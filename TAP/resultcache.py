@@ -0,0 +1,577 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import argparse
+import datetime
+import tempfile
+
+import sqlparse
+
+from sqlparse.tokens import Keyword, Comment
+
+
+def next_midnight():
+
+    # Seconds until the next local midnight: the public/proprietary status
+    # of a row (current_date against its release date) only changes then
+    #
+
+    now = datetime.datetime.now()
+
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(1),
+                                         datetime.time())
+
+    return((midnight - now).total_seconds())
+
+
+def normalize_sql(sql):
+
+    # Query text with the comments dropped, white space collapsed and the
+    # keywords in upper case (string literals and names are kept as is)
+    #
+
+    words = []
+
+    for statement in sqlparse.parse(sql):
+
+        for token in statement.flatten():
+
+            if(token.ttype in Comment):
+                continue
+
+            if token.is_whitespace:
+                if((len(words) > 0) and (words[-1] != ' ')):
+                    words.append(' ')
+                continue
+
+            if(token.ttype in Keyword):
+                words.append(token.normalized)
+            else:
+                words.append(token.value)
+
+    return(''.join(words).strip().rstrip(';').strip())
+
+
+def result_key(scope, dbms, format, maxrec, coldesc, sql, **kwargs):
+
+    # Cache key of a query result: the access scope ('all', 'public' or
+    # a digest of the user's access IDs), the output settings, the dataset
+    # version (if known) and the normalized SQL
+    #
+
+    version = ''
+    if('version' in kwargs):
+        version = kwargs['version']
+
+    return(scope + '|' + dbms.lower() + '|' + format + '|' + str(maxrec) +
+           '|' + str(coldesc) + '|' + version + '|' + normalize_sql(sql))
+
+
+def access_scope(accessids):
+
+    if(len(accessids) == 0):
+        return('public')
+
+    return(hashlib.sha256('|'.join(sorted(accessids)).encode('utf-8'))
+           .hexdigest())
+
+
+class resultCache:
+
+    """
+    resultCache keeps finished result files under a cache directory so
+    that the service processes can share them.  The files are content
+    addressed (objects/<sha256 of the file>), so results of different
+    queries that come out identical are stored once; each cached key has
+    a small JSON entry pointing at its file.  A cached file is hard linked
+    (or copied, across file systems) into the job directory.
+
+    The per-key lock lets concurrent requests for the same key wait for
+    the one running the query instead of running it again (single
+    flight): with a short ttl the cache does only that.  With a byte
+    budget the least recently used entries are dropped when the files
+    take more than the budget.
+
+    Required input:
+
+        cachedir:  cache directory (created if needed)
+
+        name:      cache name; each cache is a sub-directory of cachedir
+
+    Optional input:
+
+        budget:    bytes the cached files may take (default 0: no limit)
+
+        prune(0/1): drop the expired entries after each put (default 0,
+                   for caches with short-lived entries, like the single
+                   flight results)
+
+    Usage:
+
+        rcache = resultCache(cachedir, 'results', budget=budget)
+
+        result = rcache.run(key, outpath, runner, ttl=3600)
+
+    runner() executes the query into outpath and returns a dictionary
+    with (at least) 'outpath' and 'ntot'; run() returns the same
+    dictionary, from the cache or from runner().
+    """
+
+    debug = 0
+
+    cachedir = ''
+    name = ''
+    budget = 0
+    prune = 0
+
+    nhit = 0
+
+    def __init__(self, cachedir, name, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('budget' in kwargs):
+            self.budget = kwargs['budget']
+
+        if('prune' in kwargs):
+            self.prune = kwargs['prune']
+
+        self.name = name
+        self.cachedir = cachedir + '/' + name
+        self.objdir = self.cachedir + '/objects'
+
+        try:
+            os.makedirs(self.objdir, exist_ok=True)
+
+        except Exception as e:
+
+            self.msg = f'Failed to create cache directory [{self.cachedir:s}]'
+            raise Exception(self.msg)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'resultCache: cachedir= {self.cachedir:s} '
+                          f'budget= {self.budget:d}')
+
+        #
+        # } end of init
+        #
+
+
+    def run(self, key, outpath, runner, **kwargs):
+
+        #
+        # {
+        #
+
+        ttl = 600
+        if('ttl' in kwargs):
+            ttl = kwargs['ttl']
+
+        fp = self.lock(key)
+
+        try:
+            meta = self.get(key, outpath)
+
+            if meta is not None:
+
+                meta['outpath'] = outpath
+                return(meta)
+
+            result = runner()
+
+            self.put(key, result['outpath'], {'ntot': result['ntot']},
+                     ttl=ttl)
+
+        finally:
+            self.unlock(fp)
+
+        return(result)
+
+        #
+        # } end of run def
+        #
+
+
+    def lock(self, key, **kwargs):
+
+        # Blocks until no other process holds the lock of key
+        #
+
+        path = self.__path__(key) + '.lock'
+
+        fp = open(path, 'a')
+        os.utime(path)
+
+        fcntl.lockf(fp, fcntl.LOCK_EX)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'resultCache {self.name:s}: locked')
+
+        return(fp)
+
+
+    def unlock(self, fp, **kwargs):
+
+        try:
+            fcntl.lockf(fp, fcntl.LOCK_UN)
+            fp.close()
+
+        except Exception as e:
+            pass
+
+
+    def get(self, key, outpath, **kwargs):
+
+        #
+        # {
+        #
+
+        path = self.__path__(key)
+
+        try:
+            with open(path + '.json', 'r') as fp:
+                data = json.load(fp)
+
+        except Exception as e:
+            return(None)
+
+        if(data.get('key') != key):
+            return(None)
+
+        if(data.get('expires', 0) <= time.time()):
+
+            self.__remove__(path)
+            return(None)
+
+        try:
+            self.__link__(self.objdir + '/' + data['digest'], outpath)
+
+            #
+            # The entry's mtime is its last use, for the LRU eviction
+            #
+
+            os.utime(path + '.json')
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'resultCache get exception: {str(e):s}')
+
+            return(None)
+
+        self.nhit = self.nhit + 1
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'resultCache {self.name:s}: hit {path:s}')
+
+        return(data['meta'])
+
+        #
+        # } end of get def
+        #
+
+
+    def put(self, key, outpath, meta, **kwargs):
+
+        #
+        # {
+        #
+
+        # The result file is linked in before the entry is written, so a
+        # reader that finds the entry also finds the file
+        #
+
+        ttl = 600
+        if('ttl' in kwargs):
+            ttl = kwargs['ttl']
+
+        path = self.__path__(key)
+
+        try:
+            digest = self.__digest__(outpath)
+
+            objpath = self.objdir + '/' + digest
+
+            if os.path.exists(objpath):
+                os.utime(objpath)
+            else:
+                self.__link__(outpath, objpath)
+
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir, prefix='.tmp')
+
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'key': key, 'expires': time.time() + ttl,
+                           'digest': digest, 'meta': meta}, fp)
+
+            os.chmod(tmppath, 0o664)
+            os.replace(tmppath, path + '.json')
+
+        except Exception as e:
+
+            #
+            # A result that cannot be cached is still returned to the user
+            #
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'resultCache put exception: {str(e):s}')
+
+            return
+
+        if((self.budget > 0) or self.prune):
+            self.evict()
+
+        return
+
+        #
+        # } end of put def
+        #
+
+
+    def evict(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # Drop the expired entries, then (with a budget) the least
+        # recently used ones until the files fit in it, and the files no
+        # entry points at.  Only one process evicts at a time; the others
+        # skip it.
+        #
+
+        try:
+            lockfp = open(self.cachedir + '/.evict.lock', 'a')
+            fcntl.lockf(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except Exception as e:
+            return
+
+        try:
+            now = time.time()
+
+            entries = []
+
+            for fname in os.listdir(self.cachedir):
+
+                #
+                # Lock files not used for a day are dropped with their
+                # (expired) entries
+                #
+
+                if fname.endswith('.lock'):
+
+                    path = self.cachedir + '/' + fname
+
+                    try:
+                        if((os.stat(path).st_mtime < now - 86400) and
+                                not os.path.exists(path[:-5] + '.json')):
+                            os.remove(path)
+
+                    except Exception as e:
+                        pass
+
+                    continue
+
+                if not fname.endswith('.json'):
+                    continue
+
+                path = self.cachedir + '/' + fname
+
+                try:
+                    with open(path, 'r') as fp:
+                        data = json.load(fp)
+
+                    mtime = os.stat(path).st_mtime
+
+                except Exception as e:
+                    continue
+
+                if(data.get('expires', 0) <= now):
+                    self.__remove__(path[:-5])
+                    continue
+
+                entries.append((mtime, path[:-5], data['digest']))
+
+            entries.sort()
+
+            #
+            # Size of the files, each counted once
+            #
+
+            refs = {}
+            for (mtime, path, digest) in entries:
+                refs[digest] = refs.get(digest, 0) + 1
+
+            sizes = {}
+            total = 0
+
+            for fname in os.listdir(self.objdir):
+
+                objpath = self.objdir + '/' + fname
+
+                try:
+                    stat = os.stat(objpath)
+
+                except Exception as e:
+                    continue
+
+                #
+                # A file with no entry is dropped once it is a minute old
+                # (a put may be between linking the file and its entry)
+                #
+
+                if((fname not in refs) and (stat.st_ctime < now - 60)):
+
+                    try:
+                        os.remove(objpath)
+                    except Exception as e:
+                        pass
+
+                    continue
+
+                sizes[fname] = stat.st_size
+                total = total + stat.st_size
+
+            nevict = 0
+
+            for (mtime, path, digest) in entries:
+
+                if((self.budget <= 0) or (total <= self.budget)):
+                    break
+
+                self.__remove__(path)
+
+                nevict = nevict + 1
+
+                refs[digest] = refs[digest] - 1
+
+                if((refs[digest] == 0) and (digest in sizes)):
+
+                    try:
+                        os.remove(self.objdir + '/' + digest)
+                    except Exception as e:
+                        pass
+
+                    total = total - sizes[digest]
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'resultCache {self.name:s}: {nevict:d} '
+                              f'evicted, {total:d} bytes')
+
+        finally:
+            fcntl.lockf(lockfp, fcntl.LOCK_UN)
+            lockfp.close()
+
+        return
+
+        #
+        # } end of evict def
+        #
+
+
+    def __digest__(self, path, **kwargs):
+
+        sha = hashlib.sha256()
+
+        with open(path, 'rb') as fp:
+
+            while True:
+
+                data = fp.read(1048576)
+                if not data:
+                    break
+
+                sha.update(data)
+
+        return(sha.hexdigest())
+
+
+    def __link__(self, frompath, topath, **kwargs):
+
+        # Hard link frompath to topath (replacing it), or copy it if
+        # they are on different file systems
+        #
+
+        tmppath = topath + '.' + str(os.getpid())
+
+        try:
+            os.link(frompath, tmppath)
+
+        except Exception as e:
+            shutil.copyfile(frompath, tmppath)
+
+        os.replace(tmppath, topath)
+
+
+    def __remove__(self, path, **kwargs):
+
+        try:
+            os.remove(path + '.json')
+        except Exception as e:
+            pass
+
+
+    def __path__(self, key, **kwargs):
+
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+        return(self.cachedir + '/' + digest)
+
+
+def main():
+
+    #
+    # Cache maintenance, e.g. after a data reload:
+    #
+    #     python -m TAP.resultcache /work/TAP/cache results --clear
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Evict or clear a TAP result cache.')
+
+    parser.add_argument('cachedir', help='cache directory (TAP_CACHEDIR)')
+    parser.add_argument('name', help='cache name (e.g. results)')
+    parser.add_argument('--budget', type=float, default=0.,
+                        help='evict down to this size in MB')
+    parser.add_argument('--clear', action='store_true',
+                        help='drop all the entries')
+
+    args = parser.parse_args()
+
+    rcache = resultCache(args.cachedir, args.name,
+                         budget=int(args.budget*1024*1024))
+
+    if args.clear:
+
+        for fname in os.listdir(rcache.cachedir):
+            if fname.endswith('.json'):
+                rcache.__remove__(rcache.cachedir + '/' + fname[:-5])
+
+    rcache.evict()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
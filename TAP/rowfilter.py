@@ -0,0 +1,73 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import logging
+
+
+class rowFilter:
+
+    """
+    rowFilter is the writer side access check of propFilter ('writer'
+    filter mode): the query returns all rows with two extra columns, a
+    public flag (1 if past the proprietary period) and the lower case
+    access ID, and writeResult keeps the rows that are public or whose
+    access ID is in the user's set of granted IDs.
+
+    Required input:
+
+        accessids:  access IDs (lower case) granted to the user
+
+    Optional input:
+
+        ipublic:    index of the public flag column (default -2)
+
+        iaccess:    index of the access ID column (default -1)
+
+    Usage:
+
+        rfilter = rowFilter(accessids)
+
+        rows = rfilter.filter(rows)
+    """
+
+    debug = 0
+
+    ipublic = -2
+    iaccess = -1
+
+    nin = 0
+    nout = 0
+
+    def __init__(self, accessids, **kwargs):
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('ipublic' in kwargs):
+            self.ipublic = kwargs['ipublic']
+
+        if('iaccess' in kwargs):
+            self.iaccess = kwargs['iaccess']
+
+        self.allowed = frozenset(accessids)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'rowFilter: {len(self.allowed):d} accessids')
+
+
+    def filter(self, rows, **kwargs):
+
+        ipublic = self.ipublic
+        iaccess = self.iaccess
+        allowed = self.allowed
+
+        kept = [row for row in rows
+                if((row[ipublic] == 1) or (row[iaccess] in allowed))]
+
+        self.nin = self.nin + len(rows)
+        self.nout = self.nout + len(kept)
+
+        return(kept)
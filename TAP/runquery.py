@@ -15,6 +15,8 @@ import configobj
 from TAP.datadictionary import dataDictionary
 from TAP.writeresult import writeResult
 from TAP.tablenames import TableNames
+from TAP.upload import upload_table
+from TAP.partition import partitionCursor
 
 
 class runQuery:
@@ -51,6 +53,12 @@ class runQuery:
     maxrec = -1
     coldesc = 0
 
+    upload = None
+
+    nproc = 0
+    minrows = 1000000
+    indxcol = ''
+
 
     def __init__(self, **kwargs):
 
@@ -80,6 +88,14 @@ class runQuery:
             deccol(char):      decimal DEC column name,
             maxrec(int):       number of records to return(default: all)
             format(char):      return table format(default: votable)
+            upload:            uploaded tables (TAP.upload.tapUpload),
+                               loaded into the session as TAP_UPLOAD
+            nproc(int):        SQLite: processes to run the query on
+                               ranges of indxcol in parallel (see
+                               TAP.partition; default 0: no),
+            minrows(int):      smallest table worth running in
+                               parallel (default 1000000 rows),
+            indxcol(char):     spatial index column
 
         Usage:
 
@@ -99,6 +115,42 @@ class runQuery:
         if('arraysize' in kwargs):
             self.arraysize = kwargs['arraysize']
 
+        self.nworker = 1
+        if('nworker' in kwargs):
+            self.nworker = kwargs['nworker']
+
+        self.prefetch = 0
+        if('prefetch' in kwargs):
+            self.prefetch = kwargs['prefetch']
+
+        self.arraysize_max = 4*self.arraysize
+        if('arraysize_max' in kwargs):
+            self.arraysize_max = kwargs['arraysize_max']
+
+        self.numwidth = 22
+        if('numwidth' in kwargs):
+            self.numwidth = kwargs['numwidth']
+
+        self.nsample = 100
+        if('nsample' in kwargs):
+            self.nsample = kwargs['nsample']
+
+        self.memory_budget = 0
+        if('memory_budget' in kwargs):
+            self.memory_budget = kwargs['memory_budget']
+
+        if('upload' in kwargs):
+            self.upload = kwargs['upload']
+
+        if('nproc' in kwargs):
+            self.nproc = kwargs['nproc']
+
+        if('minrows' in kwargs):
+            self.minrows = kwargs['minrows']
+
+        if('indxcol' in kwargs):
+            self.indxcol = kwargs['indxcol']
+
         #
         # Get keyword parameters
         #
@@ -248,6 +300,7 @@ class runQuery:
 
         tn = TableNames()
         tables = tn.extract_tables(self.sql)
+        tables = [tbl for tbl in tables if not upload_table(tbl)] or tables
 
         if len(tables) > 0:
             self.dbtable = tables[0]
@@ -265,7 +318,8 @@ class runQuery:
             try:
                 self.conn = cx_Oracle.connect(self.userid,
                                               self.password,
-                                              self.dbserver)
+                                              self.dbserver,
+                                              threaded=True)
 
                 if self.debug:
                     logging.debug('')
@@ -281,7 +335,8 @@ class runQuery:
         elif(self.dbms.lower() == 'sqlite3'):
 
             try:
-                self.conn = sqlite3.connect(self.db)
+                self.conn = sqlite3.connect(self.db,
+                                            check_same_thread=False)
 
                 if self.debug:
                     logging.debug('')
@@ -316,6 +371,24 @@ class runQuery:
 
             raise Exception(self.msg)
 
+        #
+        # Uploaded tables (TAP_UPLOAD) are loaded into this session
+        #
+
+        if self.upload is not None:
+
+            try:
+                self.upload.load(self.conn, self.dbms)
+
+                self.sql = self.upload.rewrite(self.sql, self.dbms)
+
+            except Exception as e:
+
+                self.status = 'error'
+                self.msg = 'Failed to load the uploaded tables: ' + str(e)
+
+                raise Exception(self.msg)
+
         #
         # Retrieve dd table
         #
@@ -348,18 +421,49 @@ class runQuery:
             logging.debug(f'sql = {self.sql:s}')
             logging.debug('call execute sql')
 
-        cursor = self.conn.cursor()
+        cursor = None
 
-        try:
-            self.__executeSql__(cursor, self.sql)
+        #
+        # SQLite: large scans of dbtable can run in parallel on ranges of
+        # its spatial index (queries that don't qualify, including those
+        # planned as an index search, run as usual)
+        #
 
-        except Exception as e:
+        if((self.nproc > 1) and (self.dbms.lower() == 'sqlite3')
+                and (self.upload is None) and (len(self.indxcol) > 0)):
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'executeSql exception: {str(e):s}')
+            try:
+                cursor = partitionCursor(self.conn, self.connectInfo,
+                                         self.sql, self.dbtable,
+                                         self.indxcol,
+                                         nproc=self.nproc,
+                                         minrows=self.minrows,
+                                         workdir=self.userworkdir,
+                                         arraysize=self.arraysize,
+                                         debug=self.debug)
 
-            raise Exception(str(e))
+            except Exception as e:
+
+                cursor = None
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'partitionCursor: {str(e):s}')
+
+        if cursor is None:
+
+            cursor = self.conn.cursor()
+
+            try:
+                self.__executeSql__(cursor, self.sql)
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'executeSql exception: {str(e):s}')
+
+                raise Exception(str(e))
 
         if self.debug:
             logging.debug('')
@@ -376,6 +480,12 @@ class runQuery:
                                   format=self.format,
                                   maxrec=self.maxrec,
                                   arraysize=self.arraysize,
+                                  nworker=self.nworker,
+                                  prefetch=self.prefetch,
+                                  arraysize_max=self.arraysize_max,
+                                  numwidth=self.numwidth,
+                                  nsample=self.nsample,
+                                  memory_budget=self.memory_budget,
                                   coldesc=self.coldesc,
                                   racol=self.racol,
                                   deccol=self.deccol,
@@ -389,6 +499,10 @@ class runQuery:
 
             raise Exception(str(e))
 
+        finally:
+            if isinstance(cursor, partitionCursor):
+                cursor.close()
+
         self.stat = 'ok'
         self.outpath = wresult.outpath
         self.ntot = wresult.ntot
@@ -0,0 +1,225 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import re
+import logging
+
+
+class tableMap:
+
+    """
+    tableMap resolves a dbtable name to the settings proprietary filtering
+    needs for it: instrument (KOA), datalevel (NEID), fileid column,
+    observing date column, proprietary period column and filter mode
+    ('sql': access constraint in the query, 'writer': rows checked in
+    writeResult, see rowFilter).
+
+    Tables listed in the [tablemap] section of the config file are looked
+    up by name; other tables follow the KOA/NEID naming rules (instrument
+    or data level as a whole '_'-separated part of the table name, e.g.
+    koa_hires, neid_l1 or neidl1), matched with regular expressions
+    compiled once per process.  Settings given in the config file override
+    the ones derived from the name, so a new instrument only needs a
+    config entry.  The name rules are resolved once per process for each
+    (propfilter, fileid, table), whichever tableMap asks first.
+
+    Required input:
+
+        propfilter:  'koa', 'neid' (or '' for no proprietary filtering)
+
+        fileid:      base fileid column name (config FILEID)
+
+    Optional input:
+
+        tablemap:    dictionary of table name -> dictionary of settings
+                     (instrument, datalevel, fileid, datecol, propcol,
+                     filtermode: 'sql' or 'writer'),
+                     as read by configParam
+
+    Usage:
+
+        tmap = tableMap('koa', 'koaid', tablemap=config.tablemap)
+
+        entry = tmap.lookup('koa_hires')
+
+        entry['propcol']                (propmin)
+    """
+
+    debug = 0
+
+    keys = ['instrument', 'datalevel', 'fileid', 'datecol', 'propcol',
+            'filtermode']
+
+    #
+    # Name rules: a whole part of the table name (so that e.g. nirc does
+    # not match koa_nirc2 and eng does not match koa_lengths), the first
+    # matching part from the left; NEID levels may follow 'neid'
+    #
+
+    instruments = ['hires', 'nirspec', 'nirc2', 'lris', 'deimos', 'mosfire',
+                   'osiris', 'lws', 'esi', 'nirc', 'kcwi', 'nires']
+
+    levels = ['l0', 'l1', 'l2', 'eng']
+
+    instpattern = re.compile(
+        '|'.join(sorted(instruments, key=len, reverse=True)))
+
+    levelpattern = re.compile('(?:neid)?(' + '|'.join(levels) + ')')
+
+    #
+    # Name rule results for the rest of the process, keyed by
+    # (propfilter, fileid, table name)
+    #
+
+    resolved = {}
+
+    def __init__(self, propfilter, fileid, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        tablemap = {}
+        if('tablemap' in kwargs):
+            tablemap = kwargs['tablemap']
+
+        self.propfilter = propfilter.lower()
+        self.fileid = fileid
+
+        #
+        # Table names are matched without quotes and case
+        #
+
+        self.tables = {}
+        for name in tablemap:
+
+            entry = {}
+            for key in self.keys:
+                if(key in tablemap[name]):
+                    entry[key] = str(tablemap[name][key])
+
+            self.tables[self.__normalize__(name)] = entry
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tableMap: propfilter= {self.propfilter:s} '
+                          f'ntable= {len(self.tables):d}')
+
+        #
+        # } end of init
+        #
+
+
+    def lookup(self, dbtable, **kwargs):
+
+        #
+        # {
+        #
+
+        name = self.__normalize__(dbtable)
+
+        #
+        # The name rules only look at the table name, not the schema
+        #
+
+        tblname = name.split('.')[-1]
+
+        key = (self.propfilter, self.fileid, tblname)
+
+        if(key not in self.resolved):
+            self.resolved[key] = self.__nameRules__(tblname)
+
+        entry = dict(self.resolved[key])
+
+        if(name in self.tables):
+            entry.update(self.tables[name])
+
+        elif(tblname in self.tables):
+            entry.update(self.tables[tblname])
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tableMap: {name:s} -> {str(entry):s}')
+
+        return(entry)
+
+        #
+        # } end of lookup def
+        #
+
+
+    def __nameRules__(self, tblname, **kwargs):
+
+        #
+        # {
+        #
+
+        entry = {'instrument': '',
+                 'datalevel': '',
+                 'fileid': self.fileid,
+                 'datecol': '',
+                 'propcol': '',
+                 'filtermode': 'sql'}
+
+        if(self.propfilter == 'koa'):
+
+            match = self.__matchPart__(self.instpattern, tblname)
+            if match is not None:
+                entry['instrument'] = match.group(0)
+
+            entry['datecol'] = 'date_obs'
+
+            if(entry['instrument'] == 'hires'):
+                entry['propcol'] = 'propmin'
+            else:
+                entry['propcol'] = 'propint'
+
+            return(entry)
+
+        match = self.__matchPart__(self.levelpattern, tblname)
+        if match is not None:
+            entry['datalevel'] = match.group(1)
+
+        if(self.propfilter == 'neid'):
+
+            entry['datecol'] = 'obsdate'
+
+            level = entry['datalevel']
+            if(level == 'eng'):
+                level = 'l0'
+
+            entry['fileid'] = level + self.fileid
+
+            if(len(level) > 0):
+                entry['propcol'] = level + 'propint'
+
+        return(entry)
+
+        #
+        # } end of nameRules def
+        #
+
+
+    def __matchPart__(self, pattern, tblname, **kwargs):
+
+        # First '_'-separated part of the table name the pattern matches
+        # as a whole
+        #
+
+        for part in tblname.split('_'):
+
+            match = pattern.fullmatch(part)
+            if match is not None:
+                return(match)
+
+        return(None)
+
+
+    def __normalize__(self, name, **kwargs):
+
+        return(name.replace('"', '').strip().lower())
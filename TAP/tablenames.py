@@ -6,8 +6,8 @@
 import itertools
 import sqlparse
 
-from sqlparse.sql import IdentifierList, Identifier
-from sqlparse.tokens import Keyword, DML
+from sqlparse.sql import IdentifierList, Identifier, Parenthesis
+from sqlparse.tokens import Keyword, DML, CTE
 
 
 class TableNames:
@@ -34,18 +34,29 @@ class TableNames:
         return False
 
 
-    def extract_from_part(self, parsed):
+    def extract_from_part(self, parsed, skip=()):
         from_seen = False
         for item in parsed.tokens:
+            if id(item) in skip:
+                continue
             if item.is_group:
                 for x in self.extract_from_part(item):
                     yield x
             if from_seen:
-                if self.is_subselect(item):
+                # The next member of a UNION etc. starts with its own
+                # select list
+                if item.ttype is DML or (item.ttype is Keyword and
+                        item.normalized in ['UNION', 'UNION ALL',
+                                            'INTERSECT', 'EXCEPT',
+                                            'MINUS']):
+                    from_seen = False
+                elif self.is_subselect(item):
                     for x in self.extract_from_part(item):
                         yield x
-                elif item.ttype is Keyword and item.value.upper() in \
-                        ['ORDER', 'GROUP', 'BY', 'HAVING', 'GROUP BY']:
+                elif item.ttype is Keyword and \
+                        ' '.join(item.value.upper().split()) in \
+                        ['ORDER', 'GROUP', 'BY', 'HAVING', 'GROUP BY',
+                         'ORDER BY']:
                     from_seen = False
                     StopIteration
                 else:
@@ -54,13 +65,62 @@ class TableNames:
                 from_seen = True
 
 
+    def is_table(self, identifier):
+        # A subselect in the from clause is not a table (its own tables
+        # come from the from clause inside it)
+        for item in identifier.tokens:
+            if isinstance(item, Parenthesis):
+                return False
+        return True
+
+
+    def extract_with(self, parsed):
+        # The WITH clause of a statement: a list of (name, body) with the
+        # body the parenthesized select, and the ids of its tokens
+        definitions = []
+        skip = set()
+        with_seen = False
+        for item in parsed.tokens:
+            if item.ttype is CTE:
+                with_seen = True
+                skip.add(id(item))
+                continue
+            if not with_seen or item.is_whitespace:
+                continue
+            if item.ttype is Keyword and item.normalized == 'RECURSIVE':
+                skip.add(id(item))
+                continue
+            identifiers = []
+            if isinstance(item, IdentifierList):
+                identifiers = list(item.get_identifiers())
+            elif isinstance(item, Identifier):
+                identifiers = [item]
+            else:
+                break
+            for identifier in identifiers:
+                for token in identifier.tokens:
+                    if isinstance(token, Parenthesis) and \
+                            self.is_subselect(token):
+                        definitions.append(
+                            (identifier.get_name().replace('"', '').lower(),
+                             token))
+            skip.add(id(item))
+            break
+        return definitions, skip
+
+
     def extract_table_identifiers(self, token_stream):
         for item in token_stream:
             if isinstance(item, IdentifierList):
                 for identifier in item.get_identifiers():
+                    if isinstance(identifier, Identifier) and \
+                            not self.is_table(identifier):
+                        continue
                     value = identifier.value.replace('"', '').lower()
                     yield value
             elif isinstance(item, Identifier):
+                if not self.is_table(item):
+                    continue
                 value = item.value.replace('"', '').lower()
                 yield value
 
@@ -70,12 +130,25 @@ class TableNames:
         statements = list(sqlparse.parse(sql))
         for statement in statements:
             if statement.get_type() != 'UNKNOWN':
-                stream = self.extract_from_part(statement)
-                extracted_tables.append(list(
-                    self.extract_table_identifiers(stream)))
+                # A WITH name is not a table in the main query, nor in
+                # the bodies of itself and the WITH names after it
+                definitions, skip = self.extract_with(statement)
+                names = []
+                for name, body in definitions:
+                    names.append(name)
+                    stream = self.extract_from_part(body)
+                    extracted_tables.append(self.drop_names(list(
+                        self.extract_table_identifiers(stream)), names))
+                stream = self.extract_from_part(statement, skip)
+                extracted_tables.append(self.drop_names(list(
+                    self.extract_table_identifiers(stream)), names))
         tables = list(itertools.chain(*extracted_tables))
 
         for idx, _ in enumerate(tables):
             tables[idx] = tables[idx].split()[0]
 
         return tables
+
+
+    def drop_names(self, tables, names):
+        return [table for table in tables if table.split()[0] not in names]
@@ -4,6 +4,7 @@
 
 
 import os
+import re
 import sys
 import fcntl
 
@@ -12,9 +13,12 @@ import logging
 import datetime
 import time
 import signal
+import resource
 
 import cgi
+import hashlib
 import tempfile
+import email.utils
 
 import xmltodict
 from bs4 import BeautifulSoup
@@ -27,6 +31,14 @@ from TAP.runquery import runQuery
 from TAP.configparam import configParam
 from TAP.propfilter import propFilter
 from TAP.tablenames import TableNames
+from TAP.tablemap import tableMap
+from TAP.writeresult import writeResult
+from TAP.resultcache import resultCache, result_key
+from TAP.dataversion import dataVersion
+from TAP.vosi import vosiDocument
+from TAP.tapschema import tapSchema
+from TAP.conesearch import coneSearch
+from TAP.upload import tapUpload, save_uploads, upload_table
 
 
 class Tap:
@@ -136,6 +148,12 @@ class Tap:
 
     query = ''
 
+    conesearch = 0
+    coneparam = {}
+
+    uploadstr = ''
+    upload = None
+
 
     def __init__(self, **kwargs):
 
@@ -190,7 +208,8 @@ class Tap:
         for key in self.form:
 
             if self.debug:
-                logging.debug(f'      key: {key:<15}   val: {self.form[key].value:s}')
+                logging.debug(f'      key: {key:<15}   val: '
+                              f'{str(self.form[key].value):s}')
 
             if(key.lower() == 'propflag'):
                 self.propflag = int(self.form[key].value)
@@ -218,6 +237,12 @@ class Tap:
 
                 self.maxrecstr = self.form[key].value
 
+            if(key.lower() in ['table', 'ra', 'dec', 'sr']):
+                self.coneparam[key.lower()] = self.form[key].value.strip()
+
+            if(key.lower() == 'upload'):
+                self.uploadstr = self.form[key].value.strip()
+
         self.nparam = len(self.param)
 
         self.format = self.param['format'].lower()
@@ -291,6 +316,9 @@ class Tap:
             self.tapcontext = 'async'
         elif(arr[0] == "sync"):
             self.tapcontext = 'sync'
+        elif(arr[0] == "cone"):
+            self.tapcontext = 'sync'
+            self.conesearch = 1
 
         if(narr > 1):
 
@@ -370,6 +398,12 @@ class Tap:
         self.cgipgm  = self.config.cgipgm
 
         self.arraysize = self.config.arraysize
+        self.nworker = self.config.nworker
+        self.prefetch = self.config.prefetch
+        self.arraysize_max = self.config.arraysize_max
+        self.numwidth = self.config.numwidth
+        self.nsample = self.config.nsample
+        self.memory_budget = self.config.memory_budget
 
         self.cookiename = self.config.cookiename
 
@@ -380,6 +414,11 @@ class Tap:
             logging.debug(f'httpurl    = {self.httpurl:s}')
             logging.debug(f'cgipgm     = {self.cgipgm:s}')
             logging.debug(f'arraysize  = {self.arraysize:d}')
+            logging.debug(f'nworker    = {self.nworker:d}')
+            logging.debug(f'prefetch   = {self.prefetch:d}')
+            logging.debug(f'numwidth   = {self.numwidth:d}')
+            logging.debug(f'nsample    = {self.nsample:d}')
+            logging.debug(f'memory_budget = {self.memory_budget:d}')
             logging.debug(f'cookiename = {self.cookiename:s}')
             logging.debug(f'fileid     = {self.config.fileid:s}')
             logging.debug(f'accessid   = {self.config.accessid:s}')
@@ -388,6 +427,16 @@ class Tap:
             logging.debug(f'propfilter = {self.config.propfilter:s}')
             logging.debug(f'phase      = {self.param["phase"]:s}')
 
+        #
+        # VOSI resources (tables, capabilities, availability): served
+        # from the cached documents, without a workspace
+        #
+
+        if(arr[0] in vosiDocument.resources):
+
+            self.__printVosi__(arr[0])
+            sys.exit()
+
         #
         # Initialize statdict dict
         #
@@ -526,6 +575,30 @@ class Tap:
             logging.debug(f'resultpath  = {self.resultpath:s}')
             logging.debug(f'resulturl   = {self.resulturl:s}')
 
+        #
+        # Uploaded tables (UPLOAD) are saved in the job directory, where
+        # the query finds them when it runs
+        #
+
+        if(len(self.uploadstr) > 0):
+
+            try:
+                save_uploads(self.uploadstr, self.form, self.userWorkdir)
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'save_uploads exception: {str(e):s}')
+
+                if(self.tapcontext == 'async'):
+
+                    self.phase = 'ERROR'
+                    self.__writeAsyncError__(str(e), self.statuspath,
+                                             self.statdict, self.param)
+                else:
+                    self.__printError__(self.format, str(e))
+
         #
         # If async and phase == PENDING: send 303 with statusurl and exit
         #
@@ -757,7 +830,7 @@ class Tap:
         #   if query is blank, return error
         #
 
-        if(len(self.param['query']) == 0):
+        if((len(self.param['query']) == 0) and (self.conesearch == 0)):
 
             self.msg = "Input 'query' is blank."
 
@@ -780,83 +853,187 @@ class Tap:
             logging.debug('')
             logging.debug(f'ADQL query: {query_adql:s}\n')
 
-        try:
-            mode = SpatialIndex.HTM
+        #
+        # Queries on TAP_SCHEMA tables only are run on the local copy of
+        # TAP_SCHEMA (TAP_SCHEMA_CACHE), without going to the DBMS.  Only
+        # the connection changes: the ADQL translation, data dictionary
+        # and result writing below are the same as for any query.
+        #
 
-            if(self.config.adqlparam['mode'] == 'HPX'):
-                mode = SpatialIndex.HPX
+        self.connectInfo = self.config.connectInfo
 
-            level   = int(self.config.adqlparam['level'])
-            colname = self.config.adqlparam['colname']
+        if(self.config.tapschema_cache > 0):
 
-            encoding = SpatialIndex.BASE4
-            if(self.config.adqlparam['encoding'] == 'BASE10'):
-                encoding = SpatialIndex.BASE10
+            try:
+                tables = TableNames().extract_tables(query_adql)
 
-            racol = self.config.racol
-            deccol = self.config.deccol
+                if((len(tables) > 0) and
+                   all([tbl.startswith('tap_schema.') for tbl in tables])):
 
-            xcol = self.config.adqlparam['xcol']
-            ycol = self.config.adqlparam['ycol']
-            zcol = self.config.adqlparam['zcol']
+                    schema = tapSchema(self.config.connectInfo,
+                                       self.config.cachedir,
+                                       version=self.__schemaVersion__(),
+                                       ttl=self.config.tapschema_cache,
+                                       debug=self.debug)
 
-            if self.debug:
-                logging.debug(f'mode     = {mode:d}')
-                logging.debug(f'level    = {level:d}')
-                logging.debug(f'colname  = {colname:s}')
-                logging.debug(f'encoding = {encoding:d}')
-                logging.debug(f'racol    = {racol:s}')
-                logging.debug(f'deccol   = {deccol:s}')
-                logging.debug(f'xcol     = {xcol:s}')
-                logging.debug(f'ycol     = {ycol:s}')
-                logging.debug(f'zcol     = {zcol:s}')
+                    self.connectInfo = schema.connectInfo
 
+            except Exception as e:
 
-            dbms = self.config.connectInfo['dbms']
+                #
+                # The query still runs on the DBMS
+                #
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'dbms = {dbms:s}')
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'tapSchema exception: {str(e):s}')
 
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'connectInfo db: '
+                          f'{self.connectInfo.get("db", ""):s}')
 
-            adql = ADQL(dbms=dbms, mode=mode, level=level, indxcol=colname,
-                        encoding=encoding, racol=racol, deccol=deccol,
-                        xcol=xcol, ycol=ycol, zcol=zcol)
+        #
+        # Uploaded tables: read here, loaded by runQuery or propFilter
+        # into their DBMS session
+        #
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'ADQL initialized')
+        if os.path.exists(self.userWorkdir + '/upload/upload.json'):
 
+            try:
+                self.upload = tapUpload(self.userWorkdir,
+                                        maxrows=self.config.upload_maxrows,
+                                        debug=self.debug)
 
-            self.query = adql.sql(query_adql)
+            except Exception as e:
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'Query to DBMS: {self.query:s}')
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'tapUpload exception: {str(e):s}')
 
-        except Exception as e:
+                if(self.tapcontext == 'async'):
 
-            if self.debug:
-                logging.debug('')
-                logging.debug(f'ADQL exception: {str(e):s}')
+                    self.phase = 'ERROR'
+                    self.__writeAsyncError__(str(e), self.statuspath,
+                                             self.statdict, self.param)
+                else:
+                    self.__printError__(self.format, str(e))
 
-            if(self.tapcontext == 'async'):
+        if self.conesearch:
+
+            #
+            # Cone search (TABLE, RA, DEC, SR): the SQL is made directly,
+            # with the cached and coalesced index ranges of the cone
+            #
+
+            try:
+                self.query = self.__coneQuery__()
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'coneSearch exception: {str(e):s}')
 
-                self.phase = 'ERROR'
-                self.__writeAsyncError__(str(e), self.statuspath,
-                                         self.statdict, self.param)
-            else:
                 self.__printError__(self.format, str(e))
 
+        else:
+            try:
+                mode = SpatialIndex.HTM
+
+                if(self.config.adqlparam['mode'] == 'HPX'):
+                    mode = SpatialIndex.HPX
+
+                level   = int(self.config.adqlparam['level'])
+                colname = self.config.adqlparam['colname']
+
+                encoding = SpatialIndex.BASE4
+                if(self.config.adqlparam['encoding'] == 'BASE10'):
+                    encoding = SpatialIndex.BASE10
+
+                racol = self.config.racol
+                deccol = self.config.deccol
+
+                xcol = self.config.adqlparam['xcol']
+                ycol = self.config.adqlparam['ycol']
+                zcol = self.config.adqlparam['zcol']
+
+                if self.debug:
+                    logging.debug(f'mode     = {mode:d}')
+                    logging.debug(f'level    = {level:d}')
+                    logging.debug(f'colname  = {colname:s}')
+                    logging.debug(f'encoding = {encoding:d}')
+                    logging.debug(f'racol    = {racol:s}')
+                    logging.debug(f'deccol   = {deccol:s}')
+                    logging.debug(f'xcol     = {xcol:s}')
+                    logging.debug(f'ycol     = {ycol:s}')
+                    logging.debug(f'zcol     = {zcol:s}')
+
+                #
+                # Crossmatches with uploaded tables are made index range
+                # joins before the translation
+                #
+
+                if self.upload is not None:
+
+                    query_adql = self.upload.crossmatch(
+                        query_adql, mode=mode, level=level, colname=colname,
+                        encoding=encoding, xcol=xcol, ycol=ycol, zcol=zcol,
+                        maxranges=self.config.xmatch_maxranges)
+
+
+                dbms = self.connectInfo['dbms']
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'dbms = {dbms:s}')
+
+
+                adql = ADQL(dbms=dbms, mode=mode, level=level, indxcol=colname,
+                            encoding=encoding, racol=racol, deccol=deccol,
+                            xcol=xcol, ycol=ycol, zcol=zcol)
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'ADQL initialized')
+
+
+                self.query = adql.sql(query_adql)
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'Query to DBMS: {self.query:s}')
+
+            except Exception as e:
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'ADQL exception: {str(e):s}')
+
+                if(self.tapcontext == 'async'):
+
+                    self.phase = 'ERROR'
+                    self.__writeAsyncError__(str(e), self.statuspath,
+                                             self.statdict, self.param)
+                else:
+                    self.__printError__(self.format, str(e))
+
         #
         # Extract DB table name from query(This will be replaced with a library
         # parser
         #
 
         self.dbtable = ''
+        tables = []
         try:
             tn = TableNames()
             tables = tn.extract_tables(self.query)
+
+            #
+            # The first table that is not an uploaded one, if any
+            #
+
+            tables = [tbl for tbl in tables if not upload_table(tbl)] or tables
             self.dbtable = tables[0]
 
         except Exception as e:
@@ -883,6 +1060,34 @@ class Tap:
 
         self.datalevel = self.__getDatalevel__(self.dbtable)
 
+        #
+        # Data version of dbtable (looked up at most once per
+        # DATA_VERSION_INTERVAL), part of the result cache keys so that
+        # a reload is seen right away
+        #
+
+        self.dataversion = ''
+
+        if(len(self.config.dataversion) > 0):
+
+            dv = dataVersion(self.config.connectInfo, self.dbtable,
+                             mode=self.config.dataversion,
+                             sql=self.config.dataversion_sql,
+                             column=self.config.dataversion_col,
+                             interval=self.config.dataversion_interval,
+                             cachedir=self.config.cachedir,
+                             debug=self.debug)
+
+            self.dataversion = dv.version
+
+        #
+        # The results of a query with uploaded tables depend on them
+        #
+
+        if self.upload is not None:
+            self.dataversion = self.dataversion + '|upload:' + \
+                self.upload.digest
+
         if self.debug:
             logging.debug('')
             logging.debug(f'datalevel = [{self.datalevel:s}]')
@@ -891,33 +1096,41 @@ class Tap:
         # Determine whether to use runQuery or propFilter to execute SQL
         #
 
+        # Every table in the query counts (not only dbtable): a join with
+        # a proprietary table is filtered whichever table comes first
+        #
+
+        dbtables = [tbl for tbl in tables
+                    if (tbl.lower().find('tap_schema') == -1)
+                    and not upload_table(tbl)]
+
         if(self.propflag == -1):
 
-            if((self.config.propfilter.lower() == 'koa')
-                or ((self.config.propfilter.lower() == 'neid')
-                    and (self.datalevel != 'l0'))):
-                self.propflag = 1
-            else:
-                self.propflag = 0
+            self.propflag = 0
+
+            for tbl in dbtables:
+
+                if((self.config.propfilter.lower() == 'koa')
+                    or ((self.config.propfilter.lower() == 'neid')
+                        and (self.__getDatalevel__(tbl) != 'l0'))):
+                    self.propflag = 1
 
         #
-        # Check if dbtable is tap_schema tables
+        # Queries on tap_schema and uploaded tables only are not filtered
         #
 
-        ind = self.dbtable.lower().find('tap_schema')
-
-        if(ind != -1):
+        if(len(dbtables) == 0):
             self.propflag = 0
 
             if self.debug:
                 logging.debug('')
-                logging.debug('tap_schema table queries: set propflag to 0')
+                logging.debug('tap_schema and uploaded table queries: '
+                              'set propflag to 0')
 
         if self.debug:
             logging.debug('')
             logging.debug(f'propflag = [{self.propflag:d}]')
 
-        dbquery = None
         propfilter = None
 
         #
@@ -934,18 +1147,10 @@ class Tap:
 
             try:
 
-                dbquery = runQuery(connectInfo=self.config.connectInfo,
-                                   query=self.query,
-                                   workdir=self.userWorkdir,
-                                   format=self.format,
-                                   maxrec=self.maxrec,
-                                   arraysize=self.arraysize,
-                                   racol=self.config.racol,
-                                   deccol=self.config.deccol,
-                                   debug=self.debug)
+                result = self.__runQuery__()
 
                 self.phase = 'COMPLETED'
-                self.ntot = dbquery.ntot
+                self.ntot = result['ntot']
 
             except Exception as e:
 
@@ -988,9 +1193,30 @@ class Tap:
                                         accesstbl=self.config.accesstbl,
                                         fileid=self.config.fileid,
                                         accessid=self.config.accessid,
+                                        cachedir=self.config.cachedir,
+                                        access_ttl=self.config.access_ttl,
+                                        session_ttl=self.config.session_ttl,
+                                        fileidtbl=self.config.fileidtbl,
+                                        releasecol=self.config.releasecol,
+                                        tablemap=self.config.tablemap,
+                                        public_cache=self.config \
+                                                        .public_cache,
+                                        result_cache=self.config \
+                                                        .result_cache,
+                                        result_ttl=self.config.result_ttl,
+                                        single_flight=self.config \
+                                                        .single_flight,
+                                        dataversion=self.dataversion,
+                                        upload=self.upload,
                                         format=self.format,
                                         maxrec=self.maxrec,
                                         arraysize=self.arraysize,
+                                        nworker=self.nworker,
+                                        prefetch=self.prefetch,
+                                        arraysize_max=self.arraysize_max,
+                                        numwidth=self.numwidth,
+                                        nsample=self.nsample,
+                                        memory_budget=self.memory_budget,
                                         debug=self.debug)
 
 
@@ -1047,6 +1273,14 @@ class Tap:
             self.statdict['phase'] = self.phase
             self.statdict['errmsg'] = self.errmsg
 
+            #
+            # Job metrics: rows written and peak RSS (KB) of this process
+            #
+
+            self.statdict['ntot'] = self.ntot
+            self.statdict['maxrss'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
             self.__writeStatusMsg__(self.statuspath, self.statdict, self.param)
 
         else:
@@ -1201,55 +1435,53 @@ class Tap:
         #
 
         #
-        # Header
+        # The document is built first: its length and ETag go in the header
         #
 
-        print("HTTP/1.1 200 OK\r")
+        lines = []
 
         if(outtype == 'xml'):
 
-            print("Content-type: text/xml\r")
-            print("\r")
-
-            print('<?xml version="1.0" encoding="UTF-8"?>')
-            print('<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0"'
-                  ' xmlns:xlink="http://www.w3.org/1999/xlink"'
-                  ' xmlns:xs="http://www.w3.org/2001/XMLSchema"'
-                  ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
-                  ' xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0">')
+            lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+            lines.append('<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0"'
+                         ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+                         ' xmlns:xs="http://www.w3.org/2001/XMLSchema"'
+                         ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+                         ' xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0">')
 
             if((key == 'errorSummary')
                     or (key == 'errmsg')
                     or (key == 'error')):
 
                 if(len(retval) == 0):
-                    print('    <uws:errorSummary></uws:errorSummary>')
+                    lines.append('    <uws:errorSummary></uws:errorSummary>')
                 else:
-                    print('    <uws:errorSummary>')
-                    print(retval)
-                    print('    </uws:errorSummary>')
+                    lines.append('    <uws:errorSummary>')
+                    lines.append(str(retval))
+                    lines.append('    </uws:errorSummary>')
 
             elif(key == 'parameters'):
 
-                print(retval)
+                lines.append(str(retval))
 
             elif((key == 'results') or (key == 'results/resulturl')):
 
-                print('    <uws:results>')
-                print(retval)
-                print('    </uws:results>')
+                lines.append('    <uws:results>')
+                lines.append(str(retval))
+                lines.append('    </uws:results>')
 
-            print('</uws:job>')
-            sys.stdout.flush()
+            lines.append('</uws:job>')
+
+            ctype = 'text/xml'
 
         else:
-            print("Content-type: text/plain\r")
-            print("\r")
+            lines.append(str(retval))
 
-            print(retval)
-            sys.stdout.flush()
+            ctype = 'text/plain'
 
-        sys.stdout.flush()
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        self.__printResponse__(data, ctype, cache='private, no-cache')
 
         if self.debug:
             logging.debug('Write status to user and exit.')
@@ -1296,10 +1528,24 @@ class Tap:
 
         if(len(key) == 0):
 
-            print("HTTP/1.1 200 OK\r")
-            print("Content-type: text/xml\r")
-            print("\r")
-            print(data)
+            #
+            # Until the phase is final the status file can be rewritten
+            # within the second of its Last-Modified: it is revalidated
+            # by its ETag only, so a poll never gets a stale phase
+            #
+
+            mtime = None
+            try:
+                phase = self.__getStatusJob__(data)['uws:phase']
+
+                if(phase in ['COMPLETED', 'ERROR', 'ABORTED']):
+                    mtime = os.stat(self.statuspath).st_mtime
+
+            except Exception as e:
+                pass
+
+            self.__printResponse__((data + '\n').encode('utf-8'), 'text/xml',
+                                   cache='private, no-cache', mtime=mtime)
             sys.exit()
 
         #
@@ -1535,50 +1781,49 @@ class Tap:
             logging.debug('')
             logging.debug(f'resultpath = {resultpath:s}')
 
-        fp = None
-        try:
-            fp = open(resultpath, 'r')
-        except Exception as e:
-            msg = 'Failed to open result file: ' + resultpath
-            if(self.tapcontext == 'async'):
-                
-                self.phase = 'ERROR'
-                self.__writeAsyncError__(msg, self.statuspath,
-                                         self.statdict, self.param)
-            else: 
-                self.__printError__(format, msg)
+        #
+        # A completed result does not change until the job is destroyed:
+        # clients and proxies may keep it (private: it may hold
+        # proprietary data) and revalidate it with If-None-Match
+        #
 
-        print("HTTP/1.1 200 OK\r")
-
-        if(format == 'json'):
-            print("Content-type: application/json\r")
-        elif(format == 'votable'):
-            print("Content-type: text/xml\r")
-        else:
-            print("Content-type: text/plain\r")
-        print("\r")
+        maxage = 86400
 
         try:
-            while True:
+            destruction = datetime.datetime.fromisoformat(
+                job['uws:destruction'])
 
-                line = fp.readline()
+            maxage = int((destruction - datetime.datetime.now())
+                         .total_seconds())
 
-                if not line:
-                    break
+            if(maxage < 0):
+                maxage = 0
+
+        except Exception as e:
+            pass
 
-                sys.stdout.write(line)
-                sys.stdout.flush()
+        #
+        # Byte ranges let a client resume a dropped download
+        #
+
+        try:
+            self.__printFile__(resultpath, self.__contentType__(format),
+                               cache=f'private, max-age={maxage:d}',
+                               ranges=1)
 
         except Exception as e:
+
+            msg = 'Failed to return result file: ' + resultpath + \
+                ': ' + str(e)
+
             if(self.tapcontext == 'async'):
-                
+
                 self.phase = 'ERROR'
-                self.__writeAsyncError__(str(e), self.statuspath,
+                self.__writeAsyncError__(msg, self.statuspath,
                                          self.statdict, self.param)
-            else: 
-                self.__printError__(format, str(e))
+            else:
+                self.__printError__(format, msg)
 
-        fp.close()
         sys.exit()
 
         #
@@ -1680,47 +1925,439 @@ class Tap:
             logging.debug(f'resultpath = {resultpath:s}')
             logging.debug(f'format     = [{format:s}]\n')
 
-            logging.debug('Output lines:')
-            logging.debug('-------------------------------------------------')
-
-        print("HTTP/1.1 200 OK\r")
+        #
+        # A result served from the result cache is a link to the cached
+        # file, so a repeated query gets the same ETag and a client holding
+        # the result gets a 304
+        #
 
-        fp = None
         try:
-            fp = open(resultpath, 'r')
-        except IOError:
-            msg = 'Failed to open result file.'
-            self.__printError__(msg)
+            self.__printFile__(resultpath, self.__contentType__(format),
+                               cache='private, no-cache')
+
+        except Exception as e:
+
+            msg = 'Failed to return result file: ' + str(e)
+            self.__printError__(format, msg)
+
+        return
+
+        #
+        # }  end of printSyncResult
+        #
+
+
+    def __contentType__(self, format, **kwargs):
 
         if(format == 'json'):
-            print("Content-type: application/json\r")
+            return('application/json')
+
         elif(format == 'votable'):
-            print("Content-type: text/xml\r")
-        else:
-            print("Content-type: text/plain\r")
-        print("\r")
+            return('text/xml')
+
+        return('text/plain')
+
+
+    def __notModified__(self, etag, mtime, **kwargs):
+
+        # Conditional GET: If-None-Match (which takes precedence) against
+        # the ETag, otherwise If-Modified-Since against the mtime
+        #
+
+        inm = os.getenv('HTTP_IF_NONE_MATCH', default='')
+
+        if(len(inm) > 0):
+
+            etags = [tag.strip() for tag in inm.split(',')]
+
+            return((etag in etags) or ('W/' + etag in etags)
+                   or ('*' in etags))
+
+        ims = os.getenv('HTTP_IF_MODIFIED_SINCE', default='')
+
+        if((len(ims) > 0) and (mtime is not None)):
+
+            try:
+                since = email.utils.parsedate_to_datetime(ims).timestamp()
+
+                return(int(mtime) <= since)
+
+            except Exception as e:
+                pass
+
+        return(False)
 
-        while True:
 
-            line = fp.readline()
+    def __getRanges__(self, size, etag, mtime, **kwargs):
+
+        #
+        # {
+        #
+
+        # Byte ranges of a Range header as (first, last) pairs, sorted and
+        # merged; None to send the whole file (no or unusable Range, or an
+        # If-Range that no longer matches), an empty list if none of the
+        # ranges is satisfiable
+        #
+
+        rangestr = os.getenv('HTTP_RANGE', default='').strip()
+
+        if(rangestr[:6].lower() != 'bytes='):
+            return(None)
+
+        ifrange = os.getenv('HTTP_IF_RANGE', default='').strip()
+
+        if(len(ifrange) > 0):
+
+            if(ifrange[:1] == '"'):
+                if(ifrange != etag):
+                    return(None)
+
+            else:
+                try:
+                    since = email.utils.parsedate_to_datetime(ifrange) \
+                        .timestamp()
+
+                    if(int(mtime) > since):
+                        return(None)
+
+                except Exception as e:
+                    return(None)
+
+        spans = []
+
+        for spec in rangestr[6:].split(','):
+
+            spec = spec.strip()
+
+            if('-' not in spec):
+                return(None)
+
+            (first, last) = spec.split('-', 1)
+
+            try:
+                if(len(first) == 0):
+
+                    #
+                    # Suffix: the last bytes of the file
+                    #
+
+                    nbyte = int(last)
+
+                    if(nbyte <= 0):
+                        continue
+
+                    start = max(size - nbyte, 0)
+                    end = size - 1
+
+                else:
+                    start = int(first)
+
+                    end = size - 1
+
+                    if(len(last) > 0):
+
+                        #
+                        # last < first is invalid: the header is ignored
+                        #
+
+                        if(int(last) < start):
+                            return(None)
+
+                        end = min(int(last), size - 1)
+
+            except Exception as e:
+                return(None)
+
+            if((start >= size) or (end < start)):
+                continue
+
+            spans.append((start, end))
+
+        spans.sort()
+
+        merged = []
+        for (start, end) in spans:
+
+            if((len(merged) > 0) and (start <= merged[-1][1] + 1)):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        return(merged)
+
+        #
+        # } end of getRanges def
+        #
+
+
+    def __sendFile__(self, fp, offset, count, **kwargs):
+
+        # Copy count bytes of the file from offset to stdout with
+        # os.sendfile (no copy through Python); plain reads and writes
+        # where stdout does not support it
+        #
+
+        sys.stdout.flush()
+        sys.stdout.buffer.flush()
+
+        outfd = sys.stdout.fileno()
+        infd = fp.fileno()
+
+        try:
+            while(count > 0):
+
+                nsent = os.sendfile(outfd, infd, offset, min(count, 1 << 30))
+
+                if(nsent == 0):
+                    break
+
+                offset = offset + nsent
+                count = count - nsent
+
+            return
+
+        except OSError as e:
 
             if self.debug:
-                logging.debug(f'[{line:s}]')
+                logging.debug('')
+                logging.debug(f'sendfile: {str(e):s}; copying')
 
-            if not line:
+        fp.seek(offset)
+
+        while(count > 0):
+
+            data = fp.read(min(count, 1048576))
+            if not data:
                 break
 
-            sys.stdout.write(line)
-            sys.stdout.flush()
+            sys.stdout.buffer.write(data)
+            count = count - len(data)
 
-        if self.debug:
-            logging.debug('-------------------------------------------------')
+        sys.stdout.buffer.flush()
 
-        fp.close()
-        return
+
+    def __printHeader__(self, status, ctype, **kwargs):
 
         #
-        # }  end of printSyncResult
+        # {
+        #
+
+        length = None
+        if('length' in kwargs):
+            length = kwargs['length']
+
+        etag = ''
+        if('etag' in kwargs):
+            etag = kwargs['etag']
+
+        mtime = None
+        if('mtime' in kwargs):
+            mtime = kwargs['mtime']
+
+        cache = ''
+        if('cache' in kwargs):
+            cache = kwargs['cache']
+
+        ranges = 0
+        if('ranges' in kwargs):
+            ranges = kwargs['ranges']
+
+        crange = ''
+        if('crange' in kwargs):
+            crange = kwargs['crange']
+
+        print("HTTP/1.1 %s\r" % status)
+
+        if(status[:3] != '304'):
+            print("Content-type: %s\r" % ctype)
+
+            if length is not None:
+                print("Content-Length: %d\r" % length)
+
+        if(len(crange) > 0):
+            print("Content-Range: %s\r" % crange)
+
+        if ranges:
+            print("Accept-Ranges: bytes\r")
+
+        if(len(etag) > 0):
+            print("ETag: %s\r" % etag)
+
+        if mtime is not None:
+            print("Last-Modified: %s\r" %
+                  email.utils.formatdate(mtime, usegmt=True))
+
+        if(len(cache) > 0):
+            print("Cache-Control: %s\r" % cache)
+
+        print("\r")
+
+        sys.stdout.flush()
+
+        #
+        # } end of printHeader def
+        #
+
+
+    def __printResponse__(self, data, ctype, **kwargs):
+
+        #
+        # {
+        #
+
+        # Small response (bytes) with its length and an ETag made from
+        # its content, or a 304 if the client has it
+        #
+
+        etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+        if('etag' in kwargs):
+            etag = kwargs['etag']
+
+        mtime = None
+        if('mtime' in kwargs):
+            mtime = kwargs['mtime']
+
+        cache = ''
+        if('cache' in kwargs):
+            cache = kwargs['cache']
+
+        if self.__notModified__(etag, mtime):
+
+            self.__printHeader__('304 Not Modified', ctype, etag=etag,
+                                 mtime=mtime, cache=cache)
+            return
+
+        self.__printHeader__('200 OK', ctype, length=len(data), etag=etag,
+                             mtime=mtime, cache=cache)
+
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+        #
+        # } end of printResponse def
+        #
+
+
+    def __printFile__(self, path, ctype, **kwargs):
+
+        #
+        # {
+        #
+
+        # Result file with its length and an ETag made from the file's
+        # inode, size and mtime (no need to read a large file to make it),
+        # or a 304 if the client has it.  With ranges, a Range request
+        # (If-Range: only while the file is unchanged) gets a 206 with the
+        # requested bytes: one range as is, several as multipart/byteranges.
+        #
+
+        cache = ''
+        if('cache' in kwargs):
+            cache = kwargs['cache']
+
+        ranges = 0
+        if('ranges' in kwargs):
+            ranges = kwargs['ranges']
+
+        fp = open(path, 'rb')
+
+        try:
+            stat = os.fstat(fp.fileno())
+            size = stat.st_size
+
+            etag = f'"{stat.st_ino:x}-{stat.st_size:x}-' \
+                   f'{stat.st_mtime_ns:x}"'
+
+            header = {'etag': etag, 'mtime': stat.st_mtime, 'cache': cache,
+                      'ranges': ranges}
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'printFile: {path:s} etag= {etag:s} '
+                              f'size= {size:d}')
+
+            if self.__notModified__(etag, stat.st_mtime):
+
+                self.__printHeader__('304 Not Modified', ctype, **header)
+                return
+
+            spans = None
+
+            if ranges:
+                spans = self.__getRanges__(size, etag, stat.st_mtime)
+
+            if self.debug:
+                logging.debug(f'printFile: ranges= {str(spans):s}')
+
+            if spans is None:
+
+                self.__printHeader__('200 OK', ctype, length=size, **header)
+                self.__sendFile__(fp, 0, size)
+
+            elif(len(spans) == 0):
+
+                self.__printHeader__('416 Range Not Satisfiable', ctype,
+                                     length=0, crange=f'bytes */{size:d}',
+                                     **header)
+
+            elif(len(spans) == 1):
+
+                (start, end) = spans[0]
+
+                self.__printHeader__('206 Partial Content', ctype,
+                                     length=end-start+1,
+                                     crange=f'bytes {start:d}-{end:d}/'
+                                            f'{size:d}',
+                                     **header)
+
+                self.__sendFile__(fp, start, end-start+1)
+
+            else:
+
+                #
+                # multipart/byteranges: the part headers are known up
+                # front, so is the total length
+                #
+
+                boundary = hashlib.sha256(
+                    (etag + str(spans)).encode('utf-8')).hexdigest()[:24]
+
+                parts = []
+                for (start, end) in spans:
+
+                    parts.append(('\r\n--' + boundary + '\r\n' +
+                                  'Content-type: ' + ctype + '\r\n' +
+                                  f'Content-Range: bytes {start:d}-{end:d}/'
+                                  f'{size:d}\r\n\r\n').encode('utf-8'))
+
+                closing = ('\r\n--' + boundary + '--\r\n').encode('utf-8')
+
+                length = len(closing)
+                for k in range(len(spans)):
+                    length = length + len(parts[k]) + \
+                        spans[k][1] - spans[k][0] + 1
+
+                self.__printHeader__('206 Partial Content',
+                                     'multipart/byteranges; boundary=' +
+                                     boundary, length=length, **header)
+
+                for k in range(len(spans)):
+
+                    sys.stdout.buffer.write(parts[k])
+                    sys.stdout.buffer.flush()
+
+                    (start, end) = spans[k]
+                    self.__sendFile__(fp, start, end-start+1)
+
+                sys.stdout.buffer.write(closing)
+                sys.stdout.buffer.flush()
+
+        finally:
+            fp.close()
+
+        #
+        # } end of printFile def
         #
 
 
@@ -1900,6 +2537,14 @@ class Tap:
                      f' xlink:href="{resulturl:s}"/>\n')
             fp.write('    </uws:results>\n')
 
+            if('maxrss' in statdict):
+
+                fp.write('    <uws:jobInfo>\n')
+                fp.write(f"        <nrec>{statdict['ntot']:d}</nrec>\n")
+                fp.write(f"        <peakRSS unit=\"KB\">{statdict['maxrss']:d}"
+                         "</peakRSS>\n")
+                fp.write('    </uws:jobInfo>\n')
+
         elif(phase.lower() == 'error'):
 
             fp.write('    <uws:errorSummary type="transient" hasDetail="true">\n')
@@ -1922,34 +2567,219 @@ class Tap:
         #
 
 
-    def __getDatalevel__(self, dbtable, **kwargs):
+    def __runQuery__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # Run the query (without proprietary filtering) through runQuery;
+        # with RESULT_CACHE the result file is shared through the result
+        # cache, keyed by the normalized SQL and output settings, so that
+        # a repeated query is served without going to the DBMS.  With
+        # SINGLE_FLIGHT only concurrent identical queries are coalesced:
+        # the first one runs, the others wait for it and share its result.
+        #
+
+        def runner():
+
+            dbquery = runQuery(connectInfo=self.connectInfo,
+                               query=self.query,
+                               workdir=self.userWorkdir,
+                               format=self.format,
+                               maxrec=self.maxrec,
+                               arraysize=self.arraysize,
+                               nworker=self.nworker,
+                               prefetch=self.prefetch,
+                               arraysize_max=self.arraysize_max,
+                               numwidth=self.numwidth,
+                               nsample=self.nsample,
+                               memory_budget=self.memory_budget,
+                               racol=self.config.racol,
+                               deccol=self.config.deccol,
+                               upload=self.upload,
+                               nproc=self.config.parallel_scan,
+                               minrows=self.config.parallel_minrows,
+                               indxcol=self.config.adqlparam['colname'],
+                               debug=self.debug)
+
+            return({'outpath': dbquery.outpath, 'ntot': dbquery.ntot})
+
+        ttl = self.config.result_ttl
+        cachename = 'results'
+
+        if(self.config.result_cache <= 0):
+            ttl = self.config.single_flight
+            cachename = 'flight'
+
+        if((ttl <= 0) or (self.format not in writeResult.resulttbls)):
+            return(runner())
+
+        key = result_key('all', self.connectInfo['dbms'], self.format,
+                         self.maxrec, 0, self.query, version=self.dataversion)
+
+        outpath = self.userWorkdir + '/' + writeResult.resulttbls[self.format]
+
+        rcache = resultCache(self.config.cachedir, cachename,
+                             budget=self.config.result_cache,
+                             prune=int(cachename == 'flight'),
+                             debug=self.debug)
+
+        result = rcache.run(key, outpath, runner, ttl=ttl)
 
         if self.debug:
-            logging.debug(f'dbtable   = {dbtable:s}')
+            logging.debug('')
+            logging.debug(f'runQuery result: {result["ntot"]:d} rows, '
+                          f'cache hit: {rcache.nhit:d}')
 
-        level = ["l0",
-                 "l1",
-                 "l2",
-                 "eng"]
+        return(result)
 
-        nlevel = len(level)
+        #
+        # } end of runQuery def
+        #
+
+
+    def __printVosi__(self, resource, **kwargs):
+
+        #
+        # {
+        #
+
+        # The documents are rendered once per TAP_SCHEMA version (see
+        # DATA_VERSION) and revalidated by the clients with If-None-Match
+        #
+
+        version = self.__schemaVersion__()
+
+        try:
+            doc = vosiDocument(self.config.connectInfo, resource,
+                               baseurl=self.httpurl + '/' + self.cgipgm,
+                               cachedir=self.config.cachedir,
+                               version=version,
+                               ttl=self.config.vosi_ttl,
+                               debug=self.debug)
+
+            with open(doc.path, 'rb') as fp:
+                data = fp.read()
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'vosiDocument exception: {str(e):s}')
+
+            self.__printError__('votable', str(e))
 
         if self.debug:
-            logging.debug(f'nlevel    = {nlevel:d}')
+            logging.debug('')
+            logging.debug(f'VOSI {resource:s}: etag= {doc.etag:s}')
 
-        datalevel = ''
-        for i in range(nlevel):
+        self.__printResponse__(data, 'text/xml', etag=doc.etag,
+                               mtime=doc.mtime, cache='no-cache')
 
-            dbtable_lower = dbtable.lower()
+        return
 
-            ind = dbtable_lower.find(level[i])
+        #
+        # } end of printVosi def
+        #
 
-            if(ind != -1):
-                datalevel = level[i]
-                break
+
+    def __coneQuery__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        for key in ['table', 'ra', 'dec', 'sr']:
+
+            if(key not in self.coneparam):
+                self.msg = 'Cone search requires TABLE, RA, DEC and SR.'
+                raise Exception(self.msg)
+
+        table = self.coneparam['table']
+
+        #
+        # The table name goes into the SQL as is: only plain
+        # (schema qualified) names are accepted
+        #
+
+        if(re.fullmatch(r'[A-Za-z_][A-Za-z0-9_$]*(\.[A-Za-z_][A-Za-z0-9_$]*)?',
+                        table) is None):
+
+            self.msg = 'Invalid cone search TABLE [' + table + ']'
+            raise Exception(self.msg)
+
+        try:
+            ra = float(self.coneparam['ra'])
+            dec = float(self.coneparam['dec'])
+            sr = float(self.coneparam['sr'])
+
+        except Exception as e:
+
+            self.msg = 'Cone search RA, DEC and SR must be numbers.'
+            raise Exception(self.msg)
+
+        mode = SpatialIndex.HTM
+        if(self.config.adqlparam['mode'] == 'HPX'):
+            mode = SpatialIndex.HPX
+
+        encoding = SpatialIndex.BASE4
+        if(self.config.adqlparam['encoding'] == 'BASE10'):
+            encoding = SpatialIndex.BASE10
+
+        cone = coneSearch(ra, dec, sr,
+                          mode=mode,
+                          level=int(self.config.adqlparam['level']),
+                          colname=self.config.adqlparam['colname'],
+                          encoding=encoding,
+                          xcol=self.config.adqlparam['xcol'],
+                          ycol=self.config.adqlparam['ycol'],
+                          zcol=self.config.adqlparam['zcol'],
+                          maxranges=self.config.cone_maxranges,
+                          cachedir=self.config.cachedir,
+                          debug=self.debug)
+
+        query = 'select * from ' + table + ' where ' + cone.constraint
 
         if self.debug:
-            logging.debug(f'ind       = {ind:d}')
+            logging.debug('')
+            logging.debug(f'cone search query: {query:s}')
+
+        return(query)
+
+        #
+        # } end of coneQuery def
+        #
+
+
+    def __schemaVersion__(self, **kwargs):
+
+        # Data version of TAP_SCHEMA (see DATA_VERSION), '' if not known
+        #
+
+        if(len(self.config.dataversion) == 0):
+            return('')
+
+        dv = dataVersion(self.config.connectInfo, 'TAP_SCHEMA.tables',
+                         mode=self.config.dataversion,
+                         sql=self.config.dataversion_sql,
+                         column=self.config.dataversion_col,
+                         interval=self.config.dataversion_interval,
+                         cachedir=self.config.cachedir,
+                         debug=self.debug)
+
+        return(dv.version)
+
+
+    def __getDatalevel__(self, dbtable, **kwargs):
+
+        tmap = tableMap(self.config.propfilter, self.config.fileid,
+                        tablemap=self.config.tablemap, debug=self.debug)
+
+        datalevel = tmap.lookup(dbtable)['datalevel']
+
+        if self.debug:
+            logging.debug(f'dbtable   = {dbtable:s}')
             logging.debug(f'datalevel = {datalevel:s}')
 
         return(datalevel)
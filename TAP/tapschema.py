@@ -0,0 +1,298 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+
+from TAP.configparam import configParam
+from TAP.dataversion import dataVersion
+
+
+class tapSchema:
+
+    """
+    tapSchema keeps a SQLite copy of the TAP_SCHEMA tables (schemas,
+    tables, columns, keys, key_columns) under cachedir/tapschema, so that
+    metadata queries are answered from a small local file (kept in the
+    page cache by the OS) instead of the service DBMS.  The copy is made
+    again when the TAP_SCHEMA version changes or, without version, after
+    ttl; it is replaced atomically, so a query running on the old copy is
+    not disturbed.
+
+    The copy holds the tables both as main tables and (attached) as
+    TAP_SCHEMA, so connectInfo can be given to runQuery as is: only the
+    DBMS round trip is saved, the query still goes through the ADQL
+    translation, dataDictionary and writeResult.
+
+    Required input:
+
+        connectInfo:  DBMS connection info (as in configParam)
+
+        cachedir:     cache directory
+
+    Optional input:
+
+        version:      TAP_SCHEMA version (see TAP.dataversion)
+
+        ttl:          seconds a copy without version is used (default 3600)
+
+    Usage:
+
+        schema = tapSchema(config.connectInfo, config.cachedir,
+                           version=version)
+
+        dbquery = runQuery(connectInfo=schema.connectInfo, ...)
+    """
+
+    debug = 0
+
+    tables = ['schemas', 'tables', 'columns', 'keys', 'key_columns']
+
+    version = ''
+    ttl = 3600
+
+    path = ''
+    connectInfo = {}
+
+    def __init__(self, connectInfo, cachedir, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('version' in kwargs):
+            self.version = kwargs['version']
+
+        if('ttl' in kwargs):
+            self.ttl = kwargs['ttl']
+
+        self.source = connectInfo
+        self.dbms = connectInfo['dbms'].lower()
+
+        schemadir = cachedir + '/tapschema'
+
+        try:
+            os.makedirs(schemadir, exist_ok=True)
+
+        except Exception as e:
+
+            self.msg = f'Failed to create cache directory [{schemadir:s}]'
+            raise Exception(self.msg)
+
+        self.path = schemadir + '/tap_schema.db'
+        metapath = schemadir + '/tap_schema.json'
+
+        self.connectInfo = {'dbms': 'sqlite3',
+                            'db': self.path,
+                            'tap_schema': self.path}
+
+        try:
+            with open(metapath, 'r') as fp:
+                meta = json.load(fp)
+
+            if((meta.get('version') == self.version)
+                    and ((len(self.version) > 0)
+                         or (meta.get('expires', 0) > time.time()))
+                    and os.path.exists(self.path)):
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'tapSchema: cached {self.path:s}')
+
+                return
+
+        except Exception as e:
+            pass
+
+        #
+        # Copy into a temporary file, then replace the copy and its entry
+        #
+
+        fd, tmppath = tempfile.mkstemp(dir=schemadir, prefix='.tmp')
+        os.close(fd)
+
+        try:
+            ncopy = self.__copy__(tmppath)
+
+            os.chmod(tmppath, 0o664)
+            os.replace(tmppath, self.path)
+
+            fd, tmpmeta = tempfile.mkstemp(dir=schemadir, prefix='.tmp')
+
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'version': self.version,
+                           'expires': time.time() + self.ttl}, fp)
+
+            os.chmod(tmpmeta, 0o664)
+            os.replace(tmpmeta, metapath)
+
+        except Exception as e:
+
+            try:
+                os.remove(tmppath)
+            except Exception as e2:
+                pass
+
+            self.msg = f'Failed to copy TAP_SCHEMA: {str(e):s}'
+            raise Exception(self.msg)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tapSchema: {ncopy:d} rows copied to '
+                          f'{self.path:s}')
+
+        #
+        # } end of init
+        #
+
+
+    def __copy__(self, path, **kwargs):
+
+        #
+        # {
+        #
+
+        import sqlite3
+
+        src = self.__connect__()
+        dst = sqlite3.connect(path)
+
+        ncopy = 0
+
+        try:
+            for table in self.tables:
+
+                cursor = src.cursor()
+
+                try:
+                    cursor.execute('select * from TAP_SCHEMA.' + table)
+
+                except Exception as e:
+
+                    #
+                    # Only tables and columns are required
+                    #
+
+                    if(table in ['tables', 'columns']):
+                        raise
+
+                    continue
+
+                names = [str(col[0]) for col in cursor.description]
+
+                dst.execute('create table ' + table + ' (' +
+                            ', '.join(['"' + name + '"' for name in names]) +
+                            ')')
+
+                insert = 'insert into ' + table + ' values (' + \
+                    ', '.join(['?']*len(names)) + ')'
+
+                while True:
+
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+
+                    dst.executemany(insert,
+                                    [[self.__value__(val) for val in row]
+                                     for row in rows])
+
+                    ncopy = ncopy + len(rows)
+
+            dst.commit()
+
+        finally:
+            src.close()
+            dst.close()
+
+        return(ncopy)
+
+        #
+        # } end of copy def
+        #
+
+
+    def __value__(self, val, **kwargs):
+
+        # Oracle LOBs are read, dates kept as ISO strings
+        #
+
+        if hasattr(val, 'read'):
+            return(val.read())
+
+        if isinstance(val, (datetime.datetime, datetime.date)):
+            return(val.isoformat())
+
+        return(val)
+
+
+    def __connect__(self, **kwargs):
+
+        if(self.dbms == 'oracle'):
+
+            import cx_Oracle
+
+            conn = cx_Oracle.connect(self.source['userid'],
+                                     self.source['password'],
+                                     self.source['dbserver'])
+        else:
+            import sqlite3
+
+            conn = sqlite3.connect(self.source['db'])
+
+            conn.execute('ATTACH DATABASE ? AS TAP_SCHEMA',
+                         (self.source['tap_schema'],))
+
+        return(conn)
+
+
+def main():
+
+    #
+    # Refresh the TAP_SCHEMA copy, e.g. after loading new tables:
+    #
+    #     python -m TAP.tapschema
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Refresh the local copy of TAP_SCHEMA.')
+
+    parser.add_argument('--config', default=os.getenv('TAP_CONF', ''),
+                        help='TAP config file (default: $TAP_CONF)')
+
+    args = parser.parse_args()
+
+    config = configParam(args.config)
+
+    version = dataVersion(config.connectInfo, 'TAP_SCHEMA.tables',
+                          mode=config.dataversion,
+                          sql=config.dataversion_sql,
+                          column=config.dataversion_col,
+                          interval=0).version
+
+    try:
+        os.remove(config.cachedir + '/tapschema/tap_schema.json')
+    except Exception as e:
+        pass
+
+    schema = tapSchema(config.connectInfo, config.cachedir, version=version,
+                       ttl=config.tapschema_cache)
+
+    print(f'{schema.path:s} [{version:s}]')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,766 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import io
+import os
+import re
+import csv
+import json
+import math
+import hashlib
+import logging
+
+import xml.etree.ElementTree as ET
+
+
+def upload_table(tblname):
+
+    # Tables of the query that are uploaded tables (TAP_UPLOAD.name, or
+    # the Oracle private temporary table they are loaded into)
+    #
+
+    tblname = tblname.lower()
+
+    return(tblname.startswith('tap_upload.') or
+           tblname.startswith('ora$ptt_'))
+
+
+def save_uploads(uploadstr, form, workdir):
+
+    #
+    # {
+    #
+
+    # UPLOAD is a list of "name,URI" pairs separated by ';'; the URI
+    # 'param:field' names the (multipart) form field holding the table.
+    # The tables are saved in the job directory, so that an async job
+    # run later finds them there.
+    #
+
+    uploaddir = workdir + '/upload'
+
+    os.makedirs(uploaddir, exist_ok=True)
+
+    names = []
+
+    for item in uploadstr.split(';'):
+
+        item = item.strip()
+        if(len(item) == 0):
+            continue
+
+        if(item.find(',') == -1):
+            msg = 'Invalid UPLOAD [' + item + ']: must be name,URI'
+            raise Exception(msg)
+
+        name, uri = [val.strip() for val in item.split(',', 1)]
+
+        if(re.fullmatch(r'[A-Za-z][A-Za-z0-9_]{0,63}', name) is None):
+            msg = 'Invalid UPLOAD table name [' + name + ']'
+            raise Exception(msg)
+
+        name = name.lower()
+
+        if(name in names):
+            msg = 'UPLOAD table name [' + name + '] used twice'
+            raise Exception(msg)
+
+        if not uri.startswith('param:'):
+            msg = 'UPLOAD [' + name + ']: only inline uploads ' + \
+                '(param:<field>) are supported'
+            raise Exception(msg)
+
+        field = uri[6:]
+
+        if(field not in form):
+            msg = 'UPLOAD [' + name + ']: no form field [' + field + ']'
+            raise Exception(msg)
+
+        data = form[field].value
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        with open(uploaddir + '/' + name, 'wb') as fp:
+            fp.write(data)
+
+        names.append(name)
+
+    with open(uploaddir + '/upload.json', 'w') as fp:
+        json.dump({'tables': names}, fp)
+
+    return(names)
+
+    #
+    # } end of save_uploads def
+    #
+
+
+class tapUpload:
+
+    """
+    tapUpload reads the tables uploaded with a query (TAP UPLOAD, saved
+    in the job directory by save_uploads) and loads them, in the query's
+    own DBMS session, as TAP_UPLOAD.<name>: an in-memory database
+    attached to the SQLite connection, or an Oracle private temporary
+    table (ORA$PTT_<name>, the query is rewritten to match).  The tables
+    are VOTable (TABLEDATA) or CSV with a header line.
+
+    A positional crossmatch of a catalog with an uploaded table, i.e.
+
+        CONTAINS(POINT('ICRS', t.ra, t.dec),
+                 CIRCLE('ICRS', u.ra, u.dec, 0.001)) = 1
+
+    is made a join on the spatial index: each uploaded position is loaded
+    with its unit vector and the (coalesced) index ranges covering its
+    circle (see TAP.conesearch), one row per range, in
+    TAP_UPLOAD.<name>__xmatch, and the predicate becomes a range join on
+    the catalog index column plus the exact dot product test.  The whole
+    crossmatch runs as one query on the DBMS.
+
+    Required input:
+
+        workdir:    job directory holding the uploaded tables
+
+    Optional input:
+
+        maxrows:    most rows in an uploaded table (default 100000)
+
+    Usage:
+
+        upload = tapUpload(workdir, maxrows=config.upload_maxrows)
+
+        query = upload.crossmatch(query, mode=mode, level=level, ...)
+
+        (on the query's connection)
+
+        upload.load(conn, dbms)
+        sql = upload.rewrite(sql, dbms)
+    """
+
+    debug = 0
+
+    maxrows = 100000
+
+    tables = {}
+    digest = ''
+
+    xmatchcols = ['tap_lo', 'tap_hi', 'tap_x', 'tap_y', 'tap_z']
+
+    namepattern = re.compile(r'[A-Za-z][A-Za-z0-9_]{0,63}')
+
+    containspattern = re.compile(
+        r"CONTAINS\s*\(\s*"
+        r"POINT\s*\(\s*(?:'[^']*'\s*,\s*)?(\w+)\.(\w+)\s*,\s*(\w+)\.(\w+)\s*\)"
+        r"\s*,\s*"
+        r"CIRCLE\s*\(\s*(?:'[^']*'\s*,\s*)?(\w+)\.(\w+)\s*,\s*(\w+)\.(\w+)"
+        r"\s*,\s*([-+0-9.eE]+)\s*\)"
+        r"\s*\)\s*=\s*1", re.IGNORECASE)
+
+    notalias = ['where', 'join', 'on', 'inner', 'left', 'right', 'full',
+                'outer', 'cross', 'natural', 'order', 'group', 'having',
+                'union', 'limit', 'offset', 'using']
+
+    def __init__(self, workdir, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('maxrows' in kwargs):
+            self.maxrows = kwargs['maxrows']
+
+        uploaddir = workdir + '/upload'
+
+        with open(uploaddir + '/upload.json', 'r') as fp:
+            names = json.load(fp)['tables']
+
+        self.tables = {}
+
+        sha = hashlib.sha256()
+
+        for name in names:
+
+            with open(uploaddir + '/' + name, 'rb') as fp:
+                data = fp.read()
+
+            sha.update(name.encode('utf-8') + b'\0' + data + b'\0')
+
+            try:
+                if data.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<'):
+                    table = self.__readVotable__(data)
+                else:
+                    table = self.__readCsv__(data)
+
+            except Exception as e:
+
+                self.msg = 'UPLOAD [' + name + ']: ' + str(e)
+                raise Exception(self.msg)
+
+            if(len(table['rows']) > self.maxrows):
+
+                self.msg = 'UPLOAD [' + name + '] has more than ' + \
+                    str(self.maxrows) + ' rows.'
+                raise Exception(self.msg)
+
+            self.tables[name] = table
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'tapUpload {name:s}: '
+                              f'{len(table["rows"]):d} rows, columns '
+                              f'{str(table["columns"]):s}')
+
+        self.digest = sha.hexdigest()
+
+        #
+        # } end of init
+        #
+
+
+    def crossmatch(self, query, **kwargs):
+
+        #
+        # {
+        #
+
+        # Rewrite the CONTAINS(POINT(catalog), CIRCLE(upload)) predicates
+        # of the (ADQL) query into index range joins with
+        # TAP_UPLOAD.<name>__xmatch.  kwargs are the coneSearch settings.
+        #
+
+        aliases = self.__aliases__(query)
+
+        xmatch = {}
+
+        def predicate(match):
+
+            (pa, pra, pa2, pdec, ca, cra, ca2, cdec, radius) = match.groups()
+
+            if((pa.lower() != pa2.lower()) or (ca.lower() != ca2.lower())):
+                return(match.group(0))
+
+            if(ca.lower() in aliases):
+                (ualias, ura, udec, talias) = (ca, cra, cdec, pa)
+
+            elif(pa.lower() in aliases):
+                (ualias, ura, udec, talias) = (pa, pra, pdec, ca)
+
+            else:
+                return(match.group(0))
+
+            name = aliases[ualias.lower()]
+
+            try:
+                radius = float(radius)
+
+            except Exception as e:
+                raise Exception('Invalid crossmatch radius [' + radius + ']')
+
+            spec = (ura.lower(), udec.lower(), radius)
+
+            if((name in xmatch) and (xmatch[name] != spec)):
+
+                self.msg = 'UPLOAD [' + name + ']: only one crossmatch ' + \
+                    'per uploaded table'
+                raise Exception(self.msg)
+
+            xmatch[name] = spec
+
+            cosr = math.cos(math.radians(radius))
+
+            colname = kwargs.get('colname', 'spt_ind')
+            xcol = kwargs.get('xcol', 'x')
+            ycol = kwargs.get('ycol', 'y')
+            zcol = kwargs.get('zcol', 'z')
+
+            return(f'({talias}.{colname} between {ualias}.tap_lo and '
+                   f'{ualias}.tap_hi and '
+                   f'({talias}.{xcol}*{ualias}.tap_x+'
+                   f'{talias}.{ycol}*{ualias}.tap_y+'
+                   f'{talias}.{zcol}*{ualias}.tap_z)>={cosr:.17g})')
+
+        query = self.containspattern.sub(predicate, query)
+
+        for name in xmatch:
+
+            (racol, deccol, radius) = xmatch[name]
+
+            self.__xmatchTable__(name, racol, deccol, radius, **kwargs)
+
+            #
+            # The table reference (given an alias if it had none) and
+            # the alias.* of the select list point at the xmatch table
+            #
+
+            for alias in [alias for alias in aliases
+                          if aliases[alias] == name]:
+
+                columns = ', '.join([alias + '.' + col for col in
+                                     self.tables[name]['columns']])
+
+                query = re.sub(r'\b' + alias + r'\s*\.\s*\*', columns, query,
+                               flags=re.IGNORECASE)
+
+            def table(match):
+
+                alias = match.group(2)
+                if alias is None:
+                    alias = name
+
+                return('TAP_UPLOAD.' + name + '__xmatch ' + alias)
+
+            query = self.__tablePattern__(name).sub(table, query)
+
+            query = re.sub(r'\bTAP_UPLOAD\.\s*' + name + r'\s*\.',
+                           name + '.', query, flags=re.IGNORECASE)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tapUpload crossmatch query: {query:s}')
+
+        return(query)
+
+        #
+        # } end of crossmatch def
+        #
+
+
+    def load(self, conn, dbms, **kwargs):
+
+        #
+        # {
+        #
+
+        # Create and fill the TAP_UPLOAD tables in the connection's
+        # session, with array inserts
+        #
+
+        dbms = dbms.lower()
+
+        cursor = conn.cursor()
+
+        if(dbms == 'sqlite3'):
+            cursor.execute("ATTACH DATABASE ':memory:' AS TAP_UPLOAD")
+
+        nrow = 0
+
+        for name in self.tables:
+
+            table = self.tables[name]
+
+            ncol = len(table['columns'])
+
+            if(dbms == 'oracle'):
+
+                tblname = 'ORA$PTT_' + name
+
+                coldefs = []
+                for i in range(ncol):
+
+                    coltype = table['types'][i]
+
+                    if(coltype == 'int'):
+                        coltype = 'number(19)'
+                    elif(coltype == 'float'):
+                        coltype = 'binary_double'
+                    else:
+                        width = max([1] + [len(row[i]) for row in
+                                           table['rows'] if row[i] is not None])
+                        coltype = f'varchar2({min(width, 4000):d} char)'
+
+                    coldefs.append(table['columns'][i] + ' ' + coltype)
+
+                cursor.execute('create private temporary table ' + tblname +
+                               ' (' + ', '.join(coldefs) + ')' +
+                               ' on commit preserve definition')
+
+                insert = 'insert into ' + tblname + ' values (' + \
+                    ', '.join([':' + str(i+1) for i in range(ncol)]) + ')'
+
+            else:
+                tblname = 'TAP_UPLOAD.' + name
+
+                types = {'int': 'integer', 'float': 'real', 'char': 'text'}
+
+                cursor.execute('create table ' + tblname + ' (' +
+                               ', '.join([table['columns'][i] + ' ' +
+                                          types[table['types'][i]]
+                                          for i in range(ncol)]) + ')')
+
+                insert = 'insert into ' + tblname + ' values (' + \
+                    ', '.join(['?']*ncol) + ')'
+
+            rows = table['rows']
+
+            for i in range(0, len(rows), 10000):
+                cursor.executemany(insert, rows[i:i+10000])
+
+            nrow = nrow + len(rows)
+
+        if(dbms == 'sqlite3'):
+
+            #
+            # Row counts for the planner: the uploaded table is the outer
+            # loop of the join on the catalog index
+            #
+
+            cursor.execute('ANALYZE TAP_UPLOAD')
+
+        conn.commit()
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tapUpload: {len(self.tables):d} tables, '
+                          f'{nrow:d} rows loaded')
+
+        return
+
+        #
+        # } end of load def
+        #
+
+
+    def rewrite(self, sql, dbms, **kwargs):
+
+        # Oracle: TAP_UPLOAD.<name> is the private temporary table
+        #
+
+        if(dbms.lower() != 'oracle'):
+            return(sql)
+
+        return(re.sub(r'\bTAP_UPLOAD\.\s*(\w+)', r'ORA$PTT_\1', sql,
+                      flags=re.IGNORECASE))
+
+
+    def __aliases__(self, query, **kwargs):
+
+        # alias (or table name) -> uploaded table name
+        #
+
+        aliases = {}
+
+        for match in self.__tablePattern__(r'\w+').finditer(query):
+
+            name = match.group(1).lower()
+
+            if(name not in self.tables):
+
+                self.msg = 'Table [TAP_UPLOAD.' + match.group(1) + \
+                    '] was not uploaded.'
+                raise Exception(self.msg)
+
+            aliases[name] = name
+
+            alias = match.group(2)
+
+            if alias is not None:
+                aliases[alias.lower()] = name
+
+        return(aliases)
+
+
+    def __tablePattern__(self, name, **kwargs):
+
+        # TAP_UPLOAD.<name> table reference (not a column reference) and
+        # its alias, if any
+        #
+
+        return(re.compile(r'\bTAP_UPLOAD\.\s*(' + name + r')\b(?!\s*\.)'
+                          r'(?:\s+(?:AS\s+)?(?!(?:' +
+                          '|'.join(self.notalias) + r')\b)(\w+))?',
+                          re.IGNORECASE))
+
+
+    def __xmatchTable__(self, name, racol, deccol, radius, **kwargs):
+
+        #
+        # {
+        #
+
+        # TAP_UPLOAD.<name>__xmatch: the uploaded rows, each with the
+        # index ranges covering its circle and its unit vector
+        #
+
+        table = self.tables[name]
+
+        if((racol not in table['columns']) or
+           (deccol not in table['columns'])):
+
+            self.msg = 'UPLOAD [' + name + '] has no column [' + racol + \
+                '] or [' + deccol + ']'
+            raise Exception(self.msg)
+
+        for col in self.xmatchcols:
+
+            if(col in table['columns']):
+                self.msg = 'UPLOAD [' + name + '] column name [' + col + \
+                    '] is reserved for the crossmatch'
+                raise Exception(self.msg)
+
+        #
+        # Only crossmatches need the spatial index package
+        #
+
+        from TAP.conesearch import coneSearch
+
+        ira = table['columns'].index(racol)
+        idec = table['columns'].index(deccol)
+
+        settings = {}
+        for key in ['mode', 'level', 'colname', 'encoding', 'xcol', 'ycol',
+                    'zcol', 'maxranges']:
+
+            if(key in kwargs):
+                settings[key] = kwargs[key]
+
+        rows = []
+        nrange = 0
+
+        for row in table['rows']:
+
+            try:
+                ra = float(row[ira])
+                dec = float(row[idec])
+
+            except Exception as e:
+
+                #
+                # A position without coordinates matches nothing
+                #
+
+                continue
+
+            cone = coneSearch(ra, dec, radius, **settings)
+
+            ra = math.radians(ra)
+            dec = math.radians(dec)
+
+            x = math.cos(dec)*math.cos(ra)
+            y = math.cos(dec)*math.sin(ra)
+            z = math.sin(dec)
+
+            for (lo, hi) in cone.ranges:
+                rows.append(list(row) + [lo, hi, x, y, z])
+
+            nrange = nrange + len(cone.ranges)
+
+        self.tables[name + '__xmatch'] = {
+            'columns': table['columns'] + self.xmatchcols,
+            'types': table['types'] + ['int', 'int', 'float', 'float',
+                                       'float'],
+            'rows': rows}
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'tapUpload {name:s}__xmatch: '
+                          f'{len(table["rows"]):d} positions, '
+                          f'{nrange:d} index ranges')
+
+        return
+
+        #
+        # } end of xmatchTable def
+        #
+
+
+    def __readVotable__(self, data, **kwargs):
+
+        #
+        # {
+        #
+
+        # First TABLE of the VOTable: FIELD names and datatypes, and the
+        # TABLEDATA rows
+        #
+
+        columns = []
+        datatypes = []
+        rows = []
+
+        intypes = ['boolean', 'bit', 'unsignedbyte', 'short', 'int', 'long']
+        floattypes = ['float', 'double']
+
+        ntable = 0
+
+        for event, elem in ET.iterparse(io.BytesIO(data),
+                                        events=('start', 'end')):
+
+            tag = elem.tag.rsplit('}', 1)[-1].upper()
+
+            if(event == 'start'):
+
+                if(tag == 'TABLE'):
+                    ntable = ntable + 1
+
+                continue
+
+            if(ntable > 1):
+                break
+
+            if(tag == 'FIELD'):
+
+                columns.append(elem.get('name', ''))
+
+                datatype = elem.get('datatype', 'char')
+
+                if(elem.get('arraysize') is not None and
+                   datatype not in ['char', 'unicodeChar']):
+                    raise Exception('array column [' +
+                                    elem.get('name', '') +
+                                    '] is not supported')
+
+                if(datatype.lower() in intypes):
+                    datatypes.append('int')
+                elif(datatype.lower() in floattypes):
+                    datatypes.append('float')
+                else:
+                    datatypes.append('char')
+
+            elif(tag == 'TR'):
+
+                row = [self.__value__(td.text, datatypes[i])
+                       for i, td in enumerate(elem)]
+
+                if(len(row) != len(columns)):
+                    raise Exception('row ' + str(len(rows) + 1) + ' has ' +
+                                    str(len(row)) + ' values')
+
+                rows.append(row)
+
+                if(len(rows) > self.maxrows):
+                    break
+
+                elem.clear()
+
+            elif(tag in ['BINARY', 'BINARY2', 'FITS']):
+                raise Exception('only TABLEDATA VOTables are supported')
+
+        return({'columns': self.__columns__(columns), 'types': datatypes,
+                'rows': rows})
+
+        #
+        # } end of readVotable def
+        #
+
+
+    def __readCsv__(self, data, **kwargs):
+
+        #
+        # {
+        #
+
+        # CSV with a header line; a column is int or float if all its
+        # (non empty) values are
+        #
+
+        reader = csv.reader(io.StringIO(data.decode('utf-8-sig')))
+
+        columns = None
+        rows = []
+
+        for row in reader:
+
+            if(len(row) == 0):
+                continue
+
+            if columns is None:
+                columns = [col.strip() for col in row]
+                continue
+
+            if(len(row) != len(columns)):
+                raise Exception('row ' + str(len(rows) + 1) + ' has ' +
+                                str(len(row)) + ' values')
+
+            rows.append([None if len(val.strip()) == 0 else val.strip()
+                         for val in row])
+
+            if(len(rows) > self.maxrows):
+                break
+
+        if columns is None:
+            raise Exception('empty table')
+
+        datatypes = []
+
+        for i in range(len(columns)):
+
+            values = [row[i] for row in rows if row[i] is not None]
+
+            datatype = 'char'
+
+            for (name, func) in [('int', int), ('float', float)]:
+
+                try:
+                    for val in values:
+                        func(val)
+
+                    datatype = name
+                    break
+
+                except Exception as e:
+                    pass
+
+            datatypes.append(datatype)
+
+        for row in rows:
+            for i in range(len(columns)):
+                row[i] = self.__value__(row[i], datatypes[i])
+
+        return({'columns': self.__columns__(columns), 'types': datatypes,
+                'rows': rows})
+
+        #
+        # } end of readCsv def
+        #
+
+
+    def __value__(self, text, datatype, **kwargs):
+
+        if((text is None) or (len(text.strip()) == 0)):
+            return(None)
+
+        text = text.strip()
+
+        if(datatype == 'int'):
+
+            if(text.lower() in ['true', 't']):
+                return(1)
+            if(text.lower() in ['false', 'f']):
+                return(0)
+
+            return(int(text))
+
+        if(datatype == 'float'):
+
+            value = float(text)
+
+            if math.isnan(value):
+                return(None)
+
+            return(value)
+
+        return(text)
+
+
+    def __columns__(self, columns, **kwargs):
+
+        # Column names go into the SQL as is: plain names only
+        #
+
+        columns = [col.lower() for col in columns]
+
+        for col in columns:
+
+            if(self.namepattern.fullmatch(col) is None):
+                raise Exception('invalid column name [' + col + ']')
+
+        if(len(set(columns)) != len(columns)):
+            raise Exception('duplicate column names')
+
+        return(columns)
@@ -0,0 +1,561 @@
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+
+from xml.sax.saxutils import escape, quoteattr
+
+from TAP.configparam import configParam
+from TAP.dataversion import dataVersion
+
+
+class vosiDocument:
+
+    """
+    vosiDocument renders the VOSI documents of the service: 'tables' (the
+    VODataService tableset built from TAP_SCHEMA), 'capabilities' and
+    'availability'.  The rendered XML is kept under cachedir/vosi with its
+    ETag and the TAP_SCHEMA version it was made from, so the documents are
+    served from the file until the schema version changes (or, when no
+    version is known, until ttl runs out).  'availability' checks the
+    database connection and is kept for 60 seconds.
+
+    Required input:
+
+        connectInfo:  DBMS connection info (as in configParam)
+
+        resource:     'tables', 'capabilities' or 'availability'
+
+    Optional input:
+
+        baseurl:      TAP service URL (for 'capabilities')
+
+        cachedir:     cache directory (default: a new temporary directory)
+
+        version:      TAP_SCHEMA version (see TAP.dataversion)
+
+        ttl:          seconds a document without version is kept
+                      (default 3600)
+
+    Usage:
+
+        doc = vosiDocument(config.connectInfo, 'tables',
+                           cachedir=config.cachedir, version=version)
+
+        doc.path, doc.etag, doc.mtime
+    """
+
+    debug = 0
+
+    resources = ['tables', 'capabilities', 'availability']
+
+    baseurl = ''
+    cachedir = ''
+    version = ''
+    ttl = 3600
+    availability_ttl = 60
+
+    path = ''
+    etag = ''
+    mtime = 0.
+
+    #
+    # TAP_SCHEMA datatype -> VOTable datatype
+    #
+
+    votypes = {'boolean': 'boolean',
+               'smallint': 'short',
+               'short': 'short',
+               'int': 'int',
+               'integer': 'int',
+               'bigint': 'long',
+               'long': 'long',
+               'real': 'float',
+               'float': 'float',
+               'double': 'double',
+               'char': 'char',
+               'varchar': 'char',
+               'string': 'char',
+               'timestamp': 'char',
+               'date': 'char',
+               'clob': 'char',
+               'unicodechar': 'unicodeChar'}
+
+    formats = [('application/x-votable+xml', 'votable'),
+               ('text/csv', 'csv'),
+               ('text/tab-separated-values', 'tsv'),
+               ('text/plain', 'ipac')]
+
+    def __init__(self, connectInfo, resource, **kwargs):
+
+        #
+        # {
+        #
+
+        if('debug' in kwargs):
+            self.debug = kwargs['debug']
+
+        if('baseurl' in kwargs):
+            self.baseurl = kwargs['baseurl']
+
+        if('cachedir' in kwargs):
+            self.cachedir = kwargs['cachedir']
+
+        if('version' in kwargs):
+            self.version = kwargs['version']
+
+        if('ttl' in kwargs):
+            self.ttl = kwargs['ttl']
+
+        self.connectInfo = connectInfo
+        self.dbms = connectInfo['dbms'].lower()
+
+        if(resource not in self.resources):
+            self.msg = 'Invalid VOSI resource [' + resource + ']'
+            raise Exception(self.msg)
+
+        self.resource = resource
+
+        #
+        # The document is used while it was made from the same schema
+        # version (and, without version, within ttl) with the same base URL
+        #
+
+        ttl = self.ttl
+        version = self.version
+
+        if(resource == 'capabilities'):
+            version = self.baseurl
+
+        elif(resource == 'availability'):
+            ttl = self.availability_ttl
+            version = ''
+
+        cachedir = self.cachedir
+        if(len(cachedir) == 0):
+            cachedir = tempfile.mkdtemp(prefix='vosi')
+
+        vosidir = cachedir + '/vosi'
+
+        try:
+            os.makedirs(vosidir, exist_ok=True)
+
+        except Exception as e:
+
+            self.msg = f'Failed to create cache directory [{vosidir:s}]'
+            raise Exception(self.msg)
+
+        self.path = vosidir + '/' + resource + '.xml'
+        metapath = vosidir + '/' + resource + '.json'
+
+        try:
+            with open(metapath, 'r') as fp:
+                meta = json.load(fp)
+
+            if((meta.get('version') == version)
+                    and ((len(version) > 0)
+                         or (meta.get('expires', 0) > time.time()))
+                    and os.path.exists(self.path)):
+
+                self.etag = meta['etag']
+                self.mtime = meta['mtime']
+
+                if self.debug:
+                    logging.debug('')
+                    logging.debug(f'vosiDocument {resource:s}: cached')
+
+                return
+
+        except Exception as e:
+            pass
+
+        #
+        # Render, then replace the file and its entry (file first, so a
+        # reader that finds the new entry finds the new file)
+        #
+
+        xml = self.__render__().encode('utf-8')
+
+        self.etag = '"' + hashlib.sha256(xml).hexdigest()[:32] + '"'
+        self.mtime = time.time()
+
+        try:
+            for (path, data) in [(self.path, xml),
+                                 (metapath,
+                                  json.dumps({'version': version,
+                                              'expires': self.mtime + ttl,
+                                              'etag': self.etag,
+                                              'mtime': self.mtime})
+                                  .encode('utf-8'))]:
+
+                fd, tmppath = tempfile.mkstemp(dir=vosidir, prefix='.tmp')
+
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(data)
+
+                os.chmod(tmppath, 0o664)
+                os.replace(tmppath, path)
+
+        except Exception as e:
+
+            self.msg = f'Failed to write VOSI document: {str(e):s}'
+            raise Exception(self.msg)
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'vosiDocument {resource:s}: rendered '
+                          f'{len(xml):d} bytes')
+
+        #
+        # } end of init
+        #
+
+
+    def __render__(self, **kwargs):
+
+        if(self.resource == 'tables'):
+            return(self.__tables__())
+
+        elif(self.resource == 'capabilities'):
+            return(self.__capabilities__())
+
+        return(self.__availability__())
+
+
+    def __tables__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        conn = self.__connect__()
+
+        try:
+            tables = self.__select__(conn, 'TAP_SCHEMA.tables')
+            columns = self.__select__(conn, 'TAP_SCHEMA.columns')
+
+            try:
+                schemas = self.__select__(conn, 'TAP_SCHEMA.schemas')
+            except Exception as e:
+                schemas = []
+
+        finally:
+            conn.close()
+
+        #
+        # Tables by schema (the schema name is the table name prefix when
+        # TAP_SCHEMA.tables has no schema_name), columns by table
+        #
+
+        descs = {}
+        for row in schemas:
+            descs[str(row.get('schema_name', ''))] = row.get('description')
+
+        bytable = {}
+        for row in columns:
+            name = str(row.get('table_name', '')).strip().lower()
+            bytable.setdefault(name, []).append(row)
+
+        tablerows = {}
+        for row in tables:
+            name = str(row.get('table_name', '')).strip()
+            tablerows[name.lower()] = row
+
+        for name in bytable:
+            if(name not in tablerows):
+                tablerows[name] = {'table_name': name}
+
+        byschema = {}
+        for name in sorted(tablerows):
+
+            row = tablerows[name]
+
+            schema = row.get('schema_name')
+            if((schema is None) or (len(str(schema)) == 0)):
+                schema = 'default'
+                if('.' in name):
+                    schema = str(row['table_name']).split('.')[0]
+
+            byschema.setdefault(str(schema), []).append(row)
+
+        lines = []
+
+        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+        lines.append('<vosi:tableset '
+                     'xmlns:vosi="http://www.ivoa.net/xml/VOSITables/v1.0" '
+                     'xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1" '
+                     'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">')
+
+        for schema in sorted(byschema):
+
+            lines.append('  <schema>')
+            lines.append('    <name>' + escape(schema) + '</name>')
+            self.__element__(lines, 4, 'description', descs.get(schema))
+
+            for row in byschema[schema]:
+
+                tabletype = str(row.get('table_type') or 'table').lower()
+                if(tabletype not in ['table', 'view', 'output']):
+                    tabletype = 'table'
+
+                name = str(row['table_name']).strip()
+
+                lines.append('    <table type="' + tabletype + '">')
+                lines.append('      <name>' + escape(name) + '</name>')
+                self.__element__(lines, 6, 'description',
+                                 row.get('description'))
+                self.__element__(lines, 6, 'utype', row.get('utype'))
+
+                for col in bytable.get(name.lower(), []):
+                    self.__column__(lines, col)
+
+                lines.append('    </table>')
+
+            lines.append('  </schema>')
+
+        lines.append('</vosi:tableset>')
+
+        return('\n'.join(lines) + '\n')
+
+        #
+        # } end of tables def
+        #
+
+
+    def __column__(self, lines, col, **kwargs):
+
+        #
+        # {
+        #
+
+        lines.append('      <column>')
+
+        lines.append('        <name>' +
+                     escape(str(col['column_name']).strip()) + '</name>')
+
+        for key in ['description', 'unit', 'ucd', 'utype']:
+            self.__element__(lines, 8, key, col.get(key))
+
+        datatype = str(col.get('datatype') or 'char').strip().lower()
+        votype = self.votypes.get(datatype, 'char')
+
+        arraysize = col.get('arraysize')
+        if((arraysize is None) or (len(str(arraysize).strip()) == 0)):
+            arraysize = ''
+            if(votype in ['char', 'unicodeChar']):
+                arraysize = '*'
+
+        attr = ''
+        if(len(str(arraysize)) > 0):
+            attr = ' arraysize=' + quoteattr(str(arraysize).strip())
+
+        lines.append('        <dataType xsi:type="vs:VOTableType"' + attr +
+                     '>' + votype + '</dataType>')
+
+        for (key, flag) in [('indexed', 'indexed'),
+                            ('principal', 'principal'),
+                            ('std', 'std')]:
+
+            if(str(col.get(key) or 0).strip() == '1'):
+                lines.append('        <flag>' + flag + '</flag>')
+
+        lines.append('      </column>')
+
+        #
+        # } end of column def
+        #
+
+
+    def __capabilities__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        baseurl = escape(self.baseurl)
+
+        lines = []
+
+        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+        lines.append('<vosi:capabilities '
+                     'xmlns:vosi="http://www.ivoa.net/xml/VOSICapabilities/v1.0" '
+                     'xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1" '
+                     'xmlns:tr="http://www.ivoa.net/xml/TAPRegExt/v1.0" '
+                     'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">')
+
+        lines.append('  <capability standardID="ivo://ivoa.net/std/TAP" '
+                     'xsi:type="tr:TableAccess">')
+        lines.append('    <interface xsi:type="vs:ParamHTTP" role="std">')
+        lines.append('      <accessURL use="base">' + baseurl +
+                     '</accessURL>')
+        lines.append('    </interface>')
+        lines.append('    <language>')
+        lines.append('      <name>ADQL</name>')
+        lines.append('      <version ivo-id="ivo://ivoa.net/std/ADQL#v2.0">'
+                     '2.0</version>')
+        lines.append('      <description>ADQL 2.0</description>')
+        lines.append('    </language>')
+
+        for (mime, alias) in self.formats:
+
+            lines.append('    <outputFormat>')
+            lines.append('      <mime>' + mime + '</mime>')
+            lines.append('      <alias>' + alias + '</alias>')
+            lines.append('    </outputFormat>')
+
+        lines.append('  </capability>')
+
+        for resource in self.resources:
+
+            lines.append('  <capability standardID='
+                         '"ivo://ivoa.net/std/VOSI#' + resource + '">')
+            lines.append('    <interface xsi:type="vs:ParamHTTP">')
+            lines.append('      <accessURL use="full">' + baseurl + '/' +
+                         resource + '</accessURL>')
+            lines.append('    </interface>')
+            lines.append('  </capability>')
+
+        lines.append('</vosi:capabilities>')
+
+        return('\n'.join(lines) + '\n')
+
+        #
+        # } end of capabilities def
+        #
+
+
+    def __availability__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        available = 'true'
+        note = 'service is accepting queries'
+
+        try:
+            conn = self.__connect__()
+
+            try:
+                cursor = conn.cursor()
+                cursor.execute('select count(*) from TAP_SCHEMA.tables')
+                cursor.fetchone()
+
+            finally:
+                conn.close()
+
+        except Exception as e:
+
+            available = 'false'
+            note = 'database is not available'
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'vosiDocument availability: {str(e):s}')
+
+        lines = []
+
+        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+        lines.append('<vosi:availability '
+                     'xmlns:vosi="http://www.ivoa.net/xml/VOSIAvailability/v1.0">')
+        lines.append('  <vosi:available>' + available + '</vosi:available>')
+        lines.append('  <vosi:note>' + note + '</vosi:note>')
+        lines.append('</vosi:availability>')
+
+        return('\n'.join(lines) + '\n')
+
+        #
+        # } end of availability def
+        #
+
+
+    def __element__(self, lines, indent, key, value, **kwargs):
+
+        if((value is None) or (len(str(value).strip()) == 0)):
+            return
+
+        lines.append(' '*indent + '<' + key + '>' +
+                     escape(str(value).strip()) + '</' + key + '>')
+
+
+    def __select__(self, conn, table, **kwargs):
+
+        # Rows of a TAP_SCHEMA table as dictionaries keyed by the lower
+        # case column names (the optional columns vary between services)
+        #
+
+        cursor = conn.cursor()
+        cursor.execute('select * from ' + table)
+
+        names = [str(col[0]).lower() for col in cursor.description]
+
+        return([dict(zip(names, row)) for row in cursor.fetchall()])
+
+
+    def __connect__(self, **kwargs):
+
+        if(self.dbms == 'oracle'):
+
+            import cx_Oracle
+
+            conn = cx_Oracle.connect(self.connectInfo['userid'],
+                                     self.connectInfo['password'],
+                                     self.connectInfo['dbserver'])
+        else:
+            import sqlite3
+
+            conn = sqlite3.connect(self.connectInfo['db'])
+
+            conn.execute('ATTACH DATABASE ? AS TAP_SCHEMA',
+                         (self.connectInfo['tap_schema'],))
+
+        return(conn)
+
+
+def main():
+
+    #
+    # Render a VOSI document to check the configuration, e.g.
+    #
+    #     python -m TAP.vosi tables
+    #
+
+    parser = argparse.ArgumentParser(
+        description='Print a VOSI document of the TAP service.')
+
+    parser.add_argument('resource', choices=vosiDocument.resources,
+                        help='VOSI resource')
+    parser.add_argument('--config', default=os.getenv('TAP_CONF', ''),
+                        help='TAP config file (default: $TAP_CONF)')
+
+    args = parser.parse_args()
+
+    config = configParam(args.config)
+
+    version = dataVersion(config.connectInfo, 'TAP_SCHEMA.tables',
+                          mode=config.dataversion,
+                          sql=config.dataversion_sql,
+                          column=config.dataversion_col,
+                          interval=0).version
+
+    doc = vosiDocument(config.connectInfo, args.resource,
+                       baseurl=config.httpurl + '/' + config.cgipgm,
+                       cachedir=config.cachedir, version=version)
+
+    with open(doc.path, 'r') as fp:
+        sys.stdout.write(fp.read())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,1045 +7,1113 @@
 
 #include <Python.h>
 #include <sys/types.h>
+#include <sys/stat.h>
 #include <unistd.h>
 #include <ctype.h>
+#include <stdarg.h>
+#include <string.h>
+#include <strings.h>
+#include <math.h>
 
-static PyObject *method_writerecs(PyObject *self, PyObject *args) {
 
-    PyObject *ddlist = NULL;
-    PyObject *ddarr = NULL;
-    
-    PyObject *datalist = NULL;
-    PyObject *dataarr = NULL;
+/*
+    The formatting of a batch of rows is done in two passes:
 
-    PyObject *item = NULL;
-    PyObject *item_bytes = NULL;
+    1.  With the GIL held, the ddlist is copied into C strings and every
+        cell of the data list is reduced to a plain C value (cellval).
+        The data list can hold the row tuples straight from fetchmany();
+        the optional exclcols argument lists the row columns to skip.
+
+    2.  With the GIL released, the cells are formatted into a growing
+        memory buffer (outbuf).
+
+    writerecs() appends the buffer to the output file, as it always has;
+    formatrecs() returns it as a bytes object so that the caller can format
+    several batches concurrently in worker threads and write them in order.
+*/
+
+#define OUT_IPAC     0
+#define OUT_VOTABLE  1
+#define OUT_CSV      2
+#define OUT_TSV      3
+
+#define COL_OTHER    0
+#define COL_CHAR     1
+#define COL_INT      2
+#define COL_FLOAT    3
+
+#define CELL_NULL    0
+#define CELL_EMPTY   1
+#define CELL_STR     2
+#define CELL_INT     3
+#define CELL_DBL     4
 
-    char filepath[1024];
+
+typedef struct {
+
+    int    ncols;
 
     char **namearr;
     char **typearr;
     char **dbtypearr;
     char **fmtarr;
-    char **descarr;
     char **unitsarr;
+    char **descarr;
 
-    char *cptr1;
+    int   *widtharr;
 
-    int  ishdr;
-    int  coldesc;
-    int  overflow;
-    int  istail;
+    int   *kindarr;
 
-    int  *widtharr;
-    
-    int  ncols;
-    int  nrows_data;
-    int  nrows_dd;
-
-    char    outfmt[40];
-    char    msg[1024];
-    char    fmt[40];
-    char    nullval[20];
-    char    nullval_ipac[20];
-    char    strval[1024];
-    char    substr[40];
-    
-    double  dblval;
-    int     intval;
-    int     istatus;
+    char **valfmtarr;
+    char **nullfmtarr;
 
-    const char *cptr_outpath = NULL;
-    const char *cptr_format = NULL;
-    const char *cptr = NULL;
+} ddinfo;
 
-    int i;
-    int j;
-    int l;
 
-    char debugfname[1024];
-    int  debug  = 0;
-    int  debug1 = 0;
+typedef struct {
 
-    FILE *fp;
-    FILE *fp_debug = (FILE *)NULL;
-    
-    sprintf(debugfname, "/tmp/writerec_%d.debug", getpid());
+    int         kind;
+    long long   ival;
+    double      dval;
+    const char *sval;
 
+} cellval;
 
-    if (debug) {
-        fp_debug = (FILE *)NULL;
-        fp_debug = fopen (debugfname, "w+");
 
-        if (fp_debug == (FILE *)NULL) {
-            printf ("From writerecs: Failed to open debug file\n");
-            fflush (stdout);
+typedef struct {
+
+    char   *data;
+    size_t  len;
+    size_t  size;
+    int     err;
+
+} outbuf;
+
+
+static int debug = 0;
+
+
+static void buf_printf (outbuf *buf, const char *fmt, ...) {
+
+    va_list ap;
+    int     n;
+    size_t  newsize;
+    char   *newdata;
+
+    if (buf->err)
+        return;
+
+    while (1) {
+
+        va_start (ap, fmt);
+        n = vsnprintf (buf->data + buf->len, buf->size - buf->len, fmt, ap);
+        va_end (ap);
+
+        if (n < 0) {
+            buf->err = 1;
+            return;
         }
-    }
 
-/* Parse arguments */
+        if ((size_t)n < buf->size - buf->len) {
+            buf->len += n;
+            return;
+        }
 
-    if(!PyArg_ParseTuple(args, "ssOOiiii", &cptr_outpath, &cptr_format, 
-        &ddlist, &datalist, &ishdr, &coldesc, &overflow, &istail)) {
+        newsize = 2*buf->size + n + 1;
+        newdata = (char *)realloc (buf->data, newsize);
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "PyArg_ParseTuple error\n");
-            fflush (fp_debug);
+        if (newdata == (char *)NULL) {
+            buf->err = 1;
+            return;
         }
 
-        PyErr_SetString (PyExc_Exception, "parseTuple error");
-        return NULL;
+        buf->data = newdata;
+        buf->size = newsize;
     }
+}
 
-    if (cptr_outpath == (char *)NULL) {
-        PyErr_SetString (PyExc_Exception, "Input outpath string empty");
-        return NULL;
+
+static char *copy_str (PyObject *item) {
+
+    const char *cptr;
+
+    if ((item != (PyObject *)NULL) && (PyUnicode_Check (item))) {
+
+        cptr = PyUnicode_AsUTF8 (item);
+
+        if (cptr != (char *)NULL)
+            return strdup (cptr);
+
+        PyErr_Clear ();
     }
-    strcpy (filepath, cptr_outpath);
+    return strdup ("");
+}
 
-    if (cptr_format == (char *)NULL) {
-        PyErr_SetString (PyExc_Exception, "Input format string empty");
-        return NULL;
+
+static void free_ddinfo (ddinfo *dd) {
+
+    int i;
+
+    for (i=0; i<dd->ncols; i++) {
+
+        if (dd->namearr)    free (dd->namearr[i]);
+        if (dd->typearr)    free (dd->typearr[i]);
+        if (dd->dbtypearr)  free (dd->dbtypearr[i]);
+        if (dd->fmtarr)     free (dd->fmtarr[i]);
+        if (dd->unitsarr)   free (dd->unitsarr[i]);
+        if (dd->descarr)    free (dd->descarr[i]);
+        if (dd->valfmtarr)  free (dd->valfmtarr[i]);
+        if (dd->nullfmtarr) free (dd->nullfmtarr[i]);
     }
-    strcpy (outfmt, cptr_format);
 
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "filepath= %s\n", filepath);
-        fprintf (fp_debug, "outfmt= %s\n", outfmt);
-        fprintf (fp_debug, "ishdr= %d\n", ishdr);
-        fprintf (fp_debug, "coldesc= %d\n", coldesc);
-        fprintf (fp_debug, "overflow= %d\n", overflow);
-        fprintf (fp_debug, "istail= %d\n", istail);
-        fflush (fp_debug);
-    } 
+    free (dd->namearr);
+    free (dd->typearr);
+    free (dd->dbtypearr);
+    free (dd->fmtarr);
+    free (dd->unitsarr);
+    free (dd->descarr);
+    free (dd->valfmtarr);
+    free (dd->nullfmtarr);
+    free (dd->widtharr);
+    free (dd->kindarr);
+}
+
+
+static int get_outfmt (const char *format) {
+
+    if (strcasecmp (format, "ipac") == 0)
+        return OUT_IPAC;
+    else if (strcasecmp (format, "votable") == 0)
+        return OUT_VOTABLE;
+    else if (strcasecmp (format, "csv") == 0)
+        return OUT_CSV;
+    else if (strcasecmp (format, "tsv") == 0)
+        return OUT_TSV;
+
+    return -1;
+}
 
 
 /*
-    retrieve datalist
+    Retrieve namearr, typearr, dbtypearr, fmtarr, unitsarr, descarr and
+    widtharr from ddlist and pre-compute the per-column output formats
 */
-    if(!PyList_Check (datalist)) {
+static int parse_ddlist (PyObject *ddlist, int outfmt, ddinfo *dd) {
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "PyList_Check (datalist) failed: return NULL\n");
-            fflush (fp_debug);
-        }
+    PyObject *ddarr = NULL;
+    PyObject *item  = NULL;
 
-        PyErr_SetString (PyExc_Exception, "PyList_Check (datalist) failed.");
-        return NULL;
-    }
+    char      fmt[1024];
+    char     *cptr;
 
-    nrows_data = PyObject_Length (datalist);
+    int       nrows_dd;
+    int       ncols;
+    int       i, j, l;
 
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "nrows_data= %d\n", nrows_data);
-        fflush (fp_debug);
-    } 
-    
-    
-    if(!PyList_Check (ddlist)) {
+    memset (dd, 0, sizeof(ddinfo));
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "PyList_Check failed: return NULL\n");
-            fflush (fp_debug);
-        }
+    if (!PyList_Check (ddlist)) {
         PyErr_SetString (PyExc_Exception, "PyList_Check (ddlist) failed.");
-        return NULL;
+        return -1;
     }
 
-    nrows_dd = PyObject_Length (ddlist);
+    nrows_dd = PyList_Size (ddlist);
 
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "nrows_dd= %d\n", nrows_dd);
-        fflush (fp_debug);
-    } 
-    
-    if (nrows_dd <= 0) {
+    if (nrows_dd < 7) {
         PyErr_SetString (PyExc_Exception, "ddlist empty.");
-        return NULL;
+        return -1;
     }
-    
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "here0\n");
-        fflush (fp_debug);
-    } 
 
-/*
-    retrieve the first tuple to count ncols
-*/
-    ddarr = PyList_GetItem (ddlist, 0); 
-       
-    if (!PySequence_Check (ddarr)) {
+    ddarr = PyList_GetItem (ddlist, 0);
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "PySequence_Check failed: return NULL\n");
-            fflush (fp_debug);
-        }
+    if (!PySequence_Check (ddarr)) {
         PyErr_SetString (PyExc_Exception, "Failed PySequence_Check");
-        return NULL;
+        return -1;
+    }
+
+    ncols = PySequence_Length (ddarr);
+
+    dd->namearr    = (char **)calloc (ncols+1, sizeof(char *));
+    dd->typearr    = (char **)calloc (ncols+1, sizeof(char *));
+    dd->dbtypearr  = (char **)calloc (ncols+1, sizeof(char *));
+    dd->fmtarr     = (char **)calloc (ncols+1, sizeof(char *));
+    dd->unitsarr   = (char **)calloc (ncols+1, sizeof(char *));
+    dd->descarr    = (char **)calloc (ncols+1, sizeof(char *));
+    dd->valfmtarr  = (char **)calloc (ncols+1, sizeof(char *));
+    dd->nullfmtarr = (char **)calloc (ncols+1, sizeof(char *));
+    dd->widtharr   = (int *)calloc (ncols+1, sizeof(int));
+    dd->kindarr    = (int *)calloc (ncols+1, sizeof(int));
+
+    if ((dd->namearr    == (char **)NULL) ||
+        (dd->typearr    == (char **)NULL) ||
+        (dd->dbtypearr  == (char **)NULL) ||
+        (dd->fmtarr     == (char **)NULL) ||
+        (dd->unitsarr   == (char **)NULL) ||
+        (dd->descarr    == (char **)NULL) ||
+        (dd->valfmtarr  == (char **)NULL) ||
+        (dd->nullfmtarr == (char **)NULL) ||
+        (dd->widtharr   == (int *)NULL)   ||
+        (dd->kindarr    == (int *)NULL)) {
+
+        free_ddinfo (dd);
+        PyErr_SetString (PyExc_Exception, "Failed to malloc dd arrays");
+        return -1;
     }
-       
-    ncols = PyObject_Length (ddarr);
-        
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "ncols= %d\n", ncols);
-        fflush (fp_debug);
-    }         
 
+    dd->ncols = ncols;
+
+    for (l=0; l<7; l++) {
+
+        ddarr = PyList_GetItem (ddlist, l);
+
+        if ((!PySequence_Check (ddarr))
+            || (PySequence_Length (ddarr) < ncols)) {
+
+            free_ddinfo (dd);
+            PyErr_SetString (PyExc_Exception, "Failed PySequence_Check");
+            return -1;
+        }
+
+        for (i=0; i<ncols; i++) {
+
+            item = PySequence_GetItem (ddarr, i);
+
+            if (l == 0) {
+                dd->namearr[i] = copy_str (item);
+
+                for (j=0; j<(int)strlen(dd->namearr[i]); ++j)
+                   dd->namearr[i][j] = tolower(dd->namearr[i][j]);
+            }
+            else if (l == 1) {
 /*
-    malloc arrays
+    typearr: date and timestamp output file type is char
 */
-    namearr = (char **)NULL;
-    namearr = (char **)malloc (ncols*sizeof(char *));
-    if (namearr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc namearr");
-        return NULL;
-    }
-    for (i=0; i<ncols; i++) {
-        namearr[i] = (char *)NULL;
-        namearr[i] = (char *)malloc (40*sizeof(char));
-        if (namearr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc namearr");
-            return NULL;
+                dd->typearr[i] = copy_str (item);
+
+                if ((strcasecmp (dd->typearr[i], "date") == 0) ||
+                    (strcasecmp (dd->typearr[i], "timestamp") == 0)) {
+
+                    free (dd->typearr[i]);
+                    dd->typearr[i] = strdup ("char");
+                }
+            }
+            else if (l == 2)
+                dd->dbtypearr[i] = copy_str (item);
+            else if (l == 3)
+                dd->fmtarr[i] = copy_str (item);
+            else if (l == 4)
+                dd->unitsarr[i] = copy_str (item);
+            else if (l == 5)
+                dd->descarr[i] = copy_str (item);
+            else {
+/*
+    the last dd row is widtharr: integer type
+*/
+                dd->widtharr[i] = 0;
+                if ((item != (PyObject *)NULL) && (PyLong_Check (item)))
+                    dd->widtharr[i] = PyLong_AsLong (item);
+            }
+
+            Py_XDECREF (item);
         }
     }
 
-    typearr = (char **)NULL;
-    typearr = (char **)malloc (ncols*sizeof(char *));
-    if (typearr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc typearr");
-        return NULL;
-    }
     for (i=0; i<ncols; i++) {
-        typearr[i] = (char *)NULL;
-        typearr[i] = (char *)malloc (20*sizeof(char));
-        if (typearr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc typearr");
-            return NULL;
+
+        if ((dd->namearr[i]   == (char *)NULL) ||
+            (dd->typearr[i]   == (char *)NULL) ||
+            (dd->dbtypearr[i] == (char *)NULL) ||
+            (dd->fmtarr[i]    == (char *)NULL) ||
+            (dd->unitsarr[i]  == (char *)NULL) ||
+            (dd->descarr[i]   == (char *)NULL)) {
+
+            free_ddinfo (dd);
+            PyErr_SetString (PyExc_Exception, "Failed to malloc dd arrays");
+            return -1;
         }
-    }
 
-    dbtypearr = (char **)NULL;
-    dbtypearr = (char **)malloc (ncols*sizeof(char *));
-    if (dbtypearr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc dbtypearr");
-        return NULL;
-    }
-    for (i=0; i<ncols; i++) {
-        dbtypearr[i] = (char *)NULL;
-        dbtypearr[i] = (char *)malloc (40*sizeof(char));
-        if (dbtypearr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc dbtypearr");
-            return NULL;
+        if ((strcasecmp (dd->typearr[i],   "char") == 0) ||
+            (strcasecmp (dd->typearr[i],   "date") == 0) ||
+            (strcasecmp (dd->dbtypearr[i], "timestamp") == 0))
+
+            dd->kindarr[i] = COL_CHAR;
+
+        else if ((strcasecmp (dd->typearr[i], "int"    ) == 0) ||
+                 (strcasecmp (dd->typearr[i], "long"   ) == 0) ||
+                 (strcasecmp (dd->typearr[i], "short"  ) == 0) ||
+                 (strcasecmp (dd->typearr[i], "integer") == 0))
+
+            dd->kindarr[i] = COL_INT;
+
+        else if ((strcasecmp (dd->typearr[i], "float" ) == 0) ||
+                 (strcasecmp (dd->typearr[i], "double") == 0))
+
+            dd->kindarr[i] = COL_FLOAT;
+
+        else
+            dd->kindarr[i] = COL_OTHER;
+
+/*
+    Value format: e.g. "%-30s ", "%-22lld", "%-22.14e"; non-ipac tables
+    strip the width element from the double format
+*/
+        strcpy (fmt, "");
+
+        if (dd->kindarr[i] == COL_CHAR) {
+
+            snprintf (fmt, sizeof(fmt), "%%-%s ", dd->fmtarr[i]);
         }
-    }
+        else if (dd->kindarr[i] == COL_INT) {
 
-    fmtarr = (char **)NULL;
-    fmtarr = (char **)malloc (ncols*sizeof(char *));
-    if (fmtarr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc fmtarr array");
-        return NULL;
-    }
-    for (i=0; i<ncols; i++) {
-        fmtarr[i] = (char *)NULL;
-        fmtarr[i] = (char *)malloc (40*sizeof(char));
-        if (fmtarr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc fmtarr");
-            return NULL;
+            snprintf (fmt, sizeof(fmt), "%%-%s", dd->fmtarr[i]);
+
+            cptr = strrchr (fmt, 'd');
+            if ((cptr != (char *)NULL) && (*(cptr+1) == '\0'))
+                strcpy (cptr, "lld");
+            else
+                snprintf (fmt, sizeof(fmt), "%%-%dlld", dd->widtharr[i]);
         }
-    }
+        else if (dd->kindarr[i] == COL_FLOAT) {
 
-    descarr = (char **)NULL;
-    descarr = (char **)malloc (ncols*sizeof(char *));
-    if (descarr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc descarr array");
-        return NULL;
+            snprintf (fmt, sizeof(fmt), "%%-%s", dd->fmtarr[i]);
+
+            if (outfmt != OUT_IPAC) {
+
+                cptr = strchr (dd->fmtarr[i], '.');
+                if (cptr != (char *)NULL)
+                    snprintf (fmt, sizeof(fmt), "%%%s", cptr);
+            }
+        }
+
+        dd->valfmtarr[i] = strdup (fmt);
+
+        snprintf (fmt, sizeof(fmt), "%%-%ds ", dd->widtharr[i]);
+        dd->nullfmtarr[i] = strdup (fmt);
+
+        if ((dd->valfmtarr[i] == (char *)NULL)
+            || (dd->nullfmtarr[i] == (char *)NULL)) {
+
+            free_ddinfo (dd);
+            PyErr_SetString (PyExc_Exception, "Failed to malloc dd arrays");
+            return -1;
+        }
     }
-    for (i=0; i<ncols; i++) {
-        descarr[i] = (char *)NULL;
-        descarr[i] = (char *)malloc (1024*sizeof(char));
-        if (descarr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc descarr");
-            return NULL;
+
+    return 0;
+}
+
+
+/*
+    Map the output columns to the row item indices, skipping the excluded
+    row columns (exclcols may be NULL or a sequence of row indices).
+*/
+static int *make_colmap (PyObject *exclcols, int ncols) {
+
+    PyObject *item = NULL;
+
+    int      *colmap;
+    int      *excl;
+    int       nexcl;
+    int       i, j, k, skip;
+
+    nexcl = 0;
+    excl  = (int *)NULL;
+
+    if ((exclcols != (PyObject *)NULL) && (exclcols != Py_None)) {
+
+        if (!PySequence_Check (exclcols)) {
+            PyErr_SetString (PyExc_Exception,
+                "exclcols must be a sequence of column indices");
+            return (int *)NULL;
+        }
+
+        nexcl = PySequence_Length (exclcols);
+        excl  = (int *)malloc ((nexcl+1)*sizeof(int));
+
+        if (excl == (int *)NULL) {
+            PyErr_SetString (PyExc_Exception, "Failed to malloc colmap");
+            return (int *)NULL;
+        }
+
+        for (k=0; k<nexcl; k++) {
+
+            item = PySequence_GetItem (exclcols, k);
+
+            excl[k] = -1;
+            if ((item != (PyObject *)NULL) && (PyLong_Check (item)))
+                excl[k] = PyLong_AsLong (item);
+
+            Py_XDECREF (item);
         }
     }
 
-    unitsarr = (char **)NULL;
-    unitsarr = (char **)malloc (ncols*sizeof(char *));
-    if (unitsarr == (char **)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc unitsarr array");
-        return NULL;
+    colmap = (int *)malloc ((ncols+1)*sizeof(int));
+
+    if (colmap == (int *)NULL) {
+        free (excl);
+        PyErr_SetString (PyExc_Exception, "Failed to malloc colmap");
+        return (int *)NULL;
     }
+
+    j = 0;
     for (i=0; i<ncols; i++) {
-        unitsarr[i] = (char *)NULL;
-        unitsarr[i] = (char *)malloc (40*sizeof(char));
-        if (unitsarr[i] == (char *)NULL) {
-            PyErr_SetString (PyExc_Exception, "Failed to malloc unitsarr");
-            return NULL;
+
+        while (1) {
+
+            skip = 0;
+            for (k=0; k<nexcl; k++) {
+                if (excl[k] == j)
+                    skip = 1;
+            }
+
+            if (!skip)
+                break;
+
+            j++;
         }
-    }
 
-    widtharr = (int *)NULL;
-    widtharr = (int *)malloc (ncols*sizeof(int));
-    if (widtharr == (int *)NULL) {
-        PyErr_SetString (PyExc_Exception, "Failed to malloc widtharr");
-        return NULL;
+        colmap[i] = j;
+        j++;
     }
 
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "\nDone malloc dd arrays\n");
-        fflush (fp_debug);
-    }
+    free (excl);
+
+    return colmap;
+}
+
 
 /*
-    retrieve namearr, typearr, dbtypearr, fmtarr, unitsarr, descarr, widtharr
+    Reduce each cell of datalist to a C value.  The rows can be the raw
+    row tuples returned by fetchmany(): colmap gives the row item index of
+    each output column.  Non-string values in char columns (dates,
+    timestamps, ...) are converted with str(); the converted objects are
+    kept alive in the keep list.  String pointers refer to the UTF-8
+    buffers cached in the string objects, which stay alive (and unchanged)
+    for as long as datalist and keep are referenced.
 */
-    for (l=0; l<nrows_dd; l++) {
+static cellval *extract_cells (PyObject *datalist, ddinfo *dd, int *colmap,
+    PyObject *keep, int *nrows) {
+
+    PyObject  *rowseq = NULL;
+    PyObject  *item   = NULL;
+    PyObject  *strobj = NULL;
+    PyObject **items;
+
+    cellval   *cells;
+    cellval   *cell;
+
+    Py_ssize_t rowlen;
+
+    int        nrows_data;
+    int        ncols;
+    int        i, j, l;
+
+    ncols = dd->ncols;
+
+    if (!PyList_Check (datalist)) {
+        PyErr_SetString (PyExc_Exception, "PyList_Check (datalist) failed.");
+        return (cellval *)NULL;
+    }
+
+    nrows_data = PyList_Size (datalist);
+
+    cells = (cellval *)malloc ((size_t)(nrows_data*ncols + 1)*sizeof(cellval));
+
+    if (cells == (cellval *)NULL) {
+        PyErr_SetString (PyExc_Exception, "Failed to malloc cell array");
+        return (cellval *)NULL;
+    }
+
+    for (l=0; l<nrows_data; l++) {
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "\nl= [%d]\n", l );
-            fflush (fp_debug);
+        rowseq = PyList_GetItem (datalist, l);
+
+        if ((!PyTuple_Check (rowseq)) && (!PyList_Check (rowseq))) {
+
+            free (cells);
+            PyErr_SetString (PyExc_Exception,
+                "Failed PyTuple_Check/PyList_Check (dataarr)");
+            return (cellval *)NULL;
         }
-        
-        ddarr = PyList_GetItem (ddlist, l); 
 
-        if (!PySequence_Check (ddarr)) {
+        items  = PySequence_Fast_ITEMS (rowseq);
+        rowlen = PySequence_Fast_GET_SIZE (rowseq);
+
+        for (i=0; i<ncols; i++) {
+
+            cell = &cells[l*ncols + i];
+
+            cell->kind = CELL_EMPTY;
+            cell->ival = 0;
+            cell->dval = 0.;
+            cell->sval = "";
 
-            if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                fprintf (fp_debug, "PySequence_Check failed: return NULL\n");
-                fflush (fp_debug);
+            j = colmap[i];
+
+            if (j >= rowlen) {
+                cell->kind = CELL_NULL;
+                continue;
             }
-            PyErr_SetString (PyExc_Exception, "Failed PySequence_Check");
-            return NULL;
-        }
-       
-        if (l < nrows_dd-1) {
-        
-            for (i=0; i<ncols; i++) {
-       
-                item = PySequence_GetItem (ddarr, i); 
 
-                strcpy (strval, "");
+            item = items[j];
+
+            if (item == Py_None) {
+                cell->kind = CELL_NULL;
+            }
+            else if (dd->kindarr[i] == COL_CHAR) {
+
                 if (!PyUnicode_Check (item)) {
-                
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "here1-2\n");
-                        fprintf (fp_debug, "strval= %s\n", strval);
-                        fflush (fp_debug);
-                    }
-                }
-                else {
-                    item_bytes 
-                        = PyUnicode_AsEncodedString (item, "UTF-8", "strict");
 
-                    if (item_bytes != NULL) {
-                        cptr = PyBytes_AS_STRING (item_bytes);
-                        strcpy (strval, cptr);
-                    }
-                }
+                    strobj = PyObject_Str (item);
 
-                if (l == 0) {
-                    strcpy (namearr[i], strval);
+                    if ((strobj == (PyObject *)NULL)
+                        || (PyList_Append (keep, strobj) < 0)) {
 
-                    for(j=0; j<(int)strlen(namearr[i]); ++j)
-                       namearr[i][j] = tolower(namearr[i][j]);
-                
-                    if ((debug) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "namearr[%d]= [%s]\n", 
-                            i, namearr[i]);
-                        fflush (fp_debug);
-                    }
-                }
-                else if (l == 1) {
-/*
-    typearr: date and timestamp output file type is char
-*/  
-                    if ((strcasecmp (strval, "date") == 0) ||
-                        (strcasecmp (strval, "timestamp") == 0)) {
-                        
-                        strcpy (typearr[i], "char");
-                    }
-                    else {
-                        strcpy (typearr[i], strval);
+                        Py_XDECREF (strobj);
+                        free (cells);
+                        return (cellval *)NULL;
                     }
 
-                    if ((debug) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "typearr[%d]= [%s]\n", 
-                            i, typearr[i]);
-                        fflush (fp_debug);
-                    }
+                    Py_DECREF (strobj);
+                    item = strobj;
                 }
-                else if (l == 2) {
-/*
-    dbtypearr
-*/  
-                    strcpy (dbtypearr[i], strval);
-                    if ((debug) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "dbtypearr[%d]= [%s]\n", 
-                            i, dbtypearr[i]);
-                        fflush (fp_debug);
-                    }
-                }
-                else if (l == 3) {
-                    strcpy (fmtarr[i], strval);
-                    if ((debug) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "fmtarr[%d]= [%s]\n", 
-                            i, fmtarr[i]);
-                        fflush (fp_debug);
-                    }
+
+                cell->sval = PyUnicode_AsUTF8 (item);
+
+                if (cell->sval == (char *)NULL) {
+                    PyErr_Clear ();
+                    cell->sval = "";
                 }
-                else if (l == 4) {
-                    strcpy (unitsarr[i], strval);
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "unitsarr[%d]= [%s]\n", 
-                            i, unitsarr[i]);
-                        fflush (fp_debug);
-                    }
+                cell->kind = CELL_STR;
+            }
+            else if (dd->kindarr[i] == COL_INT) {
+
+                if (PyLong_Check (item)) {
+
+                    cell->ival = PyLong_AsLongLong (item);
+
+                    if (PyErr_Occurred ())
+                        PyErr_Clear ();
+                    else
+                        cell->kind = CELL_INT;
                 }
-                else if (l == 5) {
-                    strcpy (descarr[i], strval);
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "descarr[%d]= [%s]\n", 
-                            i, descarr[i]);
-                        fflush (fp_debug);
+                else if (PyFloat_Check (item)) {
+
+                    /*
+                        The column type may have been inferred from a
+                        sample: print non-integral floats as doubles
+                    */
+                    cell->dval = PyFloat_AS_DOUBLE (item);
+                    cell->kind = CELL_DBL;
+
+                    if ((cell->dval == floor (cell->dval))
+                        && (fabs (cell->dval) < 9.0e18)) {
+
+                        cell->ival = (long long)cell->dval;
+                        cell->kind = CELL_INT;
                     }
                 }
             }
-                    
-        }
-        else {
-/*
-    the last dd row is widtharr: integer type
-*/
-            for (i=0; i<ncols; i++) {
-       
-                item = PySequence_GetItem (ddarr, i); 
-              
-                intval = 0;
-                if (PyLong_Check (item)) {
-                    intval = PyLong_AsLong (item);
+            else if (dd->kindarr[i] == COL_FLOAT) {
+
+                if (PyFloat_Check (item)) {
+
+                    cell->dval = PyFloat_AS_DOUBLE (item);
+                    cell->kind = CELL_DBL;
                 }
-                
-                widtharr[i] = intval;
+                else if (PyLong_Check (item)) {
 
-                if ((debug) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "widtharr[%d]= [%d]\n", 
-                        i, widtharr[i]);
-                    fflush (fp_debug);
+                    cell->dval = PyLong_AsDouble (item);
+
+                    if (PyErr_Occurred ())
+                        PyErr_Clear ();
+                    else
+                        cell->kind = CELL_DBL;
                 }
             }
         }
     }
-            
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "\nDone with ddlist retrieval\n");
-        fflush (fp_debug);
-    }
 
-/*
-    open filepath to write header
-*/
-    fp = (FILE *)NULL;
-    if (ishdr) {
-        fp = fopen (filepath, "w+");
-        chmod(filepath, 0664);
-    }
-    else {
-        fp = fopen (filepath, "a");
-    }
+    *nrows = nrows_data;
+    return cells;
+}
 
-    if (fp == (FILE *)NULL) {
-        sprintf (msg, "Failed to open filepath: [%s]\n", filepath);
-        
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "msg= [%s]\n", msg);
-            fflush (fp_debug);
-        }
 
-        PyErr_SetString (PyExc_Exception, msg);
-        return NULL;
-    }
+static void write_sep (outbuf *buf, int outfmt, int i, int ncols) {
 
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "filepath [%s] opened for write\n", filepath);
-        fflush (fp_debug);
+    if (outfmt == OUT_IPAC) {
+        if (i == ncols-1)
+            buf_printf (buf, "\n");
+    }
+    else if (outfmt == OUT_CSV) {
+        if (i == ncols-1)
+            buf_printf (buf, "\n");
+        else
+            buf_printf (buf, ",");
+    }
+    else if (outfmt == OUT_TSV) {
+        if (i == ncols-1)
+            buf_printf (buf, "\n");
+        else
+            buf_printf (buf, "\t");
     }
+}
 
-/*
-    write header
-*/
-    strcpy (nullval, "");
-    strcpy (nullval_ipac, "null");
-    if (ishdr) {
-        
-        if (strcasecmp (outfmt, "ipac") == 0) {
-    
 
-//            fprintf (fp, "\\\n");
-//            fprintf (fp, "\\RowsRetrieved = %10d\n", nrows_data);
+static void write_header (outbuf *buf, ddinfo *dd, int outfmt,
+    int coldesc, int overflow) {
+
+    int i;
+    int ncols = dd->ncols;
+
+    if (outfmt == OUT_IPAC) {
 
 /*
     if coldesc =1: write column description -- currently not implemented
 */
-            if (coldesc) {
-
-            }
+        if (coldesc) {
 
-            fprintf (fp, "|");
-            for (i=0; i<ncols; i++) {
-                sprintf (fmt, "%%-%ds|", widtharr[i]);
-                fprintf (fp, fmt, namearr[i]); 
-            }
-            fprintf (fp, "\n");
-            fflush (fp);
+        }
 
-            fprintf (fp, "|");
-            for (i=0; i<ncols; i++) {
-                sprintf (fmt, "%%-%ds|", widtharr[i]);
-                fprintf (fp, fmt, typearr[i]); 
-            }
-            fprintf (fp, "\n");
-            fflush (fp);
+        buf_printf (buf, "|");
+        for (i=0; i<ncols; i++)
+            buf_printf (buf, "%-*s|", dd->widtharr[i], dd->namearr[i]);
+        buf_printf (buf, "\n");
+
+        buf_printf (buf, "|");
+        for (i=0; i<ncols; i++)
+            buf_printf (buf, "%-*s|", dd->widtharr[i], dd->typearr[i]);
+        buf_printf (buf, "\n");
+
+        buf_printf (buf, "|");
+        for (i=0; i<ncols; i++)
+            buf_printf (buf, "%-*s|", dd->widtharr[i], dd->unitsarr[i]);
+        buf_printf (buf, "\n");
+
+        buf_printf (buf, "|");
+        for (i=0; i<ncols; i++)
+            buf_printf (buf, "%-*s|", dd->widtharr[i], "null");
+        buf_printf (buf, "\n");
+    }
+    else if (outfmt == OUT_VOTABLE) {
 
-            fprintf (fp, "|");
-            for (i=0; i<ncols; i++) {
-                sprintf (fmt, "%%-%ds|", widtharr[i]);
-                fprintf (fp, fmt, unitsarr[i]); 
-            }
-            fprintf (fp, "\n");
-            fflush (fp);
+        buf_printf (buf, "<?xml version=\"1.0\" encoding=\"utf-8\"?>\n");
+        buf_printf (buf, "<VOTABLE version=\"1.3\" xmlns=\"http://www.ivoa.net/xml/VOTable/v1.3\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation=\"http://www.ivoa.net/xml/VOTable/v1.3\">\n");
 
-            fprintf (fp, "|");
-            for (i=0; i<ncols; i++) {
-                sprintf (fmt, "%%-%ds|", widtharr[i]);
-                fprintf (fp, fmt, nullval_ipac); 
-            }
-            fprintf (fp, "\n");
-            fflush (fp);
+        buf_printf (buf, "  <RESOURCE type=\"results\">\n");
 
+        if (overflow) {
+            buf_printf (buf,
+                "  <INFO name=\"QUERY_STATUS\" value=\"OVERFLOW\"/>\n");
         }
-        else if (strcasecmp (outfmt, "votable") == 0) {
-   
-            fprintf (fp, "<?xml version=\"1.0\" encoding=\"utf-8\"?>\n");
-            fprintf (fp, "<VOTABLE version=\"1.3\" xmlns=\"http://www.ivoa.net/xml/VOTable/v1.3\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation=\"http://www.ivoa.net/xml/VOTable/v1.3\">\n");
-        
-            fprintf (fp, "  <RESOURCE type=\"results\">\n");
-        
-            if (overflow) {
-                fprintf (fp, 
-                    "  <INFO name=\"QUERY_STATUS\" value=\"OVERFLOW\"/>\n");
-            }
-            else {
-                fprintf (fp, "  <INFO name=\"QUERY_STATUS\" value=\"OK\"/>\n");
-            }
-    
-            fprintf (fp, "  <TABLE>\n");
-       
-            for (i=0; i<ncols; i++) { 
-    
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-        
-                    fprintf (fp_debug, "i= [%d] namearr= [%s]\n",
-                        i, namearr[i]);
-                    fprintf (fp_debug, "widtharr= [%d] typearr= [%s]\n",
-                        widtharr[i], typearr[i]);
-                    fflush (fp_debug);
-                }
-            
-                if (strcasecmp (typearr[i], "char") == 0) {
-
-                    fprintf (fp, 
-                        "    <FIELD ID=\"%s\" arraysize=\"*\" datatype=\"%s\" "
-                        "name=\"%s\"/>\n", namearr[i], typearr[i], namearr[i]);
-                }
-                else {
-                    fprintf (fp, 
-                        "    <FIELD ID=\"%s\" datatype=\"%s\" name=\"%s\"/>\n", 
-                        namearr[i], typearr[i], namearr[i]);
-                }
-            }
+        else {
+            buf_printf (buf, "  <INFO name=\"QUERY_STATUS\" value=\"OK\"/>\n");
         }
-        else if (strcasecmp (outfmt, "csv") == 0) {
-   
-            for (i=0; i<ncols; i++) { 
-            
-                if (i == ncols-1) { 
-                    fprintf (fp, "%s", namearr[i]);
-                }
-                else {
-                    fprintf (fp, "%s,", namearr[i]);
-                }
+
+        buf_printf (buf, "  <TABLE>\n");
+
+        for (i=0; i<ncols; i++) {
+
+            if (strcasecmp (dd->typearr[i], "char") == 0) {
+
+                buf_printf (buf,
+                    "    <FIELD ID=\"%s\" arraysize=\"*\" datatype=\"%s\" "
+                    "name=\"%s\"/>\n",
+                    dd->namearr[i], dd->typearr[i], dd->namearr[i]);
             }
-            fprintf (fp, "\n");
-        }
-        else if (strcasecmp (outfmt, "tsv") == 0) {
-    
-            for (i=0; i<ncols; i++) { 
-            
-                if (i == ncols-1) { 
-                    fprintf (fp, "%s", namearr[i]);
-                }
-                else {
-                    fprintf (fp, "%s\t", namearr[i]);
-                }
+            else {
+                buf_printf (buf,
+                    "    <FIELD ID=\"%s\" datatype=\"%s\" name=\"%s\"/>\n",
+                    dd->namearr[i], dd->typearr[i], dd->namearr[i]);
             }
-            fprintf (fp, "\n");
         }
-        fflush (fp);
-   
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-           fprintf (fp_debug, "Done write header\n");
-           fflush (fp_debug);
+    }
+    else if ((outfmt == OUT_CSV) || (outfmt == OUT_TSV)) {
+
+        for (i=0; i<ncols; i++) {
+
+            buf_printf (buf, "%s", dd->namearr[i]);
+            write_sep (buf, outfmt, i, ncols);
         }
+        if (ncols == 0)
+            buf_printf (buf, "\n");
     }
+}
 
 
 /*
-    retieve data rows
+    Format the header (if ishdr), the data rows and the tail (if istail)
+    into buf.  No Python API calls are made here: the caller releases
+    the GIL around it.
 */
-    if ((nrows_data == 0) && (ishdr == 1) && (istail == 1)) {
+static void format_rows (outbuf *buf, ddinfo *dd, cellval *cells,
+    int nrows_data, int outfmt, int ishdr, int coldesc, int overflow,
+    int istail) {
 
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "here0-1: write tail for empty table\n");
-            fflush (fp_debug);
-        } 
+    cellval *cell;
 
-        if (strcasecmp (outfmt, "votable") == 0) {
-  
-            fprintf (fp, "  </TABLE>\n");
-            fprintf (fp, "  </RESOURCE>\n");
-            fprintf (fp, "</VOTABLE>\n");
-        }
-        fflush (fp);
-        fclose (fp);
+    char     strval[128];
 
-        istatus = 0;    
-        return PyLong_FromLong (istatus);
-    }
-    
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "here0-2\n");
-        fflush (fp_debug);
-    } 
+    int      ncols = dd->ncols;
+    int      i, l;
 
+    if (ishdr)
+        write_header (buf, dd, outfmt, coldesc, overflow);
+
+    if ((nrows_data == 0) && (ishdr == 1) && (istail == 1)) {
 
 /*
-    retrieve each row and format output line 
+    write tail for empty table
 */
-    if ((strcasecmp (outfmt, "votable") == 0) && (ishdr == 1)) {
-  
-        fprintf (fp, "    <DATA>\n");
-        fprintf (fp, "      <TABLEDATA>\n");
+        if (outfmt == OUT_VOTABLE) {
+
+            buf_printf (buf, "  </TABLE>\n");
+            buf_printf (buf, "  </RESOURCE>\n");
+            buf_printf (buf, "</VOTABLE>\n");
+        }
+        return;
     }
 
-    for (l=0; l<nrows_data; l++) {
+    if ((outfmt == OUT_VOTABLE) && (ishdr == 1)) {
 
-        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "\nxxxl= [%d]\n", l );
-            fflush (fp_debug);
-        }
-        
-        dataarr = PyList_GetItem (datalist, l); 
+        buf_printf (buf, "    <DATA>\n");
+        buf_printf (buf, "      <TABLEDATA>\n");
+    }
 
-        if (!PyList_Check (dataarr)) {
+    for (l=0; l<nrows_data; l++) {
 
-            if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                fprintf (fp_debug, 
-                    "PyList_Check (dataarr) failed: return NULL\n");
-                fflush (fp_debug);
-            }
-            PyErr_SetString (PyExc_Exception, "Failed PyList_Check (dataarr)");
-            return NULL;
-        }
-       
-        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "here0-3\n");
-            fflush (fp_debug);
-        }     
-
-        if (strcasecmp (outfmt, "ipac") == 0) {
-        
-            fprintf (fp, " ");
-        }
-        else if (strcasecmp (outfmt, "votable") == 0) {
-  
-            fprintf (fp, "        <TR>\n");
-        }
+        if (outfmt == OUT_IPAC)
+            buf_printf (buf, " ");
+        else if (outfmt == OUT_VOTABLE)
+            buf_printf (buf, "        <TR>\n");
 
         for (i=0; i<ncols; i++) {
-       
-            item = PyList_GetItem (dataarr, i); 
-            
-            const char* coltype = Py_TYPE(item)->tp_name;
-
-            if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                fprintf (fp_debug, "i= [%d] namearr= [%s]\n", i, namearr[i]);
-                fflush (fp_debug);
-                
-                fprintf (fp_debug, "PyObject type:[%s], typearr[i]: [%s]\n", coltype, typearr[i]);
-                fflush (fp_debug);
-            }
 
-            if (item == Py_None) {
-                
-                sprintf (fmt, "%%-%ds ", widtharr[i]);
-            
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "i= [%d] PyNone\n", i);
-                    fprintf (fp_debug, "fmt= [%s]\n", fmt);
-                    fflush (fp_debug);
-                }
-                
-                if (strcasecmp (outfmt, "ipac") == 0) {
-        
-                    fprintf (fp, fmt, nullval_ipac);
-                    if (i == ncols-1) {
-                        fprintf (fp, "\n");
-                        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                            fprintf (fp_debug, 
-                                "new line written: i= [%d] ncols= [%d]\n", 
-                                i, ncols);
-                            fflush (fp_debug);
-                        }
-                    }
-                }
-                else if (strcasecmp (outfmt, "votable") == 0) {
-                        
-                    fprintf (fp, "        <TD>%s</TD>\n", nullval);
-                }
-                else if (strcasecmp (outfmt, "csv") == 0) {
+            cell = &cells[l*ncols + i];
 
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", nullval);
-                    }
-                    else {
-                        fprintf (fp, "%s,", nullval);
-                    }
-                }
-                else if (strcasecmp (outfmt, "tsv") == 0) {
-            
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", nullval);
-                    }
-                    else {
-                        fprintf (fp, "%s\t", nullval);
-                    }
-                }     
+            if (cell->kind == CELL_NULL) {
+
+                if (outfmt == OUT_IPAC)
+                    buf_printf (buf, dd->nullfmtarr[i], "null");
+                else if (outfmt == OUT_VOTABLE)
+                    buf_printf (buf, "        <TD></TD>\n");
+
+                write_sep (buf, outfmt, i, ncols);
+            }
+            else if (dd->kindarr[i] == COL_CHAR) {
+
+                if (outfmt == OUT_IPAC)
+                    buf_printf (buf, dd->valfmtarr[i], cell->sval);
+                else if (outfmt == OUT_VOTABLE)
+                    buf_printf (buf, "        <TD><![CDATA[%s]]></TD>\n",
+                        cell->sval);
+                else if (outfmt == OUT_CSV)
+                    buf_printf (buf, "\"%s\"", cell->sval);
+                else
+                    buf_printf (buf, "%s", cell->sval);
+
+                write_sep (buf, outfmt, i, ncols);
             }
-            else if ((strcasecmp (typearr[i],   "char") == 0) || 
-                     (strcasecmp (typearr[i],   "date") == 0) ||
-                     (strcasecmp (dbtypearr[i], "timestamp") == 0)) {
+            else if (dd->kindarr[i] == COL_INT) {
 
                 strcpy (strval, "");
-                if (PyUnicode_Check (item)) {
-                
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "pass Unicode check\n");
-                        fflush (fp_debug);
-                    }
 
-                    item_bytes = PyUnicode_AsEncodedString (item, 
-                        "UTF-8", "strict");
+                if (cell->kind == CELL_INT) {
 
-                    if (item_bytes != NULL) {
-                        cptr = PyBytes_AS_STRING (item_bytes);
-                        strcpy (strval, cptr);
-                    }
+                    if (outfmt == OUT_IPAC)
+                        snprintf (strval, sizeof(strval), dd->valfmtarr[i],
+                            cell->ival);
+                    else
+                        snprintf (strval, sizeof(strval), "%lld", cell->ival);
                 }
-                
-                
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "i= [%d] strval= [%s]\n", i, strval);
-                    fflush (fp_debug);
+                else if (cell->kind == CELL_DBL) {
+
+                    if (outfmt == OUT_IPAC)
+                        snprintf (strval, sizeof(strval), "%-*.14e",
+                            dd->widtharr[i], cell->dval);
+                    else
+                        snprintf (strval, sizeof(strval), "%.14e",
+                            cell->dval);
                 }
 
-                if (strcasecmp (outfmt, "ipac") == 0) {
-                    
-                    sprintf (fmt, "%%-%s ", fmtarr[i]);
-                    
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "fmt= [%s]\n", fmt);
-                        fflush (fp_debug);
-                    }
-                    
-                    fprintf (fp, fmt, strval);
-                
-                    if (i == ncols-1) {
-                        fprintf (fp, "\n");
-                        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                            fprintf (fp_debug, 
-                                "new line written: i= [%d] ncols= [%d]\n", 
-                                i, ncols);
-                            fflush (fp_debug);
-                        }
-                    }
-                
-                }
-                else if (strcasecmp (outfmt, "votable") == 0) {
-       
-                    fprintf (fp, "        <TD><![CDATA[%s]]></TD>\n", strval);
-                }
-                else if (strcasecmp (outfmt, "csv") == 0) {
+                if (outfmt == OUT_IPAC)
+                    buf_printf (buf, "%s ", strval);
+                else if (outfmt == OUT_VOTABLE)
+                    buf_printf (buf, "        <TD>%s</TD>\n", strval);
+                else
+                    buf_printf (buf, "%s", strval);
 
-                    if (i == ncols-1) {
-                        fprintf (fp, "\"%s\"\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "\"%s\",", strval);
-                    }
-                }
-                else if (strcasecmp (outfmt, "tsv") == 0) {
-            
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "%s\t", strval);
-                    }
-                } 
-            
+                write_sep (buf, outfmt, i, ncols);
             }
-            else if ((strcasecmp (typearr[i], "int"    ) == 0) || 
-                     (strcasecmp (typearr[i], "long"   ) == 0) ||
-                     (strcasecmp (typearr[i], "integer") == 0)) {
-
-                sprintf (fmt, "%%-%s", fmtarr[i]);
-                        
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "fmt= [%s]\n", fmt);
-                    fflush (fp_debug);
-                }
-                    
+            else if (dd->kindarr[i] == COL_FLOAT) {
+
                 strcpy (strval, "");
-                if (PyLong_Check (item)) {
-               
-                    intval = PyLong_AsLong (item);
-                    sprintf (strval, fmt, intval);
-                }
 
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "i= [%d] intval= [%d]\n", i, intval);
-                    fprintf (fp_debug, "strval= [%s]\n", strval);
-                    fflush (fp_debug);
-                }
-                    
-                if (strcasecmp (outfmt, "ipac") == 0) {
-                    
-                    fprintf (fp, "%s ", strval);
-                    
-                    if (i == ncols-1) {
-                        fprintf (fp, "\n");
-                        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                            fprintf (fp_debug, 
-                                "new line written: i= [%d] ncols= [%d]\n", 
-                                i, ncols);
-                            fflush (fp_debug);
-                        }
-                    }
-                }
-                else if (strcasecmp (outfmt, "votable") == 0) {
-                        
-                    sprintf (strval, "%d", intval);
-                
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "votable:\n");
-                        fprintf (fp_debug, "intval= [%d]\n", intval);
-                        fprintf (fp_debug, "strval= [%s]\n", strval);
-                        fflush (fp_debug);
-                    }
-                    
-                    fprintf (fp, "        <TD>%s</TD>\n", strval);
-                }
-                else if (strcasecmp (outfmt, "csv") == 0) {
+                if (cell->kind == CELL_DBL)
+                    snprintf (strval, sizeof(strval), dd->valfmtarr[i],
+                        cell->dval);
 
-                    sprintf (strval, "%d", intval);
-                    
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "%s,", strval);
-                    }
-                }
-                else if (strcasecmp (outfmt, "tsv") == 0) {
-            
-                    sprintf (strval, "%d", intval);
-                    
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "%s\t", strval);
-                    }
-                }
+                if (outfmt == OUT_IPAC)
+                    buf_printf (buf, "%s ", strval);
+                else if (outfmt == OUT_VOTABLE)
+                    buf_printf (buf, "        <TD>%s</TD>\n", strval);
+                else
+                    buf_printf (buf, "%s", strval);
+
+                write_sep (buf, outfmt, i, ncols);
             }
-            else if ((strcasecmp (typearr[i], "float" ) == 0) || 
-                     (strcasecmp (typearr[i], "double") == 0)) {
+        }
 
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "typearr= [%s]\n", typearr[i]);
-                    fprintf (fp_debug, "fmtarr= [%s]\n", fmtarr[i]);
-                    fflush (fp_debug);
-                }
+        if (outfmt == OUT_VOTABLE)
+            buf_printf (buf, "        </TR>\n");
+    }
+
+    if ((outfmt == OUT_VOTABLE) && (istail == 1)) {
+
+        buf_printf (buf, "      </TABLEDATA>\n");
+        buf_printf (buf, "    </DATA>\n");
+        buf_printf (buf, "  </TABLE>\n");
+        buf_printf (buf, "  </RESOURCE>\n");
+        buf_printf (buf, "</VOTABLE>\n");
+    }
+}
 
-                sprintf (fmt, "%%-%s", fmtarr[i]);
-                
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "fmt= [%s]\n", fmt);
-                    fflush (fp_debug);
-                }
 
-                if (strcasecmp (outfmt, "ipac") != 0) {
-                    
 /*
-    Non-ipac tables: strip width element from double format
+    Common driver for writerecs and formatrecs: returns the formatted
+    buffer (caller frees buf->data) or -1 with a Python exception set.
 */
-                    cptr1 = strchr (fmt, '.');
-                    if (cptr1 != (char *)NULL) {
-                        strcpy (substr, cptr1);
-                        sprintf (fmt, "%%%s", substr);
-                    }
-                }
-                
-                if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                    fprintf (fp_debug, "finale: fmt= [%s]\n", fmt);
-                    fflush (fp_debug);
-                }
+static int format_batch (const char *format, PyObject *ddlist,
+    PyObject *datalist, int ishdr, int coldesc, int overflow, int istail,
+    PyObject *exclcols, outbuf *buf) {
 
-                strcpy (strval, "");
-                if (PyFloat_Check (item)) {
-                    
-                    dblval = PyFloat_AsDouble (item);
-                    sprintf (strval, fmt, dblval);
-                    
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, 
-                            "i= [%d] dblval= [%lf] strval= [%s]\n", 
-                            i, dblval, strval);
-                        fflush (fp_debug);
-                    }
-                }
-                else if (PyLong_Check (item)) {
-               
-                    intval = PyLong_AsLong (item);
-                    dblval = (float)intval;
-                    sprintf (strval, fmt, dblval);
-                
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "i= [%d] intval= [%d]\n", i, intval);
-                        fprintf (fp_debug, "dblval= [%lf] strval= [%s]\n", 
-                            dblval, strval);
-                        fflush (fp_debug);
-                    }
-                }
+    ddinfo    dd;
+    cellval  *cells;
+    PyObject *keep;
 
-                if (strcasecmp (outfmt, "ipac") == 0) {
-        
-                    if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                        fprintf (fp_debug, "ipac outfmt\n");
-                        fflush (fp_debug);
-                    }
+    int      *colmap;
+    int       outfmt;
+    int       nrows_data;
 
-                    fprintf (fp, "%s ", strval);
-                        
-                    if (i == ncols-1) {
-                        fprintf (fp, "\n");
-                        if ((debug1) && (fp_debug != (FILE *)NULL)) {
-                            fprintf (fp_debug, 
-                                "new line written: i= [%d] ncols= [%d]\n", 
-                                i, ncols);
-                            fflush (fp_debug);
-                        }
-                    }
-                }
-                else if (strcasecmp (outfmt, "votable") == 0) {
-                        
-                    fprintf (fp, "        <TD>%s</TD>\n", strval);
-                }
-                else if (strcasecmp (outfmt, "csv") == 0) {
+    outfmt = get_outfmt (format);
 
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "%s,", strval);
-                    }
-                }
-                else if (strcasecmp (outfmt, "tsv") == 0) {
-            
-                    if (i == ncols-1) {
-                        fprintf (fp, "%s\n", strval);
-                    }
-                    else {
-                        fprintf (fp, "%s\t", strval);
-                    }
-                }
-            }
-        }
+    if (outfmt < 0) {
+        PyErr_SetString (PyExc_Exception, "Invalid output format");
+        return -1;
+    }
 
-        if (strcasecmp (outfmt, "votable") == 0) {
-            fprintf (fp, "        </TR>\n");
-            fflush (fp);
-        }
+    if (parse_ddlist (ddlist, outfmt, &dd) < 0)
+        return -1;
+
+    colmap = make_colmap (exclcols, dd.ncols);
+
+    if (colmap == (int *)NULL) {
+        free_ddinfo (&dd);
+        return -1;
     }
 
-    
-    if ((debug) && (fp_debug != (FILE *)NULL)) {
-        fprintf (fp_debug, "outfmt= %s\n", outfmt);
-        fprintf (fp_debug, "istail= %d\n", istail);
-        fflush (fp_debug);
-    } 
-
-    if ((strcasecmp (outfmt, "votable") == 0) && (istail == 1)) {
-        fprintf (fp, "      </TABLEDATA>\n");
-        fprintf (fp, "    </DATA>\n");
-        fprintf (fp, "  </TABLE>\n");
-        fprintf (fp, "  </RESOURCE>\n");
-        fprintf (fp, "</VOTABLE>\n");
-    
-        if ((debug) && (fp_debug != (FILE *)NULL)) {
-            fprintf (fp_debug, "votable close brackets written\n");
-            fflush (fp_debug);
-        }     
+    keep = PyList_New (0);
+
+    if (keep == (PyObject *)NULL) {
+        free (colmap);
+        free_ddinfo (&dd);
+        return -1;
+    }
+
+    nrows_data = 0;
+    cells = extract_cells (datalist, &dd, colmap, keep, &nrows_data);
+
+    free (colmap);
+
+    if (cells == (cellval *)NULL) {
+        Py_DECREF (keep);
+        free_ddinfo (&dd);
+        return -1;
+    }
+
+    buf->len  = 0;
+    buf->err  = 0;
+    buf->size = 4096 + (size_t)nrows_data*(dd.ncols+1)*24;
+    buf->data = (char *)malloc (buf->size);
+
+    if (buf->data == (char *)NULL) {
+
+        Py_DECREF (keep);
+        free (cells);
+        free_ddinfo (&dd);
+        PyErr_SetString (PyExc_Exception, "Failed to malloc output buffer");
+        return -1;
+    }
+
+    buf->data[0] = '\0';
+
+    if (debug) {
+        printf ("format_batch: format= %s nrows= %d ncols= %d\n",
+            format, nrows_data, dd.ncols);
+        fflush (stdout);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+
+    format_rows (buf, &dd, cells, nrows_data, outfmt, ishdr, coldesc,
+        overflow, istail);
+
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF (keep);
+    free (cells);
+    free_ddinfo (&dd);
+
+    if (buf->err) {
+
+        free (buf->data);
+        buf->data = (char *)NULL;
+
+        PyErr_SetString (PyExc_Exception, "Failed to format output records");
+        return -1;
+    }
+
+    return 0;
+}
+
+
+static PyObject *method_writerecs(PyObject *self, PyObject *args) {
+
+    PyObject *ddlist = NULL;
+    PyObject *datalist = NULL;
+    PyObject *exclcols = NULL;
+
+    outbuf    buf;
+
+    char      msg[1024];
+
+    int  ishdr;
+    int  coldesc;
+    int  overflow;
+    int  istail;
+    int  istatus;
+
+    size_t nwrite;
+
+    const char *cptr_outpath = NULL;
+    const char *cptr_format = NULL;
+
+    FILE *fp;
+
+/* Parse arguments */
+
+    if(!PyArg_ParseTuple(args, "ssOOiiii|O", &cptr_outpath, &cptr_format,
+        &ddlist, &datalist, &ishdr, &coldesc, &overflow, &istail,
+        &exclcols)) {
+
+        PyErr_SetString (PyExc_Exception, "parseTuple error");
+        return NULL;
+    }
+
+    if (format_batch (cptr_format, ddlist, datalist, ishdr, coldesc,
+        overflow, istail, exclcols, &buf) < 0) {
+
+        return NULL;
     }
-    fflush (fp);
-    fclose (fp);
-    
 
 /*
-    free memory
+    open filepath: create it when writing the header, append otherwise
 */
-    for (i=0; i<ncols; i++) {
-        
-        free (namearr[i]);
-        free (typearr[i]);
-        free (dbtypearr[i]);
-        free (fmtarr[i]);
-        free (descarr[i]);
-        free (unitsarr[i]);
-    } 
-    free (namearr);
-    free (typearr);
-    free (dbtypearr);
-    free (fmtarr);
-    free (descarr);
-    free (unitsarr);
-    free (widtharr);
-
-    istatus = 0;    
+    fp = (FILE *)NULL;
+    if (ishdr) {
+        fp = fopen (cptr_outpath, "w+");
+        chmod(cptr_outpath, 0664);
+    }
+    else {
+        fp = fopen (cptr_outpath, "a");
+    }
+
+    if (fp == (FILE *)NULL) {
+
+        free (buf.data);
+
+        snprintf (msg, sizeof(msg), "Failed to open filepath: [%s]\n",
+            cptr_outpath);
+        PyErr_SetString (PyExc_Exception, msg);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+
+    nwrite = fwrite (buf.data, 1, buf.len, fp);
+    fflush (fp);
+    fclose (fp);
+
+    Py_END_ALLOW_THREADS
+
+    free (buf.data);
+
+    if (nwrite != buf.len) {
+
+        snprintf (msg, sizeof(msg), "Failed to write filepath: [%s]\n",
+            cptr_outpath);
+        PyErr_SetString (PyExc_Exception, msg);
+        return NULL;
+    }
+
+    istatus = 0;
     return PyLong_FromLong (istatus);
 }
 
+
+static PyObject *method_formatrecs(PyObject *self, PyObject *args) {
+
+    PyObject *ddlist = NULL;
+    PyObject *datalist = NULL;
+    PyObject *exclcols = NULL;
+    PyObject *retval = NULL;
+
+    outbuf    buf;
+
+    int  ishdr;
+    int  coldesc;
+    int  overflow;
+    int  istail;
+
+    const char *cptr_format = NULL;
+
+/* Parse arguments */
+
+    if(!PyArg_ParseTuple(args, "sOOiiii|O", &cptr_format, &ddlist,
+        &datalist, &ishdr, &coldesc, &overflow, &istail, &exclcols)) {
+
+        PyErr_SetString (PyExc_Exception, "parseTuple error");
+        return NULL;
+    }
+
+    if (format_batch (cptr_format, ddlist, datalist, ishdr, coldesc,
+        overflow, istail, exclcols, &buf) < 0) {
+
+        return NULL;
+    }
+
+    retval = PyBytes_FromStringAndSize (buf.data, (Py_ssize_t)buf.len);
+
+    free (buf.data);
+
+    return retval;
+}
+
+
 static PyMethodDef FputsMethods[] = {
-    
-    {"writerecs", method_writerecs, METH_VARARGS, 
+
+    {"writerecs", method_writerecs, METH_VARARGS,
     "Python interface for writerec C library function"},
-    
+
+    {"formatrecs", method_formatrecs, METH_VARARGS,
+    "Format a batch of records and return them as bytes (GIL released)"},
+
     {NULL, NULL, 0, NULL}
 };
 
 
 static struct PyModuleDef writerecsmodule = {
-    
+
     PyModuleDef_HEAD_INIT,
     "writerecs",
     "Python interface for the writerecs C library function",
@@ -1057,6 +1125,3 @@ static struct PyModuleDef writerecsmodule = {
 PyMODINIT_FUNC PyInit_writerecs(void) {
     return PyModule_Create(&writerecsmodule);
 }
-
-
-
@@ -5,10 +5,17 @@
 
 #    writeResult class
 #
+import os
+import sys
+import sqlite3
 import logging
 
+import time
 import datetime
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from TAP import writerecs
 
 
@@ -32,7 +39,13 @@ class writeResult:
     ncols_dd = 0
     ind_racol = -1
     ind_deccol = -1
-    ind_exclcol = -1
+    exclcols = []
+    rowfilter = None
+
+    resulttbls = {'votable': 'result.xml',
+                  'ipac': 'result.tbl',
+                  'csv': 'result.csv',
+                  'tsv': 'result.tsv'}
 
     racol = ''
     deccol = ''
@@ -40,6 +53,14 @@ class writeResult:
 
     format = 'votable'
     maxrec = -1
+    nworker = 1
+    prefetch = 0
+    arraysize_max = 0
+    numwidth = 22
+    nsample = 100
+    memory_budget = 0
+    nbudget = 0
+    rowbytes = 0
 
     outpath = ''
     ntot = 0
@@ -74,7 +95,24 @@ class writeResult:
             maxrec(int),
             racol,
             deccol,
-            exclcol(int): exclude column index
+            exclcol(int or list): excluded column index (or indices),
+            arraysize(int): number of rows per fetch,
+            nworker(int): number of threads formatting fetched batches
+                          in parallel (default 1: no encoder threads),
+            prefetch(0/1): fetch the next batch in a background thread
+                           while the current one is written,
+            arraysize_max(int): upper limit for the prefetch arraysize
+                           tuning (default 4*arraysize),
+            numwidth(int): width of the numeric columns not in dd
+                           (default 22),
+            nsample(int): number of rows sampled to tell int from float
+                          for the numeric columns without precision/scale
+                          (default 100),
+            memory_budget(int): bytes the batches in flight may take; the
+                          arraysize is then sized from the measured bytes
+                          per row (default 0: fixed arraysize),
+            rowfilter: object whose filter(rows) method returns the
+                          fetched rows to write (default: all rows)
 
         Usage:
 
@@ -105,8 +143,13 @@ class writeResult:
             self.deccol = kwargs['deccol']
             self.ind_deccol = self.__getDDIndex__(self.dd, self.deccol)
 
+        self.exclcols = []
         if('exclcol' in kwargs):
-            self.ind_exclcol = kwargs['exclcol']
+            if isinstance(kwargs['exclcol'], int):
+                if(kwargs['exclcol'] >= 0):
+                    self.exclcols = [kwargs['exclcol']]
+            else:
+                self.exclcols = list(kwargs['exclcol'])
 
         if('format' in kwargs):
             self.format = kwargs['format']
@@ -122,6 +165,31 @@ class writeResult:
         if('arraysize' in kwargs):
             self.arraysize = kwargs['arraysize']
 
+        if('nworker' in kwargs):
+            self.nworker = kwargs['nworker']
+
+        if('prefetch' in kwargs):
+            self.prefetch = kwargs['prefetch']
+
+        self.arraysize_max = 4*self.arraysize
+        if('arraysize_max' in kwargs):
+            self.arraysize_max = kwargs['arraysize_max']
+
+        if(self.arraysize_max < self.arraysize):
+            self.arraysize_max = self.arraysize
+
+        if('numwidth' in kwargs):
+            self.numwidth = kwargs['numwidth']
+
+        if('nsample' in kwargs):
+            self.nsample = kwargs['nsample']
+
+        if('memory_budget' in kwargs):
+            self.memory_budget = kwargs['memory_budget']
+
+        if('rowfilter' in kwargs):
+            self.rowfilter = kwargs['rowfilter']
+
         if self.debug:
             logging.debug('')
             logging.debug('from kwargs:')
@@ -130,9 +198,14 @@ class writeResult:
             logging.debug(f'      ind_racol   = {self.ind_racol:d}')
             logging.debug(f'      ind_deccol  = {self.ind_deccol:d}')
             logging.debug(f'      coldesc     = {self.coldesc:d}')
-            logging.debug(f'      ind_exclcol = {self.ind_exclcol:d}')
+            logging.debug(f'      exclcols    = {str(self.exclcols):s}')
             logging.debug(f'      maxrec      = {self.maxrec:d}')
             logging.debug(f'      arraysize   = {self.arraysize:d}')
+            logging.debug(f'      nworker     = {self.nworker:d}')
+            logging.debug(f'      prefetch    = {self.prefetch:d}')
+            logging.debug(f'      numwidth    = {self.numwidth:d}')
+            logging.debug(f'      nsample     = {self.nsample:d}')
+            logging.debug(f'      memory_budget = {self.memory_budget:d}')
 
         self.status = ''
 
@@ -141,17 +214,23 @@ class writeResult:
         #
 
         resulttbl = ''
-        if(self.format == 'votable'):
-            resulttbl = 'result.xml'
-        elif(self.format == 'ipac'):
-            resulttbl = 'result.tbl'
-        elif(self.format == 'csv'):
-            resulttbl = 'result.csv'
-        elif(self.format == 'tsv'):
-            resulttbl = 'result.tsv'
+        if(self.format in self.resulttbls):
+            resulttbl = self.resulttbls[self.format]
 
         self.outpath = self.workdir + '/' + resulttbl
 
+        #
+        # An existing result file may be a hard link into the result cache:
+        # it is replaced, never written through
+        #
+
+        try:
+            if os.path.lexists(self.outpath):
+                os.remove(self.outpath)
+
+        except Exception as e:
+            pass
+
         if self.debug:
             logging.debug('')
             logging.debug(f'outpath= {self.outpath:s}')
@@ -193,13 +272,26 @@ class writeResult:
         descarr = []
 
         #
-        # For non-dd column and dbtype == NUMBER, check data to see if
-        # it is int or float: if any number in the fltcntarr, consider it float
+        # isddcolarr: whether the output column is in the dd;
+        # colindarr:  index of the output column in the fetched rows;
+        # samplearr:  output columns whose int/float type is not known
+        #             from the DB metadata and is decided from a sample
+        #             of the first batch (charok: may turn out to be char)
         #
 
         isddcolarr = []
-        intcntarr = []
-        fltcntarr = []
+        colindarr = []
+        samplearr = []
+        charok = []
+
+        #
+        # SQLite cursors (and partitionCursor) carry no type information:
+        # use the declared column types of the table instead
+        #
+
+        decltypes = None
+        if isinstance(self.cursor.connection, sqlite3.Connection):
+            decltypes = self.__getDeclTypes__()
 
 
         dbdatatype = None
@@ -225,7 +317,7 @@ class writeResult:
             if self.debug:
                 logging.debug('')
                 logging.debug('----------------------------------------------')
-                logging.debug(f'ind_exclcol= {self.ind_exclcol:d}\n')
+                logging.debug(f'exclcols= {str(self.exclcols):s}\n')
                 logging.debug(f'i = {i:d} col = ' + str(col))
 
             #
@@ -239,12 +331,13 @@ class writeResult:
                 logging.debug('')
                 logging.debug(f'colname(lower) = {colname:s}')
 
-            if(i == self.ind_exclcol):
+            if(i in self.exclcols):
 
                 if self.debug:
                     logging.debug('')
-                    logging.debug('i=ind_exclcol: skipped')
+                    logging.debug('i in exclcols: skipped')
 
+                i = i + 1
                 continue
 
             #
@@ -296,6 +389,33 @@ class writeResult:
             if(ind != -1):
                 dbdatatype = 'FLOAT'
 
+            if((col[1] is None) and (decltypes is not None)):
+
+                #
+                # SQLite type affinity of the declared type: columns
+                # without one (expressions, NUMERIC, ...) are sampled
+                #
+
+                decltype = ''
+                if(colname in decltypes):
+                    decltype = decltypes[colname]
+
+                if(decltype.find('INT') != -1):
+                    dbdatatype = 'LONG'
+
+                elif((decltype.find('CHAR') != -1)
+                        or (decltype.find('CLOB') != -1)
+                        or (decltype.find('TEXT') != -1)):
+                    dbdatatype = ''
+
+                elif((decltype.find('REAL') != -1)
+                        or (decltype.find('FLOA') != -1)
+                        or (decltype.find('DOUB') != -1)):
+                    dbdatatype = 'FLOAT'
+
+                else:
+                    dbdatatype = 'NUMBER'
+
             if self.debug:
                 logging.debug(f'dbdatatype    = {dbdatatype:s}')
 
@@ -367,8 +487,6 @@ class writeResult:
                 desc = self.dd.coldesc[colname]
 
                 isddcolarr.append(1)
-                intcntarr.append(0)
-                fltcntarr.append(0)
 
                 #
                 # {  char/date/datetime/timestamp: verify format with
@@ -434,6 +552,8 @@ class writeResult:
                 # { col Not in dd
                 #
 
+                issample = False
+
                 if(dbdatatype == 'STRING') or (dbdatatype == 'VARCHAR'):
 
                     #
@@ -488,7 +608,7 @@ class writeResult:
                     coltype = 'int'
                     dbtype = 'long'
 
-                    width = 22
+                    width = self.numwidth
                     if(len(colname) > width):
                         width = len(colname)
                     fmt = str(width) + 'd'
@@ -505,9 +625,8 @@ class writeResult:
 
                     coltype = 'double'
                     dbtype = 'float'
-                    fmt = '22.14e'
 
-                    width = 22
+                    width = self.numwidth
                     if(len(colname) > width):
                         width = len(colname)
                     fmt = str(width) + '.14e'
@@ -519,29 +638,33 @@ class writeResult:
                 elif(dbdatatype == 'NUMBER'):
 
                     #
-                    # { dbdatatype == NUMBER
+                    # { dbdatatype == NUMBER:
+                    #   NUMBER(p) is an int, NUMBER(p,s) a double;
+                    #   unconstrained NUMBER (precision 0, scale -127)
+                    #   and untyped SQLite columns are decided from a
+                    #   sample of the first batch
                     #
 
-                    if(scale == 0):
+                    width = self.numwidth
+                    if(len(colname) > width):
+                        width = len(colname)
 
-                        coltype = 'int'
-                        dbtype = dbdatatype
+                    if((scale == 0)
+                            and (precision is not None) and (precision > 0)):
 
-                        width = 22
-                        if(len(colname) > width):
-                            width = len(colname)
+                        coltype = 'int'
+                        dbtype = 'integer'
                         fmt = str(width) + 'd'
 
                     else:
 
                         coltype = 'double'
-                        dbtype = dbdatatype
-
-                        width = 22
-                        if(len(colname) > width):
-                            width = len(colname)
+                        dbtype = 'float'
                         fmt = str(width) + '.14e'
 
+                        if((scale is None) or (scale <= 0)):
+                            issample = True
+
                     #
                     # } end dbdatatype == NUMBER
                     #
@@ -581,6 +704,8 @@ class writeResult:
 
                         fmt = dd.colfmt[self.racol.lower()]
 
+                        issample = False
+
 
                 elif(colname.lower() == 'dec'):
 
@@ -591,6 +716,8 @@ class writeResult:
                         units = dd.colunits[self.deccol.lower()]
                         fmt = dd.colfmt[self.deccol.lower()]
 
+                        issample = False
+
                 if self.debug:
                     logging.debug('')
                     logging.debug('column not in dd')
@@ -601,8 +728,10 @@ class writeResult:
 
 
                 isddcolarr.append(0)
-                intcntarr.append(0)
-                fltcntarr.append(0)
+
+                if issample:
+                    samplearr.append(len(namearr))
+                    charok.append(decltypes is not None)
 
                 #
                 # } end col Not in dd
@@ -615,6 +744,7 @@ class writeResult:
             widtharr.append(width)
             unitsarr.append(units)
             descarr.append(desc)
+            colindarr.append(i)
 
             i = i + 1
 
@@ -706,7 +836,7 @@ class writeResult:
 
         if self.debug:
             logging.debug('')
-            logging.debug('Start constructing rowslist')
+            logging.debug('Start fetching rows')
             logging.debug('----------------------------------------')
 
         #
@@ -715,6 +845,18 @@ class writeResult:
 
         nfetch = self.arraysize
 
+        #
+        # With a memory budget the first fetch is a small probe: the
+        # arraysize is set from its bytes per row.  The header (with the
+        # QUERY_STATUS) is written with the first batch, so there is no
+        # probe when it would stop short of maxrec: the overflow would
+        # not be known yet.
+        #
+
+        if((self.memory_budget > 0) and (self.nsample < nfetch)
+                and ((self.maxrec <= 0) or (self.maxrec <= self.nsample))):
+            nfetch = self.nsample
+
         self.cursor.arraysize = nfetch
 
         ibatch = 0
@@ -723,174 +865,222 @@ class writeResult:
         irow = 0
         self.ntot = 0
 
-        while True:
-
-            #
-            # { start of while loop for fetching data lines;
-            #   max 10000 lines at a time
-            #
+        #
+        # Formatted batches are written to outpath in fetch order; with
+        # nworker > 1 the formatting (done in C with the GIL released)
+        # runs in a thread pool while the next batch is fetched, with at
+        # most nworker batches in flight.
+        #
 
-            rows = cursor.fetchmany()
+        try:
+            fp = open(self.outpath, 'wb')
+            os.chmod(self.outpath, 0o664)
 
-            nrec = len(rows)
+        except Exception as e:
 
-            if self.debug:
-                logging.debug(f'nrec = {nrec:d}')
-                logging.debug('')
+            self.status = 'error'
+            self.msg = f'Failed to open output file [{self.outpath:s}]'
+            raise Exception(self.msg)
 
-            rowslist = []
+        pool = None
+        pending = deque()
 
-            for ll in range(0, nrec):
+        if(self.nworker > 1):
+            pool = ThreadPoolExecutor(max_workers=self.nworker)
 
-                #
-                # { Beginning ll loop: one row
-                #
+        #
+        # Prefetch mode: the next fetchmany runs in a background thread
+        # while the current batch is written (double buffering)
+        #
 
-                row = rows[ll]
+        fetcher = None
+        nextbatch = None
 
-                rowlist = []
+        if self.prefetch:
+            fetcher = ThreadPoolExecutor(max_workers=1)
+            nextbatch = fetcher.submit(self.__fetchRows__, nfetch)
 
-                for i in range(0, len(row)):
+        time_cycle = time.time()
 
-                    #
-                    # { Beginning i loop: one col
-                    #
+        try:
+            while True:
 
-                    if(i == self.ind_exclcol):
-                        continue
+                #
+                # { start of while loop for fetching data lines;
+                #   max 10000 lines at a time
+                #
 
-                    if((isddcolarr[i] == 0)
-                            and (dbtypearr[i] == 'NUMBER')
-                            and (ibatch == 0)):
+                time_wait = time.time()
 
-                        dtype = type(row[i]).__name__
+                try:
+                    if(fetcher is None):
+                        rows, nreq, nrec = self.__fetchRows__(nfetch)
+                    else:
+                        rows, nreq, nrec = nextbatch.result()
 
-                        if(dtype == 'int'):
-                            intcntarr[i] = intcntarr[i] + 1
-                        else:
-                            fltcntarr[i] = fltcntarr[i] + 1
+                except Exception as e:
 
-                        rowlist.append(row[i])
+                    self.__closeOutput__(fp, pool, pending, drain=False)
 
-                    elif((dbtypearr[i].lower() == 'date')
-                            or (dbtypearr[i].lower() == 'datetime')
-                            or (dbtypearr[i].lower() == 'timestamp')):
+                    self.status = 'error'
+                    self.msg = str(e)
+                    raise Exception(str(e))
 
-                        rowlist.append(str(row[i]))
+                if(self.memory_budget > 0):
+                    nfetch = self.__budgetArraysize__(rows, nfetch, ibatch)
 
-                    else:
-                        rowlist.append(row[i])
+                if(fetcher is not None):
 
                     #
-                    # } end of i loop
+                    # Start fetching the next batch unless this one is the last
                     #
 
-                if self.debug:
-                    logging.debug(rowlist)
+                    time1 = time.time()
 
-                rowslist.append(rowlist)
+                    nfetch = self.__tuneArraysize__(nfetch, nrec, nreq,
+                                                    time1 - time_wait,
+                                                    time1 - time_cycle)
+                    time_cycle = time1
 
-                irow = irow + 1
+                    islast = (nrec < nreq)
+                    if((self.maxrec > 0)
+                            and (irow + len(rows) >= self.maxrec)):
+                        islast = True
 
-                if((self.maxrec > 0) and (irow >= self.maxrec)):
-                    self.overflow = 1
-                    break
+                    if not islast:
+                        nextbatch = fetcher.submit(self.__fetchRows__, nfetch)
+
+                if self.debug:
+                    logging.debug(f'nrec = {nrec:d}')
+                    logging.debug('')
 
                 #
-                # } end of l loop
+                # The fetched row tuples go to the C routine as they are (it
+                # skips the exclcols and converts dates etc. with str());
+                # only the maxrec cut-off is applied here (after the
+                # rowfilter, if any)
                 #
 
-            if self.debug:
-                logging.debug('----------------------------------------')
-
-            if(ibatch == 0):
+                if((self.maxrec > 0) and (irow + len(rows) >= self.maxrec)):
+                    rows = rows[0:self.maxrec - irow]
+                    self.overflow = 1
 
-                #
-                # {
-                #
+                irow = irow + len(rows)
 
-                for i in range(0, len(isddcolarr)):
+                if(ibatch == 0):
 
                     #
-                    # { check intcntarr and fltcntarr
+                    # { Decide the type of the samplearr columns from the
+                    #   first nsample non-null values of the first batch (the
+                    #   C routine still prints a stray float in an int column)
                     #
 
-                    if((isddcolarr[i] == 0) and (dbtypearr[i] == 'NUMBER')):
+                    for k in range(0, len(samplearr)):
 
-                        if((intcntarr[i] > 0) and (fltcntarr[i] == 0)):
+                        i = samplearr[k]
 
-                            typearr[i] = 'int'
-                            dbtypearr[i] = 'integer'
+                        coltype = self.__sampleType__(rows, colindarr[i],
+                                                      charok[k])
 
-                            widtharr[i] = 22
-                            if(len(namearr[i]) > widtharr[i]):
-                                widtharr[i] = len(namearr[i])
+                        if self.debug:
+                            logging.debug('')
+                            logging.debug(f'sampled type of {namearr[i]:s}: '
+                                          f'{coltype:s}')
+
+                        if(coltype == 'int'):
 
+                            typearr[i] = 'int'
+                            dbtypearr[i] = 'integer'
                             fmtarr[i] = str(widtharr[i]) + 'd'
 
-                        else:
-                            typearr[i] = 'double'
-                            dbtypearr[i] = 'float'
+                        elif(coltype == 'char'):
 
-                            widtharr[i] = 22
+                            widtharr[i] = 80
                             if(len(namearr[i]) > widtharr[i]):
                                 widtharr[i] = len(namearr[i])
-                            fmtarr[i] = str(widtharr[i]) + '.14e'
+
+                            typearr[i] = 'char'
+                            dbtypearr[i] = 'varchar'
+                            fmtarr[i] = str(widtharr[i]) + 's'
 
                     #
-                    # } end checking intcntarr and fltcntarr
+                    # } end if ibatch == 0
                     #
-                #
-                # } end if ibatch == 0
-                #
 
-            if(self.ntot == 0):
-                self.ishdr = 1
-            else:
-                self.ishdr = 0
+                if(ibatch == 0):
+                    self.ishdr = 1
+                else:
+                    self.ishdr = 0
 
-            self.ntot = self.ntot + nrec
+                self.ntot = self.ntot + len(rows)
 
-            if((self.overflow == 1) and (irow >= self.maxrec)):
-                self.istail = 1
+                if((self.overflow == 1) and (irow >= self.maxrec)):
+                    self.istail = 1
 
-            if(len(rows) < self.cursor.arraysize):
-                self.istail = 1
+                if(nrec < nreq):
+                    self.istail = 1
 
-            self.status = None
+                self.status = None
 
-            try:
+                try:
+                    self.__writeBatch__(fp, pool, pending, ddlist, rows)
 
-                istatus = writerecs.writerecs(self.outpath, self.format,
-                                              ddlist, rowslist, self.ishdr,
-                                              self.coldesc, self.overflow,
-                                              self.istail)
-                if(istatus == 0):
-                    self.status = 'ok'
+                except Exception as e:
 
-            except Exception as e:
+                    self.__closeOutput__(fp, pool, pending, drain=False)
 
-                self.status = 'error'
-                self.msg = str(e)
+                    self.status = 'error'
+                    self.msg = str(e)
 
-                if self.debug:
-                    logging.debug('')
-                    logging.debug(f'writerecs exception: {str(e):s}')
+                    if self.debug:
+                        logging.debug('')
+                        logging.debug(f'writerecs exception: {str(e):s}')
 
-                raise Exception(str(e))
+                    raise Exception(str(e))
 
-            if((self.overflow == 1) and (irow >= self.maxrec)):
-                break
+                if((self.overflow == 1) and (irow >= self.maxrec)):
+                    break
 
-            if(len(rows) < self.cursor.arraysize):
-                break
+                if(nrec < nreq):
+                    break
 
-            ibatch = ibatch + 1
+                ibatch = ibatch + 1
+
+                #
+                # } end while loop for fetching data lines
+                #
+
+        finally:
 
             #
-            # } end while loop for fetching data lines
+            # The fetch thread is stopped on every way out of the loop, so
+            # nothing reads the cursor after writeResult returns: a batch
+            # not yet started is cancelled, one being fetched waited for
             #
 
+            if(fetcher is not None):
+
+                if(nextbatch is not None):
+                    nextbatch.cancel()
+
+                fetcher.shutdown(wait=True)
+
+        try:
+            self.__closeOutput__(fp, pool, pending)
+
+        except Exception as e:
+
+            self.status = 'error'
+            self.msg = str(e)
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'writerecs exception: {str(e):s}')
+
+            raise Exception(str(e))
+
+        self.status = 'ok'
+
         return
 
         #
@@ -898,6 +1088,316 @@ class writeResult:
         #
 
 
+    def __fetchRows__(self, nfetch, **kwargs):
+
+        #
+        # {
+        #
+
+        # Fetch up to nfetch rows; returns the rows (passed through the
+        # rowfilter, if any), the requested count and the fetched count
+        # (a short batch marks the end of the cursor).  In prefetch mode
+        # this runs in the fetch thread, so the filtering overlaps the
+        # formatting of the previous batch.
+        #
+
+        self.cursor.arraysize = nfetch
+
+        rows = self.cursor.fetchmany(nfetch)
+
+        nrec = len(rows)
+
+        if self.rowfilter is not None:
+            rows = self.rowfilter.filter(rows)
+
+        return(rows, nfetch, nrec)
+
+        #
+        # } end of fetchRows def
+        #
+
+
+    def __getDeclTypes__(self, **kwargs):
+
+        #
+        # {
+        #
+
+        # Declared column types (upper case) of the dd table in a SQLite
+        # DB, keyed by the lower case column name; empty if not available
+        #
+
+        decltypes = {}
+
+        dbtable = self.dd.dbtable
+
+        sql = 'PRAGMA table_info(' + dbtable + ')'
+
+        ind = dbtable.find('.')
+        if(ind != -1):
+            sql = 'PRAGMA ' + dbtable[0:ind] + '.table_info(' \
+                + dbtable[ind+1:] + ')'
+
+        try:
+            cursor = self.cursor.connection.cursor()
+            cursor.execute(sql)
+
+            for row in cursor.fetchall():
+                decltypes[str(row[1]).lower()] = str(row[2]).upper()
+
+            cursor.close()
+
+        except Exception as e:
+
+            if self.debug:
+                logging.debug('')
+                logging.debug(f'table_info exception: {str(e):s}')
+
+        return(decltypes)
+
+        #
+        # } end of getDeclTypes def
+        #
+
+
+    def __sampleType__(self, rows, j, charok, **kwargs):
+
+        #
+        # {
+        #
+
+        # Type of row column j from the first nsample non-null values:
+        # 'int' if they are all ints, 'char' if charok and any of them is
+        # not a number, 'double' otherwise (including no values at all)
+        #
+
+        nval = 0
+        isint = True
+
+        for row in rows:
+
+            val = row[j]
+
+            if val is None:
+                continue
+
+            if(type(val) is not int):
+
+                isint = False
+
+                if(charok and (type(val) is not float)):
+                    return('char')
+
+            nval = nval + 1
+            if(nval >= self.nsample):
+                break
+
+        if((nval > 0) and isint):
+            return('int')
+
+        return('double')
+
+        #
+        # } end of sampleType def
+        #
+
+
+    def __budgetArraysize__(self, rows, nfetch, ibatch, **kwargs):
+
+        #
+        # {
+        #
+
+        # Size the next fetch so that the batches in flight fit in
+        # memory_budget: the current one, the prefetched one and up to
+        # nworker queued for formatting, each counted twice (the row
+        # objects and the formatted text).  The bytes per row are taken
+        # from up to nsample rows spread over the batch.
+        #
+
+        nrow = len(rows)
+        if(nrow == 0):
+            return(nfetch)
+
+        step = nrow // self.nsample
+        if(step < 1):
+            step = 1
+
+        nbytes = 0
+        nsampled = 0
+
+        for ll in range(0, nrow, step):
+
+            row = rows[ll]
+
+            nbytes = nbytes + sys.getsizeof(row)
+            for val in row:
+                nbytes = nbytes + sys.getsizeof(val)
+
+            nsampled = nsampled + 1
+
+        self.rowbytes = nbytes // nsampled
+        if(self.rowbytes < 1):
+            self.rowbytes = 1
+
+        ninflight = 1
+        if self.prefetch:
+            ninflight = ninflight + 1
+        if(self.nworker > 1):
+            ninflight = ninflight + self.nworker
+
+        self.nbudget = self.memory_budget // (2*ninflight*self.rowbytes)
+
+        if(self.nbudget > self.arraysize_max):
+            self.nbudget = self.arraysize_max
+
+        if(self.nbudget < 1):
+            self.nbudget = 1
+
+        #
+        # Without prefetch the budget sets the arraysize; with prefetch
+        # the arraysize starts at (at most) arraysize after the probe and
+        # is tuned from there, up to the budget
+        #
+
+        if not self.prefetch:
+            nfetch = self.nbudget
+
+        elif(ibatch == 0):
+            nfetch = min(self.arraysize, self.nbudget)
+
+        elif(nfetch > self.nbudget):
+            nfetch = self.nbudget
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'memory budget: rowbytes= {self.rowbytes:d}'
+                          f' nbudget= {self.nbudget:d} nfetch= {nfetch:d}')
+
+        return(nfetch)
+
+        #
+        # } end of budgetArraysize def
+        #
+
+
+    def __tuneArraysize__(self, nfetch, nrec, nreq, waittime, cycletime,
+                          **kwargs):
+
+        #
+        # {
+        #
+
+        # If the writer spent a noticeable part of the last cycle waiting
+        # for the prefetched batch, the fetch (i.e. the DB round trip) is
+        # the bottleneck: double the batch size, up to arraysize_max, so
+        # fewer round trips are needed.  If the writer hardly waited at
+        # all, the fetch finishes well before the writer needs it (the
+        # writer is the bottleneck) and the batch only holds memory:
+        # halve it, down to the initial arraysize.  In between the size
+        # is kept, so that it does not flip back and forth.
+        #
+
+        if(nrec < nreq):
+            return(nfetch)
+
+        if((cycletime > 0.) and (waittime > 0.1*cycletime)):
+
+            nfetch = 2*nfetch
+
+            if(nfetch > self.arraysize_max):
+                nfetch = self.arraysize_max
+
+            if((self.nbudget > 0) and (nfetch > self.nbudget)):
+                nfetch = self.nbudget
+
+        elif((cycletime > 0.) and (waittime < 0.01*cycletime)
+                and (nfetch > self.arraysize)):
+
+            nfetch = nfetch // 2
+
+            if(nfetch < self.arraysize):
+                nfetch = self.arraysize
+
+        if self.debug:
+            logging.debug('')
+            logging.debug(f'prefetch: wait= {waittime:f} cycle= {cycletime:f}'
+                          f' nfetch= {nfetch:d}')
+
+        return(nfetch)
+
+        #
+        # } end of tuneArraysize def
+        #
+
+
+    def __writeBatch__(self, fp, pool, pending, ddlist, rows, **kwargs):
+
+        #
+        # {
+        #
+
+        # Format one batch of rows: directly if there is no thread pool,
+        # otherwise queue it and write out the oldest batches once more
+        # than nworker are in flight
+        #
+
+        if(pool is None):
+
+            buf = writerecs.formatrecs(self.format, ddlist, rows,
+                                       self.ishdr, self.coldesc,
+                                       self.overflow, self.istail,
+                                       self.exclcols)
+            fp.write(buf)
+            return
+
+        future = pool.submit(writerecs.formatrecs, self.format, ddlist,
+                             rows, self.ishdr, self.coldesc,
+                             self.overflow, self.istail, self.exclcols)
+        pending.append(future)
+
+        while(len(pending) > self.nworker):
+            fp.write(pending.popleft().result())
+
+        return
+
+        #
+        # } end of writeBatch def
+        #
+
+
+    def __closeOutput__(self, fp, pool, pending, drain=True, **kwargs):
+
+        #
+        # {
+        #
+
+        # Write out the batches still in flight (in order) and close up
+        #
+
+        try:
+            while(len(pending) > 0):
+
+                future = pending.popleft()
+
+                if drain:
+                    fp.write(future.result())
+                else:
+                    future.cancel()
+        finally:
+
+            if(pool is not None):
+                pool.shutdown(wait=True)
+
+            fp.close()
+
+        return
+
+        #
+        # } end of closeOutput def
+        #
+
+
     def __getArrIndex__(self, arr, name):
 
         #
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2020, Caltech IPAC.
+# This code is released with a BSD 3-clause license. License information is at
+#   https://github.com/Caltech-IPAC/nexsciTAP/blob/master/LICENSE
+
+
+#
+# Benchmark of proprietary filtering on the SQLite backend.
+#
+# A synthetic KOA-like database (koa_hires with observing dates,
+# proprietary periods and semester IDs, koa_access grants and koa_users
+# logins) is built in a scratch directory.  The same query is run through
+# propFilter for an anonymous user, a user with a few grants and a user
+# with more grants than fit in bind values (TEMP table path), with and
+# without a precomputed release date column.  Each result is checked
+# against the rows the Oracle access constraint selects, evaluated in
+# Python:
+#
+#     current_date > add_months(date_obs, propmin)
+#     or lower(semid) in (<user's grants>)
+#
+# The semester IDs follow the observing dates and the users are granted
+# semesters that are still proprietary (the many-grant user has the
+# few-grant user's ones too), so the three users have to get different
+# row counts.
+#
+# Usage:
+#
+#     python bench/propfilter_sqlite.py [--nrows 200000] [--ngrants 2000]
+#
+
+import os
+import sys
+import csv
+import time
+import random
+import sqlite3
+import datetime
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from TAP.propfilter import propFilter
+from TAP.releasedate import add_months, releaseDate
+
+
+def makeDb(dbdir, nrows, ngrants):
+
+    #
+    # {
+    #
+
+    dbpath = dbdir + '/koa.db'
+    schemapath = dbdir + '/tap_schema.db'
+
+    random.seed(1)
+
+    conn = sqlite3.connect(dbpath)
+
+    conn.execute('create table koa_hires (koaid text, date_obs text, ' +
+                 'propmin integer, semid text, ra real, dec real)')
+
+    #
+    # Observing dates up to today, the semester ID (A: February to July)
+    # from the date
+    #
+
+    date0 = datetime.date(2015, 1, 1)
+    ndays = (datetime.date.today() - date0).days
+
+    semids = set()
+    proprietary = set()
+
+    now = datetime.datetime.now()
+
+    rows = []
+    for i in range(nrows):
+
+        date = date0 + datetime.timedelta(days=random.randint(0, ndays))
+
+        if(date.month == 1):
+            semester = f'{date.year-1:d}B'
+        elif(date.month < 8):
+            semester = f'{date.year:d}A'
+        else:
+            semester = f'{date.year:d}B'
+
+        semid = f'{semester:s}_P{random.randint(0, 99):03d}'
+        propmin = random.choice([12, 18, 24, 36])
+
+        semids.add(semid)
+
+        release = datetime.datetime.fromisoformat(
+            add_months(date.isoformat(), propmin))
+
+        if(now <= release):
+            proprietary.add(semid)
+
+        rows.append((f'HI.{i:08d}', date.isoformat(), propmin, semid,
+                     random.random()*360., random.random()*180.-90.))
+
+    semids = sorted(semids)
+    proprietary = sorted(proprietary)
+
+    conn.executemany('insert into koa_hires values (?, ?, ?, ?, ?, ?)',
+                     rows)
+
+    conn.execute('create table koa_access (userid text, semid text)')
+    conn.execute('create index koa_access_userid on koa_access(userid)')
+
+    few = random.sample(proprietary, min(5, len(proprietary)))
+
+    grants = [('few', semid) for semid in few]
+
+    for semid in few:
+        grants.append(('many', semid))
+
+    for i in range(ngrants):
+        grants.append(('many', random.choice(proprietary)))
+        grants.append(('many', f'X{i:06d}'))
+
+    conn.executemany('insert into koa_access values (?, ?)', grants)
+
+    conn.execute('create table koa_users (userid text, passwd text)')
+    conn.executemany('insert into koa_users values (?, ?)',
+                     [('few', 'pw'), ('many', 'pw')])
+
+    conn.commit()
+
+    releaseDate(conn, 'sqlite3', 'koa_hires', 'date_obs', 'propmin',
+                releasecol='release_date', create=1, index=1)
+
+    conn.close()
+
+    #
+    # TAP_SCHEMA columns for the data dictionary
+    #
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table columns (table_name text, column_name text, ' +
+                 'datatype text, description text, unit text, format text)')
+
+    for (name, datatype, fmt) in [('koaid', 'char', '12s'),
+                                  ('date_obs', 'char', '10s'),
+                                  ('propmin', 'int', '4d'),
+                                  ('semid', 'char', '10s'),
+                                  ('ra', 'double', '12.6f'),
+                                  ('dec', 'double', '12.6f')]:
+
+        conn.execute('insert into columns values (?, ?, ?, ?, ?, ?)',
+                     ('koa_hires', name, datatype, '', '', fmt))
+
+    conn.commit()
+    conn.close()
+
+    return(dbpath, schemapath, rows, grants)
+
+    #
+    # } end of makeDb def
+    #
+
+
+def reference(rows, grants, userid, query_ra):
+
+    #
+    # {
+    #
+
+    # Rows (koaid) the Oracle access constraint selects: current_date is
+    # the local date and time, add_months() the date of the release day
+    #
+
+    now = datetime.datetime.now()
+
+    allowed = set()
+    for (user, semid) in grants:
+        if(user == userid):
+            allowed.add(semid.lower())
+
+    koaids = []
+    for (koaid, date_obs, propmin, semid, ra, dec) in rows:
+
+        if(ra <= query_ra):
+            continue
+
+        release = datetime.datetime.fromisoformat(add_months(date_obs,
+                                                             propmin))
+
+        if((now > release) or (semid.lower() in allowed)):
+            koaids.append(koaid)
+
+    return(sorted(koaids))
+
+    #
+    # } end of reference def
+    #
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark proprietary filtering on SQLite.')
+
+    parser.add_argument('--nrows', type=int, default=200000,
+                        help='rows in the synthetic koa_hires table')
+    parser.add_argument('--ngrants', type=int, default=2000,
+                        help='grants of the user with many grants')
+    parser.add_argument('--ra', type=float, default=180.,
+                        help='query constraint: ra > RA')
+
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='propbench')
+
+    time0 = time.time()
+
+    dbpath, schemapath, rows, grants = makeDb(workdir, args.nrows,
+                                              args.ngrants)
+
+    print(f'database: {args.nrows:d} rows, {len(grants):d} grants '
+          f'({time.time()-time0:.2f} sec)')
+
+    connectInfo = {'dbms': 'sqlite3',
+                   'db': dbpath,
+                   'tap_schema': schemapath}
+
+    query = f'select koaid, date_obs, semid, ra, dec from koa_hires ' + \
+        f'where ra > {args.ra:f} order by koaid'
+
+    print('')
+    print(f'{"user":10s} {"releasecol":14s} {"rows":>8s} {"sec":>8s}  '
+          'matches Oracle semantics')
+
+    nfail = 0
+
+    nrows = {}
+
+    for userid in ['', 'few', 'many']:
+
+        cookiestr = ''
+        if(len(userid) > 0):
+            cookiestr = 'KOA=' + userid + '|pw'
+
+        expected = reference(rows, grants, userid, args.ra)
+
+        for releasecol in ['', 'release_date']:
+
+            time0 = time.time()
+
+            pfilter = propFilter(connectInfo=connectInfo,
+                                 query=query,
+                                 workdir=workdir,
+                                 cookiename='KOA',
+                                 cookiestr=cookiestr,
+                                 usertbl='koa_users',
+                                 accesstbl='koa_access',
+                                 propfilter='koa',
+                                 fileid='koaid',
+                                 accessid='semid',
+                                 releasecol=releasecol,
+                                 format='csv',
+                                 maxrec=-1)
+
+            delt = time.time() - time0
+
+            with open(pfilter.outpath, 'r') as fp:
+                koaids = [row[0] for row in list(csv.reader(fp))[1:]]
+
+            match = (koaids == expected)
+            if not match:
+                nfail = nfail + 1
+
+            name = userid
+            if(len(name) == 0):
+                name = 'anonymous'
+
+            nrows[name] = len(koaids)
+
+            print(f'{name:10s} {releasecol or "-":14s} {len(koaids):8d} '
+                  f'{delt:8.3f}  {str(match):s}')
+
+    #
+    # The grants have to show: each user sees more rows than the one
+    # with fewer grants
+    #
+
+    if not (nrows['anonymous'] < nrows['few'] < nrows['many']):
+
+        print('')
+        print(f'row counts do not differ between users: {str(nrows):s}')
+
+        nfail = nfail + 1
+
+    return(nfail)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import math
+import sqlite3
+
+import pytest
+
+pytest.importorskip('spatial_index')
+
+from TAP import conesearch
+from TAP.conesearch import coneSearch
+
+
+class fakeIndex:
+
+    # SpatialIndex stand-in returning a fixed set of cells and counting
+    # the lookups
+
+    ncall = 0
+
+    constraint = '((spt_ind = 40) or (spt_ind between 10 and 20) or ' \
+                 '(spt_ind = 21) or (spt_ind BETWEEN 35 AND 30) or ' \
+                 '(spt_ind between 15 and 18))'
+
+    def cone_search(self, *args):
+
+        fakeIndex.ncall = fakeIndex.ncall + 1
+
+        return({'index_constraint': self.constraint})
+
+
+@pytest.fixture
+def index(monkeypatch):
+
+    fakeIndex.ncall = 0
+
+    monkeypatch.setattr(conesearch, 'SpatialIndex', fakeIndex)
+
+    return(fakeIndex)
+
+
+def coalesce(ranges, maxranges):
+
+    cone = coneSearch.__new__(coneSearch)
+    cone.maxranges = maxranges
+
+    return(cone.__coalesce__(ranges))
+
+
+def test_coalesce():
+
+    ranges = [(30, 35), (10, 20), (21, 21), (15, 18), (40, 40)]
+
+    assert coalesce(ranges, 0) == [[10, 21], [30, 35], [40, 40]]
+    assert coalesce(ranges, 2) == [[10, 21], [30, 40]]
+    assert coalesce(ranges, 1) == [[10, 40]]
+
+    #
+    # Equal gaps do not chain: each pass merges pairs next to the
+    # smallest gaps, not runs of them
+    #
+
+    ranges = [(i*10, i*10 + 1) for i in range(8)]
+
+    assert coalesce(ranges, 4) == [[0, 11], [20, 31], [40, 51], [60, 71]]
+
+
+def test_constraint(index):
+
+    cone = coneSearch(10., 20., 0.5, colname='spt_ind')
+
+    assert cone.ncell == 5
+    assert cone.ranges == [(10, 21), (30, 35), (40, 40)]
+
+    assert cone.index_constraint == \
+        '((spt_ind between 10 and 21) or (spt_ind between 30 and 35) or ' \
+        '(spt_ind = 40))'
+
+    assert cone.constraint == \
+        '(' + cone.geom_constraint + ' and ' + cone.index_constraint + ')'
+
+
+def test_ranges_cached(index, tmp_path):
+
+    cachedir = str(tmp_path / 'cache')
+
+    cone1 = coneSearch(10., 20., 0.5, cachedir=cachedir)
+    cone2 = coneSearch(370., 20., 0.5, cachedir=cachedir)
+
+    assert index.ncall == 1
+    assert cone2.ranges == cone1.ranges
+
+    #
+    # Cones differing beyond the 10th decimal are not the same key
+    #
+
+    coneSearch(10. + 1e-11, 20., 0.5, cachedir=cachedir)
+
+    assert index.ncall == 2
+
+
+def test_geom_constraint(index):
+
+    #
+    # With an arcsecond radius the cut keeps the records just inside the
+    # cone and drops those just outside it
+    #
+
+    radius = 1./3600.
+
+    cone = coneSearch(150., -30., radius, xcol='x', ycol='y', zcol='z')
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table src (id integer, x real, y real, z real)')
+
+    for (i, frac) in enumerate([0.9, 0.999, 1.001, 1.1]):
+
+        dec = math.radians(-30. + frac*radius)
+        ra = math.radians(150.)
+
+        conn.execute('insert into src values (?, ?, ?, ?)',
+                     (i, math.cos(dec)*math.cos(ra),
+                      math.cos(dec)*math.sin(ra), math.sin(dec)))
+
+    rows = conn.execute('select id from src where ' +
+                        cone.geom_constraint).fetchall()
+
+    conn.close()
+
+    assert sorted(rows) == [(0,), (1,)]
+
+
+@pytest.mark.parametrize('dec,radius', [(91., 1.), (-90.5, 1.), (0., 0.),
+                                        (0., 181.)])
+def test_invalid_cone(index, dec, radius):
+
+    with pytest.raises(Exception, match='Cone search'):
+        coneSearch(10., dec, radius)
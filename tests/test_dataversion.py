@@ -0,0 +1,101 @@
+import os
+import sqlite3
+
+import pytest
+
+from TAP.dataversion import dataVersion
+
+
+@pytest.fixture
+def catalog(tmp_path):
+
+    dbpath = str(tmp_path / 'cat.db')
+    schemapath = str(tmp_path / 'tap_schema.db')
+
+    conn = sqlite3.connect(dbpath)
+
+    conn.execute('create table ps (name text, load_id integer)')
+    conn.execute("insert into ps values ('a', 3)")
+    conn.execute("insert into ps values ('b', 7)")
+
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table tables (table_name text, version text)')
+    conn.execute("insert into tables values ('ps', '2024-05-01')")
+
+    conn.commit()
+    conn.close()
+
+    return({'dbms': 'sqlite3', 'db': dbpath, 'tap_schema': schemapath})
+
+
+def load(catalog, load_id):
+
+    conn = sqlite3.connect(catalog['db'])
+    conn.execute("insert into ps values ('c', ?)", (load_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_modes(catalog):
+
+    assert dataVersion(catalog, 'ps').version == ''
+
+    assert dataVersion(catalog, 'PS', mode='sql',
+                       sql='select max(load_id) from {table}').version == '7'
+
+    assert dataVersion(catalog, 'ps', mode='tap_schema').version == \
+        '2024-05-01'
+
+    assert dataVersion(catalog, 'ps', mode='mtime').version == \
+        str(os.stat(catalog['db']).st_mtime_ns)
+
+    assert dataVersion(catalog, 'tap_schema.tables', mode='mtime').version \
+        == str(os.stat(catalog['tap_schema']).st_mtime_ns)
+
+
+def test_failed_lookup(catalog):
+
+    #
+    # A version that cannot be looked up is empty, not an error
+    #
+
+    assert dataVersion(catalog, 'ps', mode='sql',
+                       sql='select max(nocol) from {table}').version == ''
+
+    assert dataVersion(catalog, 'ps', mode='tap_schema',
+                       column='nocol').version == ''
+
+    assert dataVersion(catalog, 'nosuch', mode='tap_schema').version == ''
+
+    assert dataVersion(catalog, 'ps', mode='nosuch').version == ''
+
+
+def test_interval(catalog, tmp_path):
+
+    #
+    # The version is looked up once per interval, per table and mode
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select max(load_id) from {table}'
+
+    assert dataVersion(catalog, 'ps', mode='sql', sql=sql,
+                       cachedir=cachedir).version == '7'
+
+    load(catalog, 9)
+
+    assert dataVersion(catalog, 'ps', mode='sql', sql=sql,
+                       cachedir=cachedir).version == '7'
+
+    assert dataVersion(catalog, 'ps', mode='sql', sql=sql,
+                       cachedir=cachedir, interval=0).version == '9'
+
+    assert dataVersion(catalog, 'ps', mode='sql', sql=sql).version == '9'
+
+    assert dataVersion(catalog, 'ps', mode='tap_schema',
+                       cachedir=cachedir).version == '2024-05-01'
@@ -0,0 +1,57 @@
+import os
+import time
+
+from TAP.filecache import fileCache
+
+
+def test_put_get(tmp_path):
+
+    cache = fileCache(str(tmp_path), 'access')
+
+    assert cache.get('alice') is None
+
+    cache.put('alice', ['2099a_x', '2099b_y'])
+
+    assert cache.get('alice') == ['2099a_x', '2099b_y']
+
+    #
+    # Another process (a new instance) reads the file
+    #
+
+    assert fileCache(str(tmp_path), 'access').get('alice') == \
+        ['2099a_x', '2099b_y']
+
+    assert fileCache(str(tmp_path), 'session').get('alice') is None
+
+
+def test_ttl(tmp_path):
+
+    cache = fileCache(str(tmp_path), 'access', ttl=1)
+
+    cache.put('alice', ['2099a_x'])
+    cache.put('bob', ['2099b_y'], ttl=60)
+
+    time.sleep(1.1)
+
+    assert cache.get('alice') is None
+    assert fileCache(str(tmp_path), 'access').get('alice') is None
+
+    assert cache.get('bob') == ['2099b_y']
+
+
+def test_invalidate(tmp_path):
+
+    cache = fileCache(str(tmp_path), 'access')
+
+    cache.put('alice', ['2099a_x'])
+    cache.put('bob', ['2099b_y'])
+
+    cache.invalidate('alice')
+
+    assert cache.get('alice') is None
+    assert cache.get('bob') == ['2099b_y']
+
+    cache.invalidate()
+
+    assert cache.get('bob') is None
+    assert os.listdir(str(tmp_path / 'access')) == []
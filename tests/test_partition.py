@@ -0,0 +1,138 @@
+import random
+import sqlite3
+
+import pytest
+
+from TAP.partition import partitionCursor
+
+
+@pytest.fixture(scope='module')
+def catalog(tmp_path_factory):
+
+    dbdir = tmp_path_factory.mktemp('partition')
+
+    dbpath = str(dbdir / 'cat.db')
+    schemapath = str(dbdir / 'tap_schema.db')
+
+    random.seed(3)
+
+    conn = sqlite3.connect(dbpath)
+
+    conn.execute('create table src (id integer, htm integer, mag real, '
+                 'name text)')
+    conn.execute('create index src_htm on src (htm)')
+    conn.execute('create index src_name on src (name)')
+
+    rows = []
+    for i in range(20000):
+
+        htm = random.randint(0, 10**9)
+        if(i % 500 == 0):
+            htm = None
+
+        rows.append((i, htm, round(random.uniform(5., 20.), 2),
+                     f'S{i:06d}'))
+
+    conn.executemany('insert into src values (?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+    sqlite3.connect(schemapath).close()
+
+    return({'dbms': 'sqlite3', 'db': dbpath, 'tap_schema': schemapath})
+
+
+def run(connectInfo, sql, workdir, **kwargs):
+
+    conn = sqlite3.connect(connectInfo['db'])
+
+    serial = conn.execute(sql).fetchall()
+
+    cursor = partitionCursor(conn, connectInfo, sql, 'src', 'htm', nproc=2,
+                             npart=5, minrows=1, workdir=str(workdir),
+                             arraysize=1000, **kwargs)
+
+    assert cursor.ntask == 6
+
+    try:
+        parallel = []
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            parallel.extend(rows)
+
+    finally:
+        cursor.close()
+        conn.close()
+
+    return(serial, parallel)
+
+
+def test_unordered(catalog, tmp_path):
+
+    serial, parallel = run(catalog, 'select id, htm, mag from src '
+                                    'where mag < 12', tmp_path)
+
+    assert len(parallel) > 0
+    assert sorted(parallel, key=str) == sorted(serial, key=str)
+
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize('orderby', [
+    'order by mag desc, id',
+    'order by htm',
+    'order by 3, 1 desc',
+    'order by s.name',
+])
+def test_ordered(catalog, tmp_path, orderby):
+
+    serial, parallel = run(catalog, 'select s.id, s.htm, s.mag, s.name '
+                                    'from src s where s.mag > 10 ' + orderby,
+                           tmp_path)
+
+    assert len(parallel) > 0
+    assert parallel == serial
+
+
+def test_pool_reused(catalog, tmp_path):
+
+    run(catalog, 'select id from src where mag < 6', tmp_path)
+    pool = partitionCursor.sharedpool
+
+    run(catalog, 'select id from src where mag > 19', tmp_path)
+
+    assert pool is not None
+    assert partitionCursor.sharedpool is pool
+
+
+@pytest.mark.parametrize('sql', [
+    "select * from src where name = 'S000123'",
+    'select * from src where htm between 1000 and 2000',
+    'select count(*) from src',
+    'select distinct mag from src',
+    'select * from src limit 10',
+    'select * from src where id in (select id from src where mag < 6)',
+    'select * from src order by mag + 1',
+])
+def test_not_partitioned(catalog, tmp_path, sql):
+
+    conn = sqlite3.connect(catalog['db'])
+
+    with pytest.raises(Exception):
+        partitionCursor(conn, catalog, sql, 'src', 'htm', nproc=2,
+                        minrows=1, workdir=str(tmp_path))
+
+    conn.close()
+
+
+def test_small_table(catalog, tmp_path):
+
+    conn = sqlite3.connect(catalog['db'])
+
+    with pytest.raises(Exception, match='fewer than'):
+        partitionCursor(conn, catalog, 'select * from src', 'src', 'htm',
+                        nproc=2, workdir=str(tmp_path))
+
+    conn.close()
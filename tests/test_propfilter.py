@@ -0,0 +1,579 @@
+import os
+import csv
+import shutil
+import sqlite3
+import datetime
+
+import pytest
+
+from TAP import propfilter
+from TAP.propfilter import propFilter
+from TAP.filecache import fileCache
+from TAP.releasedate import add_months, releaseDate
+
+
+#
+# koaid: (koa_hires date_obs, semid), (koa_nirspec date_obs, semid); the
+# recent dates are still proprietary, alice is granted 2099A_X
+#
+
+RECENT = datetime.date.today().isoformat()
+
+ROWS = {'K1': (('2000-01-01', '2000A_P'), (RECENT, '2099B_Y')),
+        'K2': ((RECENT, '2099A_X'), ('2000-01-01', '2000A_P')),
+        'K3': ((RECENT, '2099B_Y'), ('2000-01-01', '2000A_P')),
+        'K4': (('2000-01-01', '2000A_P'), ('2000-01-01', '2000A_P'))}
+
+
+@pytest.fixture(scope='module')
+def koadb(tmp_path_factory):
+
+    dbdir = tmp_path_factory.mktemp('koa')
+
+    dbpath = str(dbdir / 'koa.db')
+    schemapath = str(dbdir / 'tap_schema.db')
+
+    conn = sqlite3.connect(dbpath)
+
+    conn.execute('create table koa_hires (koaid text, date_obs text, '
+                 'propmin integer, semid text)')
+    conn.execute('create table koa_nirspec (koaid text, date_obs text, '
+                 'propint integer, semid text)')
+
+    #
+    # A public table with a date_obs column too, so that unqualified
+    # access constraint columns would be ambiguous
+    #
+
+    conn.execute('create table other (koaid text, date_obs text)')
+
+    for koaid in ROWS:
+
+        hires, nirspec = ROWS[koaid]
+
+        conn.execute('insert into koa_hires values (?, ?, 24, ?)',
+                     (koaid,) + hires)
+        conn.execute('insert into koa_nirspec values (?, ?, 24, ?)',
+                     (koaid,) + nirspec)
+        conn.execute('insert into other values (?, ?)', (koaid, RECENT))
+
+    conn.execute('create table koa_access (userid text, semid text)')
+    conn.execute("insert into koa_access values ('alice', '2099A_X')")
+
+    conn.execute('create table koa_users (userid text, passwd text)')
+    conn.execute("insert into koa_users values ('alice', 'pw')")
+
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table columns (table_name text, column_name text, '
+                 'datatype text, description text, unit text, format text)')
+
+    for table in ['koa_hires', 'koa_nirspec', 'other']:
+        for name in ['koaid', 'date_obs', 'semid']:
+            conn.execute('insert into columns values (?, ?, ?, ?, ?, ?)',
+                         (table, name, 'char', '', '', '10s'))
+
+    conn.commit()
+    conn.close()
+
+    return({'dbms': 'sqlite3', 'db': dbpath, 'tap_schema': schemapath})
+
+
+def result(koadb, workdir, sql, cookiestr='', **kwargs):
+
+    args = {'tablemap': {'other': {'propcol': ''}}}
+    args.update(kwargs)
+
+    pfilter = propFilter(connectInfo=koadb,
+                         query=sql,
+                         workdir=str(workdir),
+                         cookiename='KOA',
+                         cookiestr=cookiestr,
+                         usertbl='koa_users',
+                         accesstbl='koa_access',
+                         propfilter='koa',
+                         fileid='koaid',
+                         accessid='semid',
+                         format='csv',
+                         maxrec=-1,
+                         **args)
+
+    with open(pfilter.outpath, 'r') as fp:
+        return(list(csv.reader(fp)))
+
+
+def query(koadb, workdir, sql, cookiestr='', **kwargs):
+
+    rows = result(koadb, workdir, sql, cookiestr=cookiestr, **kwargs)
+
+    return(sorted([row[0] for row in rows[1:]]))
+
+
+def tables(koadb):
+
+    conn = sqlite3.connect(koadb['db'])
+    names = conn.execute('select name from sqlite_master').fetchall()
+    conn.close()
+
+    return(sorted(names))
+
+
+def test_single_table(koadb, tmp_path):
+
+    assert query(koadb, tmp_path, 'select koaid from koa_hires') == \
+        ['K1', 'K4']
+
+    assert query(koadb, tmp_path, 'select koaid from koa_hires',
+                 cookiestr='KOA=alice|pw') == ['K1', 'K2', 'K4']
+
+
+@pytest.mark.parametrize('sql', [
+    'select o.koaid from other o join koa_hires h on o.koaid = h.koaid',
+    'select other.koaid from other join koa_hires '
+    'on other.koaid = koa_hires.koaid',
+    'select other.koaid from other, koa_hires '
+    'where other.koaid = koa_hires.koaid order by other.koaid',
+    'select koaid from other where koaid in (select koaid from koa_hires)',
+    'with o as (select koaid from other) '
+    'select o.koaid from o join koa_hires h on o.koaid = h.koaid',
+])
+def test_public_table_first(koadb, tmp_path, sql):
+
+    assert query(koadb, tmp_path, sql) == ['K1', 'K4']
+
+
+@pytest.mark.parametrize('sql', [
+    'select h.koaid from koa_hires h join koa_nirspec n '
+    'on h.koaid = n.koaid',
+    'select koa_nirspec.koaid from koa_nirspec join koa_hires '
+    'on koa_hires.koaid = koa_nirspec.koaid',
+    'select koaid from koa_hires where koaid in '
+    '(select koaid from koa_nirspec)',
+    'select koaid from koa_hires intersect select koaid from koa_nirspec',
+    'with h as (select koaid from koa_hires), '
+    'n as (select koaid from koa_nirspec) '
+    'select h.koaid from h join n on h.koaid = n.koaid',
+])
+def test_two_proprietary_tables(koadb, tmp_path, sql):
+
+    assert query(koadb, tmp_path, sql) == ['K4']
+
+    assert query(koadb, tmp_path, sql, cookiestr='KOA=alice|pw') == \
+        ['K2', 'K4']
+
+
+def test_union(koadb, tmp_path):
+
+    #
+    # Each member is filtered with its own table's constraint (and the
+    # select list of the second one is not taken for a table)
+    #
+
+    sql = "select koaid from koa_hires where koaid < 'K3' union " \
+        "select koaid from koa_nirspec where koaid > 'K2' order by koaid"
+
+    assert query(koadb, tmp_path, sql) == ['K1', 'K3', 'K4']
+
+    assert query(koadb, tmp_path, sql, cookiestr='KOA=alice|pw') == \
+        ['K1', 'K2', 'K3', 'K4']
+
+    sql = 'select koaid from koa_hires union all select koaid from other'
+
+    assert query(koadb, tmp_path, sql) == \
+        ['K1', 'K1', 'K2', 'K3', 'K4', 'K4']
+
+
+@pytest.mark.parametrize('sql', [
+    'with h as (select koaid from koa_hires) select koaid from h',
+    'with h (k) as (select koaid from koa_hires) select k from h',
+    'with h as (select koaid, date_obs from koa_hires), '
+    'g as (select koaid from h) select g.koaid from g',
+    'with koa_nirspec as (select koaid from koa_hires) '
+    'select koaid from koa_nirspec',
+])
+def test_with(koadb, tmp_path, sql):
+
+    #
+    # The WITH bodies are filtered, the WITH names are not tables
+    #
+
+    assert query(koadb, tmp_path, sql) == ['K1', 'K4']
+
+    assert query(koadb, tmp_path, sql, cookiestr='KOA=alice|pw') == \
+        ['K1', 'K2', 'K4']
+
+
+def test_single_query(koadb, tmp_path):
+
+    #
+    # No temporary tables, and an OR in the user's condition does not
+    # get around the access constraint
+    #
+
+    before = tables(koadb)
+
+    sql = "select koaid from koa_hires where koaid = 'K2' or koaid = 'K3'"
+
+    assert query(koadb, tmp_path, sql) == []
+
+    assert query(koadb, tmp_path, sql, cookiestr='KOA=alice|pw') == ['K2']
+
+    assert tables(koadb) == before
+
+
+@pytest.fixture
+def koacopy(koadb, tmp_path):
+
+    #
+    # A copy of the database that a test may change
+    #
+
+    dbdir = tmp_path / 'db'
+    dbdir.mkdir()
+
+    copy = dict(koadb)
+
+    for key in ['db', 'tap_schema']:
+
+        copy[key] = str(dbdir / os.path.basename(koadb[key]))
+        shutil.copy(koadb[key], copy[key])
+
+    return(copy)
+
+
+def test_access_cache(koacopy, tmp_path):
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select koaid from koa_hires'
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 cachedir=cachedir) == ['K1', 'K2', 'K4']
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute('delete from koa_access')
+    conn.commit()
+    conn.close()
+
+    #
+    # The access IDs are cached for access_ttl seconds, or until the
+    # entry is invalidated
+    #
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 cachedir=cachedir) == ['K1', 'K2', 'K4']
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw') == \
+        ['K1', 'K4']
+
+    fileCache(cachedir, 'access').invalidate()
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 cachedir=cachedir) == ['K1', 'K4']
+
+
+def test_session_cache(koacopy, tmp_path):
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select koaid from koa_hires'
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 cachedir=cachedir) == ['K1', 'K2', 'K4']
+
+    #
+    # The cached session keeps the cookie valid after a password change;
+    # the password is not written to the cache
+    #
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute("update koa_users set passwd = 'new'")
+    conn.commit()
+    conn.close()
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 cachedir=cachedir) == ['K1', 'K2', 'K4']
+
+    with pytest.raises(Exception, match='Failed to validate'):
+        query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw')
+
+    sessiondir = tmp_path / 'cache' / 'session'
+
+    for fname in os.listdir(str(sessiondir)):
+        assert '|pw' not in (sessiondir / fname).read_text()
+
+
+def test_fileid_table(koadb, tmp_path):
+
+    #
+    # The allowed fileid table is written in diagnostic mode only
+    #
+
+    sql = 'select koaid from koa_hires'
+
+    (tmp_path / 'run').mkdir()
+    (tmp_path / 'diag').mkdir()
+
+    query(koadb, tmp_path / 'run', sql)
+
+    assert not [fname for fname in os.listdir(str(tmp_path / 'run'))
+                if fname.startswith('tmp_fileidallowed')]
+
+    query(koadb, tmp_path / 'diag', sql, cookiestr='KOA=alice|pw',
+          fileidtbl=1)
+
+    fnames = [fname for fname in os.listdir(str(tmp_path / 'diag'))
+              if fname.startswith('tmp_fileidallowed')]
+
+    assert len(fnames) == 1
+
+    text = (tmp_path / 'diag' / fnames[0]).read_text()
+
+    assert ('K2' in text) and ('K3' not in text)
+
+
+def test_release_column(koacopy, tmp_path):
+
+    #
+    # With the precomputed release date the results are the same
+    #
+
+    conn = sqlite3.connect(koacopy['db'])
+
+    releaseDate(conn, 'sqlite3', 'koa_hires', 'date_obs', 'propmin',
+                create=1)
+    releaseDate(conn, 'sqlite3', 'koa_nirspec', 'date_obs', 'propint',
+                create=1)
+
+    conn.close()
+
+    sql = 'select h.koaid from koa_hires h join koa_nirspec n ' \
+          'on h.koaid = n.koaid'
+
+    assert query(koacopy, tmp_path, sql, releasecol='release_date') == ['K4']
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw',
+                 releasecol='release_date') == ['K2', 'K4']
+
+
+WRITER = {'other': {'propcol': ''},
+          'koa_hires': {'filtermode': 'writer'},
+          'koa_nirspec': {'filtermode': 'writer'}}
+
+
+@pytest.mark.parametrize('sql', [
+    'select koaid, date_obs from koa_hires',
+    'select * from koa_hires',
+    'select h.koaid, h.semid from koa_hires h where h.koaid > \'K1\'',
+    'select o.koaid from other o join koa_hires h on o.koaid = h.koaid',
+])
+def test_writer_filter(koadb, tmp_path, monkeypatch, sql):
+
+    #
+    # The writer side filter returns the same rows and columns as the
+    # SQL constraint
+    #
+
+    rfilters = []
+
+    class recordFilter(propfilter.rowFilter):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            rfilters.append(self)
+
+    monkeypatch.setattr(propfilter, 'rowFilter', recordFilter)
+
+    expected = result(koadb, tmp_path, sql, cookiestr='KOA=alice|pw')
+
+    assert len(rfilters) == 0
+
+    rows = result(koadb, tmp_path, sql, cookiestr='KOA=alice|pw',
+                  tablemap=WRITER)
+
+    assert len(rfilters) == 1
+
+    assert rows[0] == expected[0]
+    assert sorted(rows[1:]) == sorted(expected[1:])
+
+    #
+    # Anonymous users keep the SQL constraint
+    #
+
+    assert result(koadb, tmp_path, sql, tablemap=WRITER) == \
+        result(koadb, tmp_path, sql)
+
+    assert len(rfilters) == 1
+
+
+@pytest.mark.parametrize('sql', [
+    'select count(*) from koa_hires',
+    'select distinct semid from koa_hires',
+    'select koaid from koa_hires limit 2',
+    'select koaid from koa_hires union select koaid from koa_nirspec',
+    'select h.koaid from koa_hires h join koa_nirspec n '
+    'on h.koaid = n.koaid',
+])
+def test_writer_fallback(koadb, tmp_path, monkeypatch, sql):
+
+    #
+    # Queries whose rows are not table rows keep the SQL constraint
+    #
+
+    rfilters = []
+
+    class recordFilter(propfilter.rowFilter):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            rfilters.append(self)
+
+    monkeypatch.setattr(propfilter, 'rowFilter', recordFilter)
+
+    expected = result(koadb, tmp_path, sql, cookiestr='KOA=alice|pw')
+
+    rows = result(koadb, tmp_path, sql, cookiestr='KOA=alice|pw',
+                  tablemap=WRITER)
+
+    assert len(rfilters) == 0
+
+    assert sorted(rows) == sorted(expected)
+
+
+def test_public_cache(koacopy, tmp_path):
+
+    #
+    # Results of users without grants are shared (until the next local
+    # midnight); those of users with grants are not
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select koaid from koa_hires'
+
+    for name in ['run1', 'run2', 'run3', 'run4']:
+        (tmp_path / name).mkdir()
+
+    assert query(koacopy, tmp_path / 'run1', sql, cachedir=cachedir,
+                 public_cache=1) == ['K1', 'K4']
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute("insert into koa_hires values ('K5', '2000-01-01', 24, "
+                 "'2000A_P')")
+    conn.commit()
+    conn.close()
+
+    assert query(koacopy, tmp_path / 'run2', sql, cachedir=cachedir,
+                 public_cache=1) == ['K1', 'K4']
+
+    assert os.stat(str(tmp_path / 'run2' / 'result.csv')).st_nlink > 1
+
+    assert query(koacopy, tmp_path / 'run3', sql, cachedir=cachedir,
+                 public_cache=1, cookiestr='KOA=alice|pw') == \
+        ['K1', 'K2', 'K4', 'K5']
+
+    assert query(koacopy, tmp_path / 'run4', sql) == ['K1', 'K4', 'K5']
+
+
+def test_single_flight(koacopy, tmp_path):
+
+    #
+    # Without a result cache, single_flight shares a result through the
+    # short-lived 'flight' cache
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select koaid from koa_hires'
+
+    for name in ['run1', 'run2']:
+        (tmp_path / name).mkdir()
+
+    assert query(koacopy, tmp_path / 'run1', sql, cachedir=cachedir,
+                 single_flight=60) == ['K1', 'K4']
+
+    assert os.listdir(cachedir) == ['flight']
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute("insert into koa_hires values ('K5', '2000-01-01', 24, "
+                 "'2000A_P')")
+    conn.commit()
+    conn.close()
+
+    assert query(koacopy, tmp_path / 'run2', sql, cachedir=cachedir,
+                 single_flight=60) == ['K1', 'K4']
+
+    assert os.stat(str(tmp_path / 'run2' / 'result.csv')).st_nlink > 1
+
+
+def test_data_version(koacopy, tmp_path):
+
+    #
+    # A cached result is used while the table's data version is the
+    # same, and not after a reload changes it
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    sql = 'select koaid from koa_hires'
+
+    for name in ['run1', 'run2', 'run3']:
+        (tmp_path / name).mkdir()
+
+    assert query(koacopy, tmp_path / 'run1', sql, cachedir=cachedir,
+                 result_cache=1000000, dataversion='1') == ['K1', 'K4']
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute("insert into koa_hires values ('K5', '2000-01-01', 24, "
+                 "'2000A_P')")
+    conn.commit()
+    conn.close()
+
+    assert query(koacopy, tmp_path / 'run2', sql, cachedir=cachedir,
+                 result_cache=1000000, dataversion='1') == ['K1', 'K4']
+
+    assert query(koacopy, tmp_path / 'run3', sql, cachedir=cachedir,
+                 result_cache=1000000, dataversion='2') == ['K1', 'K4', 'K5']
+
+
+def test_many_grants(koacopy, tmp_path):
+
+    #
+    # More grants than SQLite's bind limit go through a TEMP table
+    #
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.executemany('insert into koa_access values (?, ?)',
+                     [('alice', f'2099A_G{i:04d}') for i in range(1500)])
+    conn.commit()
+    conn.close()
+
+    sql = 'select h.koaid from koa_hires h, koa_nirspec n ' \
+          'where h.koaid = n.koaid'
+
+    assert query(koacopy, tmp_path, sql, cookiestr='KOA=alice|pw') == \
+        ['K2', 'K4']
+
+
+def test_release_day(koacopy, tmp_path):
+
+    #
+    # Data is public on its release day, as with Oracle's current_date
+    #
+
+    today = datetime.date.today()
+
+    conn = sqlite3.connect(koacopy['db'])
+    conn.execute("insert into koa_hires values ('K5', ?, 24, '2099B_Y')",
+                 (add_months(today.isoformat(), -24),))
+    conn.execute("insert into koa_hires values ('K6', ?, 24, '2099B_Y')",
+                 (add_months((today + datetime.timedelta(days=1))
+                             .isoformat(), -24),))
+    conn.commit()
+    conn.close()
+
+    assert query(koacopy, tmp_path, 'select koaid from koa_hires') == \
+        ['K1', 'K4', 'K5']
@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+from TAP.releasedate import add_months, releaseDate
+
+
+@pytest.mark.parametrize('datestr, nmonths, release', [
+    ('2020-01-15', 18, '2021-07-15'),
+    ('2020-01-31', 1, '2020-02-29'),
+    ('2020-02-29', 12, '2021-02-28'),
+    ('2021-02-28', 1, '2021-03-31'),
+    ('2020-06-30', 0, '2020-06-30'),
+    ('2020-01-15 10:20:30', 6, '2020-07-15 10:20:30'),
+    (None, 12, None),
+    ('2020-01-15', None, None),
+])
+def test_add_months(datestr, nmonths, release):
+
+    #
+    # The Oracle rule: the last day of a month maps to the last day of
+    # the target month
+    #
+
+    assert add_months(datestr, nmonths) == release
+
+
+def test_release_date(tmp_path):
+
+    conn = sqlite3.connect(str(tmp_path / 'koa.db'))
+
+    conn.execute('create table koa_hires (koaid text, date_obs text, '
+                 'propmin integer)')
+    conn.executemany('insert into koa_hires values (?, ?, ?)',
+                     [('K1', '2020-01-31', 1),
+                      ('K2', '2020-03-15', 18),
+                      ('K3', None, 18)])
+    conn.commit()
+
+    rd = releaseDate(conn, 'sqlite3', 'koa_hires', 'date_obs', 'propmin',
+                     create=1, index=1)
+
+    assert rd.nupdate == 2
+
+    rows = conn.execute('select koaid, release_date from koa_hires '
+                        'order by koaid').fetchall()
+
+    assert rows == [('K1', '2020-02-29'), ('K2', '2021-09-15'), ('K3', None)]
+
+    #
+    # Only stale rows are updated again
+    #
+
+    rd = releaseDate(conn, 'sqlite3', 'koa_hires', 'date_obs', 'propmin')
+
+    assert rd.nupdate == 0
+
+    conn.execute("update koa_hires set propmin = 24 where koaid = 'K2'")
+    conn.commit()
+
+    rd = releaseDate(conn, 'sqlite3', 'koa_hires', 'date_obs', 'propmin')
+
+    assert rd.nupdate == 1
+
+    assert conn.execute("select release_date from koa_hires "
+                        "where koaid = 'K2'").fetchone() == ('2022-03-15',)
+
+    conn.close()
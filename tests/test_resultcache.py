@@ -0,0 +1,222 @@
+import os
+import multiprocessing
+import time
+import types
+
+from TAP import resultcache
+from TAP.resultcache import resultCache, result_key, access_scope
+
+
+def write(path, text):
+
+    with open(path, 'w') as fp:
+        fp.write(text)
+
+
+def test_access_scope():
+
+    assert access_scope([]) == 'public'
+
+    assert access_scope(['2024a_x', '2024b_y']) == \
+        access_scope(['2024b_y', '2024a_x'])
+
+    assert access_scope(['2024a_x']) != access_scope(['2024a_x', '2024b_y'])
+    assert access_scope(['2024a_x']) != 'public'
+
+
+def test_result_key():
+
+    sql = 'select ra, dec from koa_hires where ra > 10'
+
+    public = result_key('public', 'sqlite3', 'csv', -1, 0, sql)
+
+    assert result_key('public', 'SQLite3', 'csv', -1, 0,
+                      'SELECT ra, dec\n  FROM koa_hires -- note\n'
+                      ' WHERE ra > 10;') == public
+
+    assert result_key(access_scope(['2024a_x']), 'sqlite3', 'csv', -1, 0,
+                      sql) != public
+
+    assert result_key(access_scope(['2024a_x']), 'sqlite3', 'csv', -1, 0,
+                      sql) != result_key(access_scope(['2024b_y']),
+                                         'sqlite3', 'csv', -1, 0, sql)
+
+    assert result_key('public', 'sqlite3', 'csv', -1, 0, sql,
+                      version='2') != public
+
+    assert result_key('public', 'sqlite3', 'votable', -1, 0, sql) != public
+    assert result_key('public', 'sqlite3', 'csv', 10, 0, sql) != public
+
+
+def test_scopes_kept_apart(tmp_path):
+
+    rcache = resultCache(str(tmp_path / 'cache'), 'results')
+
+    sql = 'select * from koa_hires'
+
+    key1 = result_key(access_scope(['2024a_x']), 'sqlite3', 'csv', -1, 0,
+                      sql)
+    key2 = result_key(access_scope(['2024b_y']), 'sqlite3', 'csv', -1, 0,
+                      sql)
+
+    calls = []
+
+    def runner(outpath, text):
+
+        def run():
+            calls.append(text)
+            write(outpath, text)
+            return({'outpath': outpath, 'ntot': 1})
+
+        return(run)
+
+    out1 = str(tmp_path / 'out1.csv')
+    out2 = str(tmp_path / 'out2.csv')
+    out3 = str(tmp_path / 'out3.csv')
+
+    rcache.run(key1, out1, runner(out1, 'rows of user 1\n'), ttl=60)
+    rcache.run(key2, out2, runner(out2, 'rows of user 2\n'), ttl=60)
+
+    assert calls == ['rows of user 1\n', 'rows of user 2\n']
+
+    result = rcache.run(key1, out3, runner(out3, 'not run\n'), ttl=60)
+
+    assert calls == ['rows of user 1\n', 'rows of user 2\n']
+    assert result['ntot'] == 1
+
+    with open(out3) as fp:
+        assert fp.read() == 'rows of user 1\n'
+
+
+def test_expired(tmp_path):
+
+    rcache = resultCache(str(tmp_path / 'cache'), 'results')
+
+    outpath = str(tmp_path / 'out.csv')
+    write(outpath, 'rows\n')
+
+    rcache.put('key', outpath, {'ntot': 1}, ttl=-1)
+
+    assert rcache.get('key', str(tmp_path / 'copy.csv')) is None
+
+
+def test_lru_eviction(tmp_path):
+
+    rcache = resultCache(str(tmp_path / 'cache'), 'results', budget=250)
+
+    now = time.time()
+
+    for (i, key) in enumerate(['a', 'b']):
+
+        outpath = str(tmp_path / key)
+        write(outpath, key*100)
+
+        rcache.put(key, outpath, {'ntot': 1}, ttl=60)
+
+        entry = rcache.__path__(key) + '.json'
+        os.utime(entry, (now - 30 + 10*i, now - 30 + 10*i))
+
+    #
+    # 'a' is used again: 'b' is now the least recently used entry
+    #
+
+    assert rcache.get('a', str(tmp_path / 'copy')) is not None
+
+    outpath = str(tmp_path / 'c')
+    write(outpath, 'c'*100)
+
+    rcache.put('c', outpath, {'ntot': 1}, ttl=60)
+
+    assert rcache.get('b', str(tmp_path / 'copy_b')) is None
+    assert rcache.get('a', str(tmp_path / 'copy_a')) is not None
+    assert rcache.get('c', str(tmp_path / 'copy_c')) is not None
+
+    assert len(os.listdir(rcache.objdir)) == 2
+
+
+def flight(cachedir, outpath, logpath):
+
+    # One service process: runs the query through the flight cache
+    #
+
+    rcache = resultCache(cachedir, 'flight', prune=1)
+
+    def run():
+
+        with open(logpath, 'a') as fp:
+            fp.write('run\n')
+
+        time.sleep(1)
+        write(outpath, 'rows\n')
+
+        return({'outpath': outpath, 'ntot': 1})
+
+    rcache.run('key', outpath, run, ttl=5)
+
+
+def test_single_flight(tmp_path):
+
+    #
+    # Concurrent processes asking for the same key run the query once;
+    # the others get the finished file, hard linked
+    #
+
+    cachedir = str(tmp_path / 'cache')
+    logpath = str(tmp_path / 'runs.log')
+
+    ctx = multiprocessing.get_context('fork')
+
+    procs = []
+    for i in range(4):
+
+        proc = ctx.Process(target=flight,
+                           args=(cachedir, str(tmp_path / f'out{i:d}.csv'),
+                                 logpath))
+        proc.start()
+        procs.append(proc)
+
+    for proc in procs:
+        proc.join(30)
+        assert proc.exitcode == 0
+
+    with open(logpath) as fp:
+        assert fp.read() == 'run\n'
+
+    inodes = set()
+    for i in range(4):
+
+        path = str(tmp_path / f'out{i:d}.csv')
+
+        with open(path) as fp:
+            assert fp.read() == 'rows\n'
+
+        inodes.add(os.stat(path).st_ino)
+
+    assert len(inodes) == 1
+
+
+def test_flight_prune(tmp_path, monkeypatch):
+
+    #
+    # With prune, a put drops the expired entries and, once they are a
+    # minute old, their files
+    #
+
+    rcache = resultCache(str(tmp_path / 'cache'), 'flight', prune=1)
+
+    outpath = str(tmp_path / 'old.csv')
+    write(outpath, 'old rows\n')
+
+    rcache.put('old', outpath, {'ntot': 1}, ttl=-1)
+
+    later = time.time() + 120
+    monkeypatch.setattr(resultcache, 'time',
+                        types.SimpleNamespace(time=lambda: later))
+
+    outpath = str(tmp_path / 'new.csv')
+    write(outpath, 'new rows\n')
+
+    rcache.put('new', outpath, {'ntot': 1}, ttl=60)
+
+    assert not os.path.exists(rcache.__path__('old') + '.json')
+    assert os.listdir(rcache.objdir) == [rcache.__digest__(outpath)]
@@ -0,0 +1,25 @@
+from TAP.rowfilter import rowFilter
+
+
+def test_filter():
+
+    rfilter = rowFilter(['2099a_x'])
+
+    rows = [('K1', 1, '2000a_p'),
+            ('K2', 0, '2099a_x'),
+            ('K3', 0, '2099b_y'),
+            ('K4', 1, None)]
+
+    assert rfilter.filter(rows) == [rows[0], rows[1], rows[3]]
+
+    assert (rfilter.nin, rfilter.nout) == (4, 3)
+
+
+def test_columns():
+
+    rfilter = rowFilter(['2099a_x'], ipublic=1, iaccess=2)
+
+    rows = [('K2', 0, '2099a_x', 'extra'),
+            ('K3', 0, '2099b_y', 'extra')]
+
+    assert rfilter.filter(rows) == [rows[0]]
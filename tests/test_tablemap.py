@@ -0,0 +1,56 @@
+import pytest
+
+from TAP.tablemap import tableMap
+
+
+@pytest.mark.parametrize('table, instrument, propcol', [
+    ('koa_hires', 'hires', 'propmin'),
+    ('KOA.KOA_NIRC2', 'nirc2', 'propint'),
+    ('koa_nirc', 'nirc', 'propint'),
+    ('koa_esi_ext', 'esi', 'propint'),
+    ('koa_lengths', '', 'propint'),
+    ('koa_hiresx', '', 'propint'),
+])
+def test_koa_rules(table, instrument, propcol):
+
+    entry = tableMap('koa', 'koaid').lookup(table)
+
+    assert entry['instrument'] == instrument
+    assert entry['propcol'] == propcol
+    assert entry['datecol'] == 'date_obs'
+
+
+@pytest.mark.parametrize('table, datalevel, fileid, propcol', [
+    ('neidl1', 'l1', 'l1filename', 'l1propint'),
+    ('neid_l2', 'l2', 'l2filename', 'l2propint'),
+    ('neid_eng', 'eng', 'l0filename', 'l0propint'),
+    ('neid_level2', '', 'filename', ''),
+    ('neid_english', '', 'filename', ''),
+])
+def test_neid_rules(table, datalevel, fileid, propcol):
+
+    entry = tableMap('neid', 'filename').lookup(table)
+
+    assert entry['datalevel'] == datalevel
+    assert entry['fileid'] == fileid
+    assert entry['propcol'] == propcol
+
+
+def test_config_overrides():
+
+    tablemap = {'koa_hires': {'filtermode': 'writer'},
+                'koa.other': {'propcol': ''}}
+
+    tmap = tableMap('koa', 'koaid', tablemap=tablemap)
+
+    assert tmap.lookup('koa_hires')['filtermode'] == 'writer'
+    assert tmap.lookup('KOA.OTHER')['propcol'] == ''
+
+    #
+    # The name rules are shared, the overrides are not
+    #
+
+    assert tableMap('koa', 'koaid').lookup('koa_hires')['filtermode'] == \
+        'sql'
+    assert tableMap('koa', 'koaid').lookup('koa.other')['propcol'] == \
+        'propint'
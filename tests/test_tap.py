@@ -0,0 +1,408 @@
+import email.utils
+import hashlib
+import os
+import sqlite3
+import time
+import types
+
+import pytest
+
+pytest.importorskip('ADQL.adql')
+pytest.importorskip('spatial_index')
+
+from TAP.tap import Tap
+
+
+STATUS = '''<?xml version="1.0" encoding="UTF-8"?>
+<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0">
+    <uws:jobId>tap_1</uws:jobId>
+    <uws:phase>{phase:s}</uws:phase>
+    <uws:parameters>
+        <uws:parameter id="format">votable</uws:parameter>
+    </uws:parameters>
+</uws:job>'''
+
+
+def response(capfdbinary):
+
+    out = capfdbinary.readouterr().out
+
+    header, _, body = out.partition(b'\r\n\r\n')
+
+    lines = header.decode('utf-8').split('\r\n')
+
+    fields = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(': ')
+        fields[name] = value
+
+    return(lines[0], fields, body)
+
+
+def get_status(tmp_path, phase):
+
+    path = tmp_path / 'status.xml'
+    path.write_text(STATUS.format(phase=phase))
+
+    tap = Tap.__new__(Tap)
+    tap.statuspath = str(path)
+    tap.tapcontext = 'async'
+
+    with pytest.raises(SystemExit):
+        tap.__getStatus__(str(tmp_path), '', '', {})
+
+
+@pytest.mark.parametrize('phase', ['QUEUED', 'EXECUTING'])
+def test_status_running(tmp_path, capfdbinary, monkeypatch, phase):
+
+    #
+    # A status that can still change has no Last-Modified, and an
+    # If-Modified-Since in the same second does not get a 304
+    #
+
+    monkeypatch.setenv('HTTP_IF_MODIFIED_SINCE',
+                       email.utils.formatdate(time.time() + 1, usegmt=True))
+
+    get_status(tmp_path, phase)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 200 OK'
+    assert 'Last-Modified' not in fields
+    assert phase.encode('utf-8') in body
+
+    #
+    # The ETag still saves the transfer of an unchanged status
+    #
+
+    monkeypatch.setenv('HTTP_IF_NONE_MATCH', fields['ETag'])
+
+    get_status(tmp_path, phase)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 304 Not Modified'
+    assert body == b''
+
+
+@pytest.mark.parametrize('phase', ['COMPLETED', 'ERROR', 'ABORTED'])
+def test_status_final(tmp_path, capfdbinary, monkeypatch, phase):
+
+    monkeypatch.setenv('HTTP_IF_MODIFIED_SINCE',
+                       email.utils.formatdate(time.time() + 1, usegmt=True))
+
+    get_status(tmp_path, phase)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 304 Not Modified'
+    assert 'Last-Modified' in fields
+
+
+def test_status_etag(tmp_path, capfdbinary):
+
+    get_status(tmp_path, 'EXECUTING')
+
+    status, fields, body = response(capfdbinary)
+
+    data = (STATUS.format(phase='EXECUTING') + '\n').encode('utf-8')
+
+    assert body == data
+    assert fields['ETag'] == \
+        '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+    assert int(fields['Content-Length']) == len(data)
+
+
+def get_vosi(tmp_path, resource):
+
+    dbpath = str(tmp_path / 'cat.db')
+    schemapath = str(tmp_path / 'tap_schema.db')
+
+    conn = sqlite3.connect(schemapath)
+    conn.execute('create table if not exists tables (table_name text)')
+    conn.execute('create table if not exists columns (table_name text, '
+                 'column_name text, datatype text)')
+    conn.commit()
+    conn.close()
+
+    tap = Tap.__new__(Tap)
+    tap.httpurl = 'https://example.org'
+    tap.cgipgm = 'TAP'
+    tap.config = types.SimpleNamespace(
+        connectInfo={'dbms': 'sqlite3', 'db': dbpath,
+                     'tap_schema': schemapath},
+        cachedir=str(tmp_path / 'cache'), vosi_ttl=3600, dataversion='')
+
+    tap.__printVosi__(resource)
+
+
+@pytest.mark.parametrize('resource', ['tables', 'capabilities',
+                                      'availability'])
+def test_vosi(tmp_path, capfdbinary, monkeypatch, resource):
+
+    get_vosi(tmp_path, resource)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 200 OK'
+    assert fields['Content-type'] == 'text/xml'
+    assert int(fields['Content-Length']) == len(body)
+    assert fields['Cache-Control'] == 'no-cache'
+
+    #
+    # The document is not rendered again, so a client's copy stays valid
+    #
+
+    monkeypatch.setenv('HTTP_IF_NONE_MATCH', fields['ETag'])
+
+    get_vosi(tmp_path, resource)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 304 Not Modified'
+    assert body == b''
+
+
+def get_file(path, **kwargs):
+
+    tap = Tap.__new__(Tap)
+    tap.__printFile__(str(path), 'text/plain', **kwargs)
+
+
+def test_file_conditional(tmp_path, capfdbinary, monkeypatch):
+
+    path = tmp_path / 'result.csv'
+    path.write_bytes(b'a,b\n1,2\n')
+
+    get_file(path, cache='private, max-age=60')
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == b'a,b\n1,2\n'
+    assert int(fields['Content-Length']) == len(body)
+    assert fields['Cache-Control'] == 'private, max-age=60'
+    assert 'Last-Modified' in fields
+
+    etag = fields['ETag']
+
+    monkeypatch.setenv('HTTP_IF_NONE_MATCH', etag)
+
+    get_file(path)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 304 Not Modified'
+    assert fields['ETag'] == etag
+    assert 'Content-Length' not in fields
+    assert body == b''
+
+    #
+    # A rewritten result has another ETag
+    #
+
+    path.write_bytes(b'a,b\n1,3\n')
+
+    get_file(path)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 200 OK'
+    assert fields['ETag'] != etag
+    assert body == b'a,b\n1,3\n'
+
+
+def test_file_modified_since(tmp_path, capfdbinary, monkeypatch):
+
+    path = tmp_path / 'result.csv'
+    path.write_bytes(b'a,b\n1,2\n')
+
+    mtime = path.stat().st_mtime
+
+    for (since, expected) in [(mtime + 1, 'HTTP/1.1 304 Not Modified'),
+                              (mtime - 10, 'HTTP/1.1 200 OK')]:
+
+        monkeypatch.setenv('HTTP_IF_MODIFIED_SINCE',
+                           email.utils.formatdate(since, usegmt=True))
+
+        get_file(path)
+
+        status, fields, body = response(capfdbinary)
+
+        assert status == expected
+
+    #
+    # If-None-Match takes precedence
+    #
+
+    monkeypatch.setenv('HTTP_IF_MODIFIED_SINCE',
+                       email.utils.formatdate(mtime + 1, usegmt=True))
+    monkeypatch.setenv('HTTP_IF_NONE_MATCH', '"other"')
+
+    get_file(path)
+
+    status, fields, body = response(capfdbinary)
+
+    assert status == 'HTTP/1.1 200 OK'
+
+
+DATA = bytes(range(256)) * 4
+
+
+def get_range(tmp_path, capfdbinary, monkeypatch, rangestr, **kwargs):
+
+    path = tmp_path / 'result.dat'
+    if not path.exists():
+        path.write_bytes(DATA)
+
+    monkeypatch.setenv('HTTP_RANGE', rangestr)
+
+    for key in kwargs:
+        monkeypatch.setenv(key, kwargs[key])
+
+    get_file(path, ranges=1)
+
+    return(response(capfdbinary))
+
+
+@pytest.mark.parametrize('rangestr,first,last', [('bytes=0-99', 0, 99),
+                                                 ('bytes=1000-', 1000, 1023),
+                                                 ('bytes=-24', 1000, 1023),
+                                                 ('bytes=1000-5000', 1000,
+                                                  1023),
+                                                 ('bytes=10-19,15-29', 10,
+                                                  29)])
+def test_range(tmp_path, capfdbinary, monkeypatch, rangestr, first, last):
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     rangestr)
+
+    assert status == 'HTTP/1.1 206 Partial Content'
+    assert fields['Accept-Ranges'] == 'bytes'
+    assert fields['Content-Range'] == f'bytes {first:d}-{last:d}/1024'
+    assert int(fields['Content-Length']) == last - first + 1
+    assert body == DATA[first:last+1]
+
+
+def test_multiple_ranges(tmp_path, capfdbinary, monkeypatch):
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     'bytes=500-509,0-9')
+
+    assert status == 'HTTP/1.1 206 Partial Content'
+
+    ctype, _, boundary = fields['Content-type'].partition('; boundary=')
+
+    assert ctype == 'multipart/byteranges'
+    assert int(fields['Content-Length']) == len(body)
+
+    parts = body.split(b'\r\n--' + boundary.encode('utf-8'))
+
+    assert parts[0] == b''
+    assert parts[-1] == b'--\r\n'
+
+    spans = []
+    for part in parts[1:-1]:
+
+        header, _, data = part.partition(b'\r\n\r\n')
+
+        lines = header.decode('utf-8').split('\r\n')
+
+        assert lines[1] == 'Content-type: text/plain'
+
+        spans.append((lines[2], data))
+
+    assert spans == [('Content-Range: bytes 0-9/1024', DATA[0:10]),
+                     ('Content-Range: bytes 500-509/1024', DATA[500:510])]
+
+
+def test_unsatisfiable_range(tmp_path, capfdbinary, monkeypatch):
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     'bytes=2000-3000')
+
+    assert status == 'HTTP/1.1 416 Range Not Satisfiable'
+    assert fields['Content-Range'] == 'bytes */1024'
+    assert body == b''
+
+
+@pytest.mark.parametrize('rangestr', ['bytes=20-10', 'bytes=x-10',
+                                      'items=0-10', 'bytes=10'])
+def test_invalid_range(tmp_path, capfdbinary, monkeypatch, rangestr):
+
+    #
+    # A Range header that cannot be used is ignored
+    #
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     rangestr)
+
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == DATA
+
+
+def test_if_range(tmp_path, capfdbinary, monkeypatch):
+
+    #
+    # The range is sent only while the file matches If-Range (an ETag or
+    # a date); otherwise the whole file is
+    #
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     'bytes=0-9')
+
+    etag = fields['ETag']
+    mtime = (tmp_path / 'result.dat').stat().st_mtime
+
+    for (ifrange, expected) in [
+            (etag, 'HTTP/1.1 206 Partial Content'),
+            ('"other"', 'HTTP/1.1 200 OK'),
+            (email.utils.formatdate(mtime + 1, usegmt=True),
+             'HTTP/1.1 206 Partial Content'),
+            (email.utils.formatdate(mtime - 10, usegmt=True),
+             'HTTP/1.1 200 OK')]:
+
+        status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                         'bytes=0-9',
+                                         HTTP_IF_RANGE=ifrange)
+
+        assert status == expected
+
+
+def test_range_without_sendfile(tmp_path, capfdbinary, monkeypatch):
+
+    def sendfile(*args):
+        raise OSError('sendfile not supported')
+
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+
+    status, fields, body = get_range(tmp_path, capfdbinary, monkeypatch,
+                                     'bytes=100-199')
+
+    assert status == 'HTTP/1.1 206 Partial Content'
+    assert body == DATA[100:200]
+
+
+def cone_query(tmp_path, **coneparam):
+
+    tap = Tap.__new__(Tap)
+    tap.coneparam = coneparam
+    tap.config = types.SimpleNamespace(
+        adqlparam={'mode': 'HTM', 'encoding': 'BASE10', 'level': '20',
+                   'colname': 'htm20', 'xcol': 'x', 'ycol': 'y',
+                   'zcol': 'z'},
+        cone_maxranges=64, cachedir=str(tmp_path / 'cache'))
+
+    return(tap.__coneQuery__())
+
+
+@pytest.mark.parametrize('coneparam,msg', [
+    ({'table': 'ps', 'ra': '10'}, 'requires TABLE, RA, DEC and SR'),
+    ({'table': 'ps; drop table ps', 'ra': '10', 'dec': '20', 'sr': '0.1'},
+     'Invalid cone search TABLE'),
+    ({'table': 'ps', 'ra': 'ten', 'dec': '20', 'sr': '0.1'},
+     'must be numbers')])
+def test_cone_invalid(tmp_path, coneparam, msg):
+
+    with pytest.raises(Exception, match=msg):
+        cone_query(tmp_path, **coneparam)
@@ -0,0 +1,151 @@
+import csv
+import sqlite3
+
+import pytest
+
+from TAP.runquery import runQuery
+from TAP.tapschema import tapSchema
+
+
+@pytest.fixture
+def catalog(tmp_path):
+
+    dbpath = str(tmp_path / 'cat.db')
+    schemapath = str(tmp_path / 'tap_schema.db')
+
+    conn = sqlite3.connect(dbpath)
+    conn.execute('create table ps (pl_name text, ra real)')
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table tables (schema_name text, table_name text, '
+                 'description text)')
+    conn.execute("insert into tables values ('', 'ps', 'Planets')")
+
+    conn.execute('create table columns (table_name text, column_name text, '
+                 'datatype text, description text, unit text, format text)')
+
+    for (table, name, datatype) in [('ps', 'pl_name', 'char'),
+                                    ('ps', 'ra', 'double'),
+                                    ('tables', 'schema_name', 'char'),
+                                    ('tables', 'table_name', 'char'),
+                                    ('tables', 'description', 'char')]:
+        conn.execute('insert into columns values (?, ?, ?, ?, ?, ?)',
+                     (table, name, datatype, '', '', '20s'))
+
+    conn.commit()
+    conn.close()
+
+    return({'dbms': 'sqlite3', 'db': dbpath, 'tap_schema': schemapath})
+
+
+def add_table(catalog, name):
+
+    conn = sqlite3.connect(catalog['tap_schema'])
+    conn.execute("insert into tables values ('', ?, '')", (name,))
+    conn.commit()
+    conn.close()
+
+
+def table_names(schema):
+
+    conn = sqlite3.connect(schema.path)
+    rows = conn.execute('select table_name from tables').fetchall()
+    conn.close()
+
+    return(sorted([row[0] for row in rows]))
+
+
+def test_copy(catalog, tmp_path):
+
+    #
+    # The optional TAP_SCHEMA tables (keys, ...) may be missing; the copy
+    # holds the others, also as the attached TAP_SCHEMA
+    #
+
+    schema = tapSchema(catalog, str(tmp_path / 'cache'))
+
+    assert schema.connectInfo == {'dbms': 'sqlite3', 'db': schema.path,
+                                  'tap_schema': schema.path}
+
+    assert table_names(schema) == ['ps']
+
+    conn = sqlite3.connect(schema.path)
+    conn.execute('ATTACH DATABASE ? AS TAP_SCHEMA', (schema.path,))
+
+    assert conn.execute('select count(*) from TAP_SCHEMA.columns') \
+        .fetchone() == (5,)
+
+    conn.close()
+
+
+def test_query(catalog, tmp_path):
+
+    #
+    # The query runs on the copy through the usual runQuery path
+    #
+
+    schema = tapSchema(catalog, str(tmp_path / 'cache'))
+
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+
+    dbquery = runQuery(connectInfo=schema.connectInfo,
+                       query='select table_name, description '
+                             'from TAP_SCHEMA.tables',
+                       workdir=str(workdir),
+                       format='csv',
+                       maxrec=-1)
+
+    with open(dbquery.outpath, 'r') as fp:
+        rows = list(csv.reader(fp))
+
+    assert rows == [['table_name', 'description'], ['ps', 'Planets']]
+
+
+def test_version(catalog, tmp_path):
+
+    #
+    # The copy is made again only when the version changes
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    tapSchema(catalog, cachedir, version='1')
+
+    add_table(catalog, 'koa')
+
+    assert table_names(tapSchema(catalog, cachedir, version='1')) == ['ps']
+
+    assert table_names(tapSchema(catalog, cachedir, version='2')) == \
+        ['koa', 'ps']
+
+
+def test_ttl(catalog, tmp_path):
+
+    #
+    # Without a version the copy is used for ttl seconds
+    #
+
+    for (ttl, expected) in [(3600, ['ps']), (0, ['koa0', 'koa3600', 'ps'])]:
+
+        cachedir = str(tmp_path / f'cache{ttl:d}')
+
+        tapSchema(catalog, cachedir, ttl=ttl)
+
+        add_table(catalog, f'koa{ttl:d}')
+
+        assert table_names(tapSchema(catalog, cachedir, ttl=ttl)) == expected
+
+
+def test_missing_columns(catalog, tmp_path):
+
+    conn = sqlite3.connect(catalog['tap_schema'])
+    conn.execute('drop table columns')
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(Exception, match='Failed to copy TAP_SCHEMA'):
+        tapSchema(catalog, str(tmp_path / 'cache'))
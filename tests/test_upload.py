@@ -0,0 +1,129 @@
+import types
+
+import pytest
+
+from TAP.upload import tapUpload, save_uploads, upload_table
+
+
+def form(**fields):
+
+    return({name: types.SimpleNamespace(value=fields[name])
+            for name in fields})
+
+
+def load(tmp_path, text, **kwargs):
+
+    save_uploads('t,param:tbl', form(tbl=text), str(tmp_path))
+
+    return(tapUpload(str(tmp_path), **kwargs))
+
+
+def test_upload_table():
+
+    assert upload_table('TAP_UPLOAD.mylist')
+    assert upload_table('ora$ptt_mylist')
+    assert not upload_table('koa_hires')
+    assert not upload_table('tap_schema.columns')
+
+
+def test_csv(tmp_path):
+
+    upload = load(tmp_path, 'ID,RA,Dec,Name\n'
+                            '1,10.5,-5,a\n'
+                            '2,11,,b\n'
+                            '3,nan,7.25,\n')
+
+    table = upload.tables['t']
+
+    assert table['columns'] == ['id', 'ra', 'dec', 'name']
+    assert table['types'] == ['int', 'float', 'float', 'char']
+
+    assert table['rows'] == [[1, 10.5, -5.0, 'a'],
+                             [2, 11.0, None, 'b'],
+                             [3, None, 7.25, None]]
+
+
+def test_votable(tmp_path):
+
+    upload = load(tmp_path, """<?xml version="1.0"?>
+<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+<RESOURCE><TABLE>
+<FIELD name="id" datatype="long"/>
+<FIELD name="ra" datatype="double"/>
+<FIELD name="flag" datatype="boolean"/>
+<FIELD name="name" datatype="char" arraysize="*"/>
+<DATA><TABLEDATA>
+<TR><TD>1</TD><TD>10.5</TD><TD>true</TD><TD>a</TD></TR>
+<TR><TD>2</TD><TD></TD><TD>F</TD><TD>b c</TD></TR>
+</TABLEDATA></DATA>
+</TABLE></RESOURCE>
+</VOTABLE>
+""")
+
+    table = upload.tables['t']
+
+    assert table['columns'] == ['id', 'ra', 'flag', 'name']
+    assert table['types'] == ['int', 'float', 'int', 'char']
+    assert table['rows'] == [[1, 10.5, 1, 'a'], [2, None, 0, 'b c']]
+
+
+def test_digest(tmp_path):
+
+    digest1 = load(tmp_path / 'a', 'id\n1\n').digest
+    digest2 = load(tmp_path / 'b', 'id\n1\n').digest
+    digest3 = load(tmp_path / 'c', 'id\n2\n').digest
+
+    assert digest1 == digest2
+    assert digest1 != digest3
+
+
+@pytest.mark.parametrize('uploadstr', [
+    '1list,param:tbl',
+    'my-list,param:tbl',
+    'my list,param:tbl',
+    'x'*65 + ',param:tbl',
+    'list;drop table koa_hires,param:tbl',
+])
+def test_bad_table_name(tmp_path, uploadstr):
+
+    with pytest.raises(Exception):
+        save_uploads(uploadstr, form(tbl='id\n1\n'), str(tmp_path))
+
+
+def test_bad_upload(tmp_path):
+
+    with pytest.raises(Exception, match='used twice'):
+        save_uploads('a,param:tbl;A,param:tbl', form(tbl='id\n1\n'),
+                     str(tmp_path))
+
+    with pytest.raises(Exception, match='only inline uploads'):
+        save_uploads('a,http://example.com/t.xml', form(), str(tmp_path))
+
+    with pytest.raises(Exception, match='no form field'):
+        save_uploads('a,param:other', form(tbl='id\n1\n'), str(tmp_path))
+
+
+@pytest.mark.parametrize('text, message', [
+    ('id,"ra; drop"\n1,2\n', 'invalid column name'),
+    ('id,ID\n1,2\n', 'duplicate column names'),
+    ('id,ra\n1,2,3\n', 'row 1 has 3 values'),
+    ('', 'empty table'),
+    ("""<VOTABLE><RESOURCE><TABLE>
+<FIELD name="pos" datatype="double" arraysize="2"/>
+<DATA><TABLEDATA><TR><TD>1 2</TD></TR></TABLEDATA></DATA>
+</TABLE></RESOURCE></VOTABLE>""", 'array column'),
+    ("""<VOTABLE><RESOURCE><TABLE>
+<FIELD name="id" datatype="int"/>
+<DATA><BINARY><STREAM encoding="base64">AAAAAQ==</STREAM></BINARY></DATA>
+</TABLE></RESOURCE></VOTABLE>""", 'only TABLEDATA'),
+])
+def test_bad_table(tmp_path, text, message):
+
+    with pytest.raises(Exception, match=r'UPLOAD \[t\]: .*' + message):
+        load(tmp_path, text)
+
+
+def test_maxrows(tmp_path):
+
+    with pytest.raises(Exception, match='more than 2 rows'):
+        load(tmp_path, 'id\n1\n2\n3\n', maxrows=2)
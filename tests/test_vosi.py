@@ -0,0 +1,178 @@
+import sqlite3
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from TAP.vosi import vosiDocument
+
+
+VS = '{http://www.ivoa.net/xml/VODataService/v1.1}'
+VOSI = '{http://www.ivoa.net/xml/VOSIAvailability/v1.0}'
+
+
+@pytest.fixture
+def catalog(tmp_path):
+
+    dbpath = str(tmp_path / 'cat.db')
+    schemapath = str(tmp_path / 'tap_schema.db')
+
+    conn = sqlite3.connect(dbpath)
+    conn.execute('create table ps (pl_name text, ra real)')
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table schemas (schema_name text, description text)')
+    conn.execute("insert into schemas values ('TAP_SCHEMA', 'TAP metadata')")
+
+    conn.execute('create table tables (schema_name text, table_name text, '
+                 'table_type text, description text)')
+    conn.execute("insert into tables values ('', 'ps', 'table', "
+                 "'Planets & systems')")
+    conn.execute("insert into tables values ('TAP_SCHEMA', "
+                 "'TAP_SCHEMA.tables', 'table', '')")
+
+    conn.execute('create table columns (table_name text, column_name text, '
+                 'datatype text, unit text, description text, '
+                 'indexed integer, principal integer)')
+    conn.execute("insert into columns values ('ps', 'pl_name', 'char', "
+                 "'', 'Planet name', 0, 1)")
+    conn.execute("insert into columns values ('ps', 'ra', 'double', "
+                 "'deg', '', 1, 1)")
+
+    conn.commit()
+    conn.close()
+
+    return({'dbms': 'sqlite3', 'db': dbpath, 'tap_schema': schemapath})
+
+
+def document(doc):
+
+    with open(doc.path, 'rb') as fp:
+        return(ET.fromstring(fp.read()))
+
+
+def test_tables(catalog, tmp_path):
+
+    doc = vosiDocument(catalog, 'tables', cachedir=str(tmp_path / 'cache'))
+
+    root = document(doc)
+
+    schemas = {}
+    for schema in root.findall('schema'):
+        schemas[schema.findtext('name')] = schema
+
+    assert sorted(schemas) == ['TAP_SCHEMA', 'default']
+
+    assert schemas['TAP_SCHEMA'].findtext('description') == 'TAP metadata'
+
+    table = schemas['default'].find('table')
+
+    assert table.findtext('name') == 'ps'
+    assert table.findtext('description') == 'Planets & systems'
+
+    columns = table.findall('column')
+
+    assert [col.findtext('name') for col in columns] == ['pl_name', 'ra']
+
+    assert columns[0].find('dataType').text == 'char'
+    assert columns[0].find('dataType').get('arraysize') == '*'
+    assert [flag.text for flag in columns[0].findall('flag')] == \
+        ['principal']
+
+    assert columns[1].find('dataType').text == 'double'
+    assert columns[1].findtext('unit') == 'deg'
+    assert [flag.text for flag in columns[1].findall('flag')] == \
+        ['indexed', 'principal']
+
+
+def test_tables_version(catalog, tmp_path):
+
+    #
+    # The document is rendered again only when the TAP_SCHEMA version
+    # changes
+    #
+
+    cachedir = str(tmp_path / 'cache')
+
+    doc1 = vosiDocument(catalog, 'tables', cachedir=cachedir, version='1')
+
+    conn = sqlite3.connect(catalog['tap_schema'])
+    conn.execute("insert into tables values ('', 'koa', 'table', '')")
+    conn.commit()
+    conn.close()
+
+    doc2 = vosiDocument(catalog, 'tables', cachedir=cachedir, version='1')
+
+    assert (doc2.etag, doc2.mtime) == (doc1.etag, doc1.mtime)
+
+    doc3 = vosiDocument(catalog, 'tables', cachedir=cachedir, version='2')
+
+    assert doc3.etag != doc1.etag
+    assert 'koa' in [table.findtext('name')
+                     for table in document(doc3).iter('table')]
+
+
+def test_tables_ttl(catalog, tmp_path):
+
+    #
+    # Without a version the document is kept for ttl seconds
+    #
+
+    for (ttl, kept) in [(3600, True), (0, False)]:
+
+        cachedir = str(tmp_path / f'cache{ttl:d}')
+
+        doc1 = vosiDocument(catalog, 'tables', cachedir=cachedir, ttl=ttl)
+
+        conn = sqlite3.connect(catalog['tap_schema'])
+        conn.execute(f"insert into tables values ('', 'koa{ttl:d}', "
+                     "'table', '')")
+        conn.commit()
+        conn.close()
+
+        doc2 = vosiDocument(catalog, 'tables', cachedir=cachedir, ttl=ttl)
+
+        assert (doc2.etag == doc1.etag) == kept
+
+
+def test_capabilities(catalog, tmp_path):
+
+    cachedir = str(tmp_path / 'cache')
+
+    doc = vosiDocument(catalog, 'capabilities', cachedir=cachedir,
+                       baseurl='https://example.org/TAP')
+
+    urls = [url.text for url in document(doc).iter('accessURL')]
+
+    assert urls == ['https://example.org/TAP',
+                    'https://example.org/TAP/tables',
+                    'https://example.org/TAP/capabilities',
+                    'https://example.org/TAP/availability']
+
+    doc2 = vosiDocument(catalog, 'capabilities', cachedir=cachedir,
+                        baseurl='https://example.org/TAP2')
+
+    assert doc2.etag != doc.etag
+
+
+def test_availability(catalog, tmp_path):
+
+    doc = vosiDocument(catalog, 'availability',
+                       cachedir=str(tmp_path / 'cache1'))
+
+    assert document(doc).findtext(VOSI + 'available') == 'true'
+
+    catalog = dict(catalog, tap_schema=str(tmp_path / 'missing' / 'ts.db'))
+
+    doc = vosiDocument(catalog, 'availability',
+                       cachedir=str(tmp_path / 'cache2'))
+
+    assert document(doc).findtext(VOSI + 'available') == 'false'
+
+
+def test_invalid_resource(catalog, tmp_path):
+
+    with pytest.raises(Exception, match='Invalid VOSI resource'):
+        vosiDocument(catalog, 'examples', cachedir=str(tmp_path))
@@ -0,0 +1,295 @@
+import time
+import sqlite3
+
+import pytest
+
+from TAP import writeresult
+from TAP.writeresult import writeResult
+from TAP.datadictionary import dataDictionary
+
+
+NROW = 2500
+
+
+@pytest.fixture(scope='module')
+def catalog(tmp_path_factory):
+
+    dbdir = tmp_path_factory.mktemp('writeresult')
+
+    dbpath = str(dbdir / 'cat.db')
+    schemapath = str(dbdir / 'tap_schema.db')
+
+    conn = sqlite3.connect(dbpath)
+
+    conn.execute('create table src (id integer, ra real, name text, '
+                 'obsdate text, flag numeric)')
+
+    rows = []
+    for i in range(NROW):
+
+        if(i % 500 == 1):
+            rows.append((i, None, None, None, None))
+        else:
+            rows.append((i, i/10., f'S{i:06d}', f'2020-01-{i%28+1:02d}',
+                         i % 2))
+
+    conn.executemany('insert into src values (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(schemapath)
+
+    conn.execute('create table columns (table_name text, column_name text, '
+                 'datatype text, description text, unit text, format text)')
+
+    for (name, datatype, fmt) in [('id', 'int', '10d'),
+                                  ('ra', 'double', '12.6f'),
+                                  ('name', 'char', '10s')]:
+        conn.execute('insert into columns values (?, ?, ?, ?, ?, ?)',
+                     ('src', name, datatype, '', '', fmt))
+
+    conn.commit()
+    conn.close()
+
+    return({'db': dbpath, 'tap_schema': schemapath})
+
+
+class slowCursor:
+
+    # sqlite3 cursor whose fetchmany takes a while and counts the calls
+    # started and finished
+
+    def __init__(self, cursor):
+
+        self.cursor = cursor
+        self.nstart = 0
+        self.nend = 0
+
+    def __getattr__(self, name):
+        return(getattr(self.cursor, name))
+
+    def fetchmany(self, nfetch):
+
+        self.nstart = self.nstart + 1
+        time.sleep(0.2)
+
+        rows = self.cursor.fetchmany(nfetch)
+
+        self.nend = self.nend + 1
+        return(rows)
+
+
+def write(catalog, workdir, sql='select id, ra, name from src', **kwargs):
+
+    conn = sqlite3.connect(catalog['db'], check_same_thread=False)
+    conn.execute("attach database '" + catalog['tap_schema'] +
+                 "' as TAP_SCHEMA")
+
+    try:
+        dd = dataDictionary(conn, 'src')
+
+        cursor = conn.cursor()
+        cursor.execute(sql)
+
+        wresult = writeResult(cursor, str(workdir), dd, **kwargs)
+
+        with open(wresult.outpath, 'r') as fp:
+            text = fp.read()
+
+    finally:
+        conn.close()
+
+    return(wresult, text)
+
+
+@pytest.mark.parametrize('maxrec', [50, 100, 500, 5000])
+def test_memory_budget_overflow(catalog, tmp_path, maxrec):
+
+    #
+    # The QUERY_STATUS in the header follows maxrec whether or not the
+    # first fetch is a memory budget probe
+    #
+
+    for budget in [0, 100000]:
+
+        wresult, text = write(catalog, tmp_path, format='votable',
+                              maxrec=maxrec, arraysize=1000, nsample=100,
+                              memory_budget=budget)
+
+        if(maxrec < NROW):
+            assert '<INFO name="QUERY_STATUS" value="OVERFLOW"/>' in text
+            assert wresult.ntot == maxrec
+        else:
+            assert '<INFO name="QUERY_STATUS" value="OK"/>' in text
+            assert wresult.ntot == NROW
+
+
+@pytest.mark.parametrize('prefetch', [0, 1])
+def test_memory_budget_same_output(catalog, tmp_path, prefetch):
+
+    _, expected = write(catalog, tmp_path, format='csv', arraysize=1000)
+
+    wresult, text = write(catalog, tmp_path, format='csv', arraysize=1000,
+                          nsample=10, memory_budget=20000,
+                          prefetch=prefetch)
+
+    assert text == expected
+    assert wresult.ntot == NROW
+
+    assert wresult.rowbytes > 0
+    assert 0 < wresult.nbudget < 1000
+
+
+@pytest.mark.parametrize('arraysize', [100, 1000, 5000])
+def test_prefetch_same_output(catalog, tmp_path, arraysize):
+
+    for fmt in ['votable', 'ipac', 'csv', 'tsv']:
+
+        _, expected = write(catalog, tmp_path, format=fmt,
+                            arraysize=arraysize)
+
+        wresult, text = write(catalog, tmp_path, format=fmt,
+                              arraysize=arraysize, prefetch=1,
+                              arraysize_max=4*arraysize)
+
+        assert text == expected
+        assert wresult.ntot == NROW
+
+
+def test_prefetch_write_error(catalog, tmp_path, monkeypatch):
+
+    #
+    # A failed batch write stops the fetch thread before writeResult
+    # raises: the prefetched batch is cancelled or waited for, and the
+    # cursor is not read afterwards
+    #
+
+    class failingWriter:
+
+        def formatrecs(self, *args):
+            raise Exception('formatrecs failed')
+
+        def __getattr__(self, name):
+            return(getattr(writeresult.writerecs, name))
+
+    monkeypatch.setattr(writeresult, 'writerecs', failingWriter())
+
+    conn = sqlite3.connect(catalog['db'], check_same_thread=False)
+    conn.execute("attach database '" + catalog['tap_schema'] +
+                 "' as TAP_SCHEMA")
+
+    try:
+        dd = dataDictionary(conn, 'src')
+
+        cursor = conn.cursor()
+        cursor.execute('select id, ra, name from src')
+
+        cursor = slowCursor(cursor)
+
+        with pytest.raises(Exception, match='formatrecs failed'):
+            writeResult(cursor, str(tmp_path), dd, format='csv',
+                        arraysize=100, prefetch=1)
+
+        nstart = cursor.nstart
+        assert cursor.nend == nstart
+
+        time.sleep(0.5)
+        assert cursor.nstart == nstart
+
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('nworker', [2, 4])
+def test_encoder_threads_same_output(catalog, tmp_path, nworker):
+
+    sql = 'select id, ra, name, obsdate from src'
+
+    for fmt in ['votable', 'ipac', 'csv', 'tsv']:
+
+        _, expected = write(catalog, tmp_path, sql=sql, format=fmt,
+                            arraysize=300)
+
+        for prefetch in [0, 1]:
+
+            wresult, text = write(catalog, tmp_path, sql=sql, format=fmt,
+                                  arraysize=300, nworker=nworker,
+                                  prefetch=prefetch)
+
+            assert text == expected
+            assert wresult.ntot == NROW
+
+
+@pytest.mark.parametrize('fmt', ['votable', 'ipac', 'csv', 'tsv'])
+def test_exclcols(catalog, tmp_path, fmt):
+
+    #
+    # Excluded row columns are dropped from the output, wherever they are
+    #
+
+    _, expected = write(catalog, tmp_path, sql='select id, name from src',
+                        format=fmt)
+
+    _, text = write(catalog, tmp_path,
+                    sql='select ra, id, obsdate, name, flag from src',
+                    format=fmt, exclcol=[0, 2, 4])
+
+    _, text2 = write(catalog, tmp_path, sql='select id, ra, name from src',
+                     format=fmt, exclcol=1)
+
+    assert text == expected
+    assert text2 == expected
+
+
+def test_nulls(catalog, tmp_path):
+
+    sql = 'select id, ra, name, obsdate from src where id < 3'
+
+    _, text = write(catalog, tmp_path, sql=sql, format='ipac')
+
+    line = text.split('\n')[5].split()
+
+    assert line == ['1', 'null', 'null', 'null']
+
+    _, text = write(catalog, tmp_path, sql=sql, format='csv')
+
+    assert text.split('\n')[2] == '1,,,'
+
+
+def test_numeric_types(catalog, tmp_path):
+
+    #
+    # Declared SQLite types where there are some, a sample of the values
+    # for the expressions
+    #
+
+    _, text = write(catalog, tmp_path,
+                    sql='select id, ra, id*2 as twice, ra*2 as ra2, flag, '
+                        'obsdate from src',
+                    format='ipac')
+
+    types = [name.strip() for name in text.split('\n')[1].split('|')[1:-1]]
+
+    assert types == ['int', 'double', 'int', 'double', 'int', 'char']
+
+
+def test_sampled_type(catalog, tmp_path):
+
+    #
+    # A float after the sample of an int column prints as a double
+    #
+
+    sql = 'select id, case when id < 200 then id else id + 0.5 end ' \
+          'as late from src where id in (0, 150, 199, 200, 201)'
+
+    _, text = write(catalog, tmp_path, sql=sql, format='ipac', nsample=2)
+
+    lines = text.split('\n')
+
+    assert lines[1].split('|')[2].strip() == 'int'
+    assert lines[5].split() == ['150', '150']
+    assert lines[7].split() == ['200', '2.00500000000000e+02']
+
+    _, text = write(catalog, tmp_path, sql=sql, format='ipac')
+
+    assert text.split('\n')[1].split('|')[2].strip() == 'double'